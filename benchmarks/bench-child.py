@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+
+# Copyright 2021 Stephen Warren <swarren@wwwdotorg.org>
+# SPDX-License-Identifier: MIT
+
+# A synthetic logged command, for use by bench-throughput.py. Writes a given
+# amount of output, in writes of a given size, split across a tree of blocks.
+# Each of the --blocks top-level blocks contains a chain of --depth nested
+# blocks, and the output is divided evenly between the innermost blocks.
+#
+# Before each control command, the command's output is drained in the same
+# way as it would be with the real nestedlog-helper; see
+# helper-stand-in/nestedlog-helper. The time taken by each control command,
+# including the drain, is written as JSON to --latency-file.
+
+import argparse
+import json
+import os
+import sys
+import time
+
+src_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(src_dir, 'lib/python'))
+
+import nestedlog.api as nlapi
+
+DRAIN_FDS_ENV_VAR = 'NESTED_LOG_BENCH_DRAIN_FDS'
+
+def gen_data(size):
+    lines = []
+    total = 0
+    i = 0
+    while total < size:
+        line = f'line {i}: gcc -O2 -c src/file{i}.c -o obj/file{i}.o <{"x" * (i % 97)}> && echo "ok"\n'
+        lines.append(line)
+        total += len(line)
+        i += 1
+    return ''.join(lines).encode('utf-8')[:size]
+
+class Controller(object):
+    def __init__(self):
+        drain_fds = os.environ.get(DRAIN_FDS_ENV_VAR)
+        if drain_fds:
+            self.req_fd, self.ack_fd = map(int, drain_fds.split(','))
+        else:
+            self.req_fd = None
+        self.latencies = []
+
+    def _drain(self):
+        if self.req_fd is None:
+            return
+        os.write(self.req_fd, b'\x00')
+        os.read(self.ack_fd, 1)
+
+    def command(self, func, *args):
+        start = time.perf_counter()
+        self._drain()
+        func(*args)
+        self.latencies.append(time.perf_counter() - start)
+
+def main():
+    parser = argparse.ArgumentParser(description='Write synthetic output for benchmarking.')
+    parser.add_argument('--megabytes', type=float, default=16, help='amount of output to write')
+    parser.add_argument('--write-size', type=int, default=4096, help='size of each write')
+    parser.add_argument('--stderr-every', type=int, default=8, help='write every Nth write to stderr rather than stdout; 0 for never')
+    parser.add_argument('--blocks', type=int, default=16, help='number of top-level blocks')
+    parser.add_argument('--depth', type=int, default=1, help='nesting depth of each top-level block')
+    parser.add_argument('--latency-file', help='write control command latencies to file')
+    args = parser.parse_args()
+
+    total = int(args.megabytes * 1024 * 1024)
+    data = gen_data(max(args.write_size, 64 * 1024))
+    writes = total // args.write_size
+    controller = Controller()
+    write_num = 0
+    for block in range(args.blocks):
+        for level in range(args.depth):
+            controller.command(nlapi.start_block, f'block {block}.{level}')
+        block_writes = writes * (block + 1) // args.blocks - writes * block // args.blocks
+        for _ in range(block_writes):
+            pos = (write_num * args.write_size) % (len(data) - args.write_size + 1)
+            if args.stderr_every and write_num % args.stderr_every == args.stderr_every - 1:
+                fd = 2
+            else:
+                fd = 1
+            os.write(fd, data[pos:pos + args.write_size])
+            write_num += 1
+        for level in range(args.depth):
+            controller.command(nlapi.end_block, 'ok')
+
+    if args.latency_file:
+        with open(args.latency_file, 'w') as f:
+            json.dump(controller.latencies, f)
+
+main()
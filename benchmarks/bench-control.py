@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+
+# Copyright 2021 Stephen Warren <swarren@wwwdotorg.org>
+# SPDX-License-Identifier: MIT
+
+# Measures the per-command cost of creating blocks from a shell script, using
+# "nestedlog start-block"/"nestedlog end-block" and nestedlog-ctl.
+#
+# Run from the source tree after "make nestedlog-ctl":
+#   ./benchmarks/bench-control.py [--blocks N] [--capture pipe]
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+src_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+clients = {
+    'none': None,
+    'nestedlog': os.path.join(src_dir, 'nestedlog'),
+    'nestedlog-ctl': os.path.join(src_dir, 'nestedlog-ctl'),
+}
+
+def run(client, blocks, capture, tmp_dir):
+    if client is None:
+        script = f'for ((i = 0; i < {blocks}; i++)); do echo $i; done'
+    else:
+        script = f'''\
+for ((i = 0; i < {blocks}; i++)); do
+    {client} start-block "block $i"
+    echo $i
+    {client} end-block ok
+done'''
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.path.join(src_dir, 'lib/python')
+    env['PATH'] = src_dir + ':' + env['PATH']
+    cmd = [
+        sys.executable, os.path.join(src_dir, 'nestedlog'), 'log',
+        '--capture', capture,
+        '--emit-text', os.path.join(tmp_dir, 'log.txt'),
+        'bash', '-c', script,
+    ]
+    start = time.monotonic()
+    subprocess.run(cmd, env=env, check=True)
+    return time.monotonic() - start
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure per-command control path cost.')
+    parser.add_argument('--blocks', type=int, default=200, help='number of blocks to create')
+    parser.add_argument('--capture', default='pipe', help='capture method to use')
+    args = parser.parse_args()
+
+    results = {'blocks': args.blocks, 'capture': args.capture, 'clients': {}}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        baseline = run(None, args.blocks, args.capture, tmp_dir)
+        for name, client in clients.items():
+            if client is None:
+                continue
+            if not os.access(client, os.X_OK):
+                print(f'Skipping {name}; {client} not built', file=sys.stderr)
+                continue
+            elapsed = run(client, args.blocks, args.capture, tmp_dir)
+            # Each block uses 2 commands.
+            per_cmd = (elapsed - baseline) / (args.blocks * 2)
+            results['clients'][name] = {'elapsed': elapsed, 'per_command': per_cmd}
+            print(f'{name:>16}: {per_cmd * 1000:8.3f} ms/command', file=sys.stderr)
+    json.dump(results, sys.stdout, indent=4)
+    print()
+
+main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+
+# Copyright 2021 Stephen Warren <swarren@wwwdotorg.org>
+# SPDX-License-Identifier: MIT
+
+# Measures the cost of formatting output, by driving a Sink directly with
+# synthetic output, and each combination of emitters.
+#
+# Run from the source tree:
+#   ./benchmarks/bench-emitters.py [--megabytes N] [--depth N]
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+src_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(src_dir, 'lib/python'))
+
+import nestedlog.data as nld
+import nestedlog.emitter_html as nlehtml
+import nestedlog.emitter_html_inline as nlehtmli
+import nestedlog.emitter_plain_text as nleplain
+import nestedlog.sink as nlsink
+
+configs = {
+    'text': (nleplain.Emitter,),
+    'html': (nlehtml.Emitter,),
+    'html-inline': (nlehtmli.Emitter,),
+    'html+html-inline': (nlehtml.Emitter, nlehtmli.Emitter),
+    'all': (nlehtml.Emitter, nlehtmli.Emitter, nleplain.Emitter),
+}
+
+# A mixture of short lines, and longer lines which need HTML escaping, read
+# in chunks of up to 32 KiB.
+def gen_chunks(megabytes):
+    lines = [
+        f'{i}\n' if i % 2 else
+        f'line {i}: gcc -O2 -c src/file{i}.c -o obj/file{i}.o <{"x" * (i % 97)}> && echo "ok"\n'
+        for i in range(1000)
+    ]
+    text = ''.join(lines)
+    chunks = [text[i:i + 32768] for i in range(0, len(text), 32768)]
+    total = 0
+    out = []
+    while total < megabytes * 1024 * 1024:
+        for chunk in chunks:
+            out.append(chunk)
+            total += len(chunk)
+    return out, total
+
+def run(emitter_classes, chunks, depth, tmp_dir):
+    emitters = [
+        emitter_class(os.path.join(tmp_dir, f'log{i}'))
+        for i, emitter_class in enumerate(emitter_classes)
+    ]
+    sink = nlsink.Sink(emitters)
+    start = time.perf_counter()
+    sink.start_log()
+    for i in range(depth):
+        sink.start_block(f'block {i}')
+    for i, chunk in enumerate(chunks):
+        if i % 8 == 7:
+            sink.stream_data(nld.STREAM_STDERR, chunk)
+        else:
+            sink.stream_data(nld.STREAM_STDOUT, chunk)
+    for i in range(depth):
+        sink.end_block(nld.STATUS_OK)
+    sink.end_log()
+    return time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure emitter formatting cost.')
+    parser.add_argument('--megabytes', type=int, default=32, help='amount of output to format')
+    parser.add_argument('--depth', type=int, default=4, help='block nesting depth of the output')
+    parser.add_argument('--repeat', type=int, default=3, help='number of runs of each configuration; the fastest is reported')
+    args = parser.parse_args()
+
+    chunks, total = gen_chunks(args.megabytes)
+    results = {'megabytes': total / (1024 * 1024), 'depth': args.depth, 'configs': {}}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name, emitter_classes in configs.items():
+            elapsed = min(run(emitter_classes, chunks, args.depth, tmp_dir) for _ in range(args.repeat))
+            mb_per_s = total / (1024 * 1024) / elapsed
+            results['configs'][name] = {'elapsed': elapsed, 'mb_per_s': mb_per_s}
+            print(f'{name:>18}: {elapsed:8.3f} s, {mb_per_s:8.1f} MB/s', file=sys.stderr)
+    json.dump(results, sys.stdout, indent=4)
+    print()
+
+main()
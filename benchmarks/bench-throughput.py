@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+
+# Copyright 2021 Stephen Warren <swarren@wwwdotorg.org>
+# SPDX-License-Identifier: MIT
+
+# Measures end-to-end "nestedlog log" performance: throughput, control
+# command latency, nestedlog's peak RSS, and the time spent in each emitter.
+# Each scenario runs bench-child.py with different output patterns, once for
+# each emitter configuration.
+#
+# By default, "--capture cuse" is used with helper-stand-in/nestedlog-helper,
+# so that no /dev/cuse is required. "--helper real" uses the nestedlog-helper
+# found in $PATH instead.
+#
+# Run from the source tree:
+#   ./benchmarks/bench-throughput.py [--scale N] [--output results.json]
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+src_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+bench_dir = os.path.join(src_dir, 'benchmarks')
+
+# Arguments to bench-child.py. --megabytes is multiplied by --scale.
+scenarios = {
+    'bulk': {'megabytes': 32, 'write_size': 65536, 'stderr_every': 0, 'blocks': 1, 'depth': 1},
+    'lines': {'megabytes': 4, 'write_size': 80, 'stderr_every': 0, 'blocks': 1, 'depth': 1},
+    'interleaved': {'megabytes': 8, 'write_size': 4096, 'stderr_every': 2, 'blocks': 16, 'depth': 1},
+    'many-blocks': {'megabytes': 2, 'write_size': 4096, 'stderr_every': 8, 'blocks': 1000, 'depth': 1},
+    'deep': {'megabytes': 2, 'write_size': 4096, 'stderr_every': 8, 'blocks': 20, 'depth': 25},
+}
+
+configs = {
+    'text': ('--emit-text',),
+    'html': ('--emit-html',),
+    'html-inline': ('--emit-html-inline',),
+    'all': ('--emit-html', '--emit-html-inline', '--emit-text'),
+}
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], cwd=src_dir, check=True,
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(scenario, emitter_args, args, tmp_dir):
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.path.join(src_dir, 'lib/python')
+    env['PATH'] = src_dir + ':' + env['PATH']
+    if args.capture == 'cuse' and args.helper == 'stand-in':
+        env['PATH'] = os.path.join(bench_dir, 'helper-stand-in') + ':' + env['PATH']
+    stats_file = os.path.join(tmp_dir, 'stats.json')
+    latency_file = os.path.join(tmp_dir, 'latency.json')
+    cmd = [sys.executable, os.path.join(src_dir, 'nestedlog'), 'log', '--capture', args.capture, '--stats-json', stats_file]
+    for i, emitter_arg in enumerate(emitter_args):
+        cmd += [emitter_arg, os.path.join(tmp_dir, f'log{i}')]
+    cmd += [
+        sys.executable, os.path.join(bench_dir, 'bench-child.py'),
+        '--megabytes', str(scenario['megabytes'] * args.scale),
+        '--write-size', str(scenario['write_size']),
+        '--stderr-every', str(scenario['stderr_every']),
+        '--blocks', str(scenario['blocks']),
+        '--depth', str(scenario['depth']),
+        '--latency-file', latency_file,
+    ]
+    start = time.monotonic()
+    subprocess.run(cmd, env=env, check=True)
+    elapsed = time.monotonic() - start
+    with open(stats_file) as f:
+        stats = json.load(f)
+    with open(latency_file) as f:
+        latencies = json.load(f)
+    total_bytes = sum(stream['bytes'] for stream in stats['streams'].values())
+    return {
+        'elapsed': elapsed,
+        # Excludes interpreter startup.
+        'nestedlog_elapsed': stats['elapsed'],
+        'mb_per_s': total_bytes / (1024 * 1024) / elapsed,
+        'bytes': total_bytes,
+        'maxrss': stats['maxrss'],
+        'helper_protocol': stats['helper_protocol'],
+        'wakeups': stats['poll']['wakeups'],
+        'bytes_per_read': stats['poll']['bytes_per_read'],
+        # As seen by the logged command, including draining its output.
+        'control_latency': {
+            'commands': len(latencies),
+            'avg': sum(latencies) / len(latencies) if latencies else 0.0,
+            'p50': percentile(latencies, 0.5),
+            'p99': percentile(latencies, 0.99),
+            'max': max(latencies, default=0.0),
+        },
+        'emitters': {
+            emitter['emitter']: emitter['seconds']
+            for emitter in stats['emitters']
+        },
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure end-to-end nestedlog performance.')
+    parser.add_argument('--scale', type=float, default=1, help='multiply the output volume of each scenario by this')
+    parser.add_argument('--repeat', type=int, default=3, help='number of runs of each configuration; the fastest is reported')
+    parser.add_argument('--scenario', action='append', choices=scenarios.keys(), help='only run this scenario; may be repeated')
+    parser.add_argument('--config', action='append', choices=configs.keys(), help='only run this emitter configuration; may be repeated')
+    parser.add_argument('--capture', choices=('cuse', 'pipe', 'pty'), default='cuse', help='capture method to use')
+    parser.add_argument('--helper', choices=('stand-in', 'real'), default='stand-in', help='with --capture cuse, which nestedlog-helper to use')
+    parser.add_argument('--output', metavar='filename', help='write results to file rather than stdout')
+    args = parser.parse_args()
+
+    results = {
+        'time': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'capture': args.capture,
+        'helper': args.helper if args.capture == 'cuse' else None,
+        'scale': args.scale,
+        'scenarios': {},
+    }
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for scenario_name in args.scenario or scenarios.keys():
+            scenario = scenarios[scenario_name]
+            scenario_results = {'params': scenario, 'configs': {}}
+            results['scenarios'][scenario_name] = scenario_results
+            for config_name in args.config or configs.keys():
+                runs = [run(scenario, configs[config_name], args, tmp_dir) for _ in range(args.repeat)]
+                best = min(runs, key=lambda result: result['elapsed'])
+                scenario_results['configs'][config_name] = best
+                print(
+                    f'{scenario_name:>12} {config_name:>12}: {best["mb_per_s"]:8.1f} MB/s, ' +
+                    f'control p50 {best["control_latency"]["p50"] * 1000:7.3f} ms, ' +
+                    f'max RSS {best["maxrss"]:7} KiB',
+                    file=sys.stderr)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4)
+            f.write('\n')
+    else:
+        json.dump(results, sys.stdout, indent=4)
+        print()
+
+main()
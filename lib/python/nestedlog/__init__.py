@@ -0,0 +1,10 @@
+# Copyright 2021 Stephen Warren <swarren@wwwdotorg.org>
+# SPDX-License-Identifier: MIT
+
+# Session is imported on first use, so that scripts which only import e.g.
+# nestedlog.api don't pay for loading the sink and emitter machinery.
+def __getattr__(name):
+    if name == 'Session':
+        import nestedlog.session as nlsession
+        return nlsession.Session
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
@@ -3,6 +3,7 @@
 
 from contextlib import contextmanager
 import nestedlog.data as nld
+import nestedlog.rusage as nlrusage
 import os
 import socket
 import subprocess
@@ -10,22 +11,151 @@ import sys
 import termios
 
 SOCK_ENV_VAR = 'NESTED_LOG_CONTROL'
+CAPTURE_ENV_VAR = 'NESTED_LOG_CAPTURE'
 
 CMD_START_BLOCK = 'start-block'
 CMD_END_BLOCK = 'end-block'
 
+def _status_text(status):
+    if status in nld.status_to_text:
+        return nld.status_to_text[status]
+    if status in nld.text_to_status:
+        return status
+    raise Exception('Invalid status ' + str(status))
+
+# A connection to the nestedlog server, which is opened on first use and then
+# kept open for the rest of the process's lifetime.
+class Client(object):
+    def __init__(self, sock_path=None):
+        if sock_path is None:
+            sock_path = os.environ[SOCK_ENV_VAR]
+        self.sock_path = sock_path
+        self.sock = None
+        self.pid = None
+        self.batch_cmds = None
+
+    def _connect(self):
+        # A forked child must not share its parent's connection, or their
+        # commands and responses would be interleaved.
+        if self.sock is not None and self.pid == os.getpid():
+            return
+        if self.sock is not None:
+            self.sock.close()
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.sock_path)
+        self.pid = os.getpid()
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def _send_cmds(self, cmds):
+        _flush_data()
+        self._connect()
+        self.sock.sendall(''.join(cmds).encode('utf-8'))
+        responses = b''
+        while len(responses) < len(cmds):
+            response = self.sock.recv(len(cmds) - len(responses))
+            if not response:
+                self.close()
+                raise Exception('nestedlog server closed the connection')
+            responses += response
+        if responses != b'0' * len(cmds):
+            raise Exception('nestedlog server command failed')
+
+    def _send_cmd(self, cmd):
+        if self.batch_cmds is not None:
+            self.batch_cmds.append(cmd)
+        else:
+            self._send_cmds([cmd])
+
+    # Within a batch, commands are queued, and then sent all at once, after a
+    # single flush of the data path. Queued commands are sent early, before
+    # any output is written via sys.stdout or sys.stderr (including their
+    # buffers), and once a block started by run_python_as_block() or
+    # run_as_block() begins, so that output always lands in the block that
+    # was open when it was written. Output written any other way, e.g. by a
+    # subprocess, must be preceded by flush().
+    @contextmanager
+    def batch(self):
+        if self.batch_cmds is not None:
+            yield self
+            return
+        self.batch_cmds = []
+        stdout = sys.stdout
+        stderr = sys.stderr
+        sys.stdout = _BatchStream(stdout, self)
+        sys.stderr = _BatchStream(stderr, self)
+        try:
+            yield self
+        finally:
+            sys.stdout = stdout
+            sys.stderr = stderr
+            cmds = self.batch_cmds
+            self.batch_cmds = None
+            if cmds:
+                self._send_cmds(cmds)
+
+    # Sends any commands queued by a batch now.
+    def flush(self):
+        if self.batch_cmds:
+            cmds = self.batch_cmds
+            self.batch_cmds = []
+            self._send_cmds(cmds)
+
+    def start_block(self, block_name):
+        self._send_cmd(f'{CMD_START_BLOCK} {block_name}\n')
+
+    # rusage optionally reports the resources the block consumed; see
+    # nestedlog.rusage. If not specified, the server measures the CPU time
+    # consumed by children of the calling process's parent (e.g. the shell
+    # script that ran "nestedlog start-block" and "nestedlog end-block").
+    def end_block(self, status, rusage=None):
+        status = _status_text(status)
+        if rusage:
+            self._send_cmd(f'{CMD_END_BLOCK} {status} {nlrusage.to_args(rusage)}\n')
+        else:
+            self._send_cmd(f'{CMD_END_BLOCK} {status}\n')
+
+# Wraps sys.stdout or sys.stderr during a batch, sending the queued commands
+# before anything is written.
+class _BatchStream(object):
+    def __init__(self, stream, client):
+        self._stream = stream
+        self._client = client
+
+    def write(self, s):
+        self._client.flush()
+        return self._stream.write(s)
+
+    def writelines(self, lines):
+        self._client.flush()
+        return self._stream.writelines(lines)
+
+    @property
+    def buffer(self):
+        return _BatchStream(self._stream.buffer, self._client)
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+_client = None
+
+def get_client():
+    global _client
+    if _client is None:
+        _client = Client()
+    return _client
+
 def start_block(block_name):
-    _send_cmd(f'{CMD_START_BLOCK} {block_name}\n')
+    get_client().start_block(block_name)
 
-def end_block(status):
-    if status in nld.status_to_text:
-        status = nld.status_to_text[status]
-    elif status in nld.text_to_status:
-        pass
-    else:
-        raise Exception('Invalid status ' + str(status))
+def end_block(status, rusage=None):
+    get_client().end_block(status, rusage)
 
-    _send_cmd(f'{CMD_END_BLOCK} {status}\n')
+def batch():
+    return get_client().batch()
 
 class MarkBlockAsFailedException(Exception):
     pass
@@ -33,13 +163,21 @@ class MarkBlockAsFailedException(Exception):
 class BlockFailedException(Exception):
     pass
 
+# Implements run_python_as_block() for anything with start_block() and
+# end_block() methods, such as a Client or a nestedlog.Session.
 @contextmanager
-def run_python_as_block(block_name, exit_on_fail=False):
-    start_block(block_name)
+def _python_block(target, block_name):
+    target.start_block(block_name)
+    # The block's content follows straight away, so must not wait for the
+    # end of a batch.
+    if isinstance(target, Client):
+        target.flush()
+    rusage_start = nlrusage.self_and_children()
+    block = {'rusage': None}
     status = nld.STATUS_AUTO
     try:
         try:
-            yield None
+            yield block
         finally:
             sys.stdout.flush()
     except MarkBlockAsFailedException:
@@ -49,18 +187,35 @@ def run_python_as_block(block_name, exit_on_fail=False):
         import traceback
         traceback.print_exc(file=sys.stderr)
         status = nld.STATUS_ERROR
-    end_block(status)
+    rusage = block['rusage']
+    if rusage is None:
+        rusage = nlrusage.delta(nlrusage.self_and_children(), rusage_start)
+    target.end_block(status, rusage)
     if status != nld.STATUS_AUTO:
         raise BlockFailedException()
 
+# Yields a dict; setting its 'rusage' entry overrides the resource usage that
+# is reported for the block, which otherwise is the CPU time consumed by this
+# process and its children while the block ran.
+def run_python_as_block(block_name, exit_on_fail=False):
+    return _python_block(get_client(), block_name)
+
 def run_as_block(block_name, cmd):
-    with run_python_as_block(block_name):
-        cpe = subprocess.run(cmd)
-        if cpe.returncode != 0:
-            print('ERROR: Process exit code ' + str(cpe.returncode), file=sys.stderr)
+    with run_python_as_block(block_name) as block:
+        sp = subprocess.Popen(cmd)
+        pid, wait_status, ru = os.wait4(sp.pid, 0)
+        sp.returncode = nlrusage.exit_code(wait_status)
+        block['rusage'] = nlrusage.from_struct_rusage(ru)
+        if sp.returncode != 0:
+            print('ERROR: Process exit code ' + str(sp.returncode), file=sys.stderr)
             raise MarkBlockAsFailedException()
 
-def _send_cmd(cmd):
+# See nestedlog.parallel.run_parallel_blocks().
+def run_parallel_blocks(blocks, jobs=None, spill_threshold=16 * 1024 * 1024):
+    import nestedlog.parallel as nlparallel
+    return nlparallel.run_parallel_blocks(blocks, jobs, spill_threshold)
+
+def _flush_data():
     # Flush data path all the way to nestedlog server.
     #
     # These should be no-ops, since stdout/stderr are a character device
@@ -68,14 +223,9 @@ def _send_cmd(cmd):
     sys.stdout.flush()
     sys.stderr.flush()
     # Synchronously flush to nestedlog-helper CUSE server, which will
-    # synchronously flush to main nestedlog server.
-    termios.tcdrain(1)
-
-    sock_path = os.environ[SOCK_ENV_VAR]
-    client_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-    client_sock.connect(sock_path)
-    client_sock.sendall(cmd.encode('utf-8'))
-    response = client_sock.recv(1)
-    client_sock.close()
-    if response != b'0':
-        raise Exception('nestedlog server command failed')
+    # synchronously flush to main nestedlog server. With the pipe and pty
+    # capture backends, the server drains the streams itself before acting
+    # on each command, so data already written is enough.
+    capture = os.environ.get(CAPTURE_ENV_VAR, nld.CAPTURE_CUSE)
+    if capture == nld.CAPTURE_CUSE:
+        termios.tcdrain(1)
@@ -17,3 +17,30 @@ status_max_len = max(map(len, text_to_status))
 
 STREAM_STDOUT = 0
 STREAM_STDERR = 1
+
+CAPTURE_CUSE = 'cuse'
+CAPTURE_PIPE = 'pipe'
+CAPTURE_PTY = 'pty'
+captures = (CAPTURE_CUSE, CAPTURE_PIPE, CAPTURE_PTY)
+
+def format_duration(seconds):
+    if seconds < 60:
+        return f'{seconds:.3f}s'
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return f'{hours}h{minutes:02}m{seconds:02}s'
+    return f'{minutes}m{seconds:02}s'
+
+# Formats the statistics Sink gathers for each block, for use in block
+# footers. Not all statistics are available in all cases, e.g. when a block
+# was closed because a journal was truncated.
+def format_block_stats(stats):
+    parts = []
+    if 'duration' in stats:
+        parts.append(format_duration(stats['duration']))
+    if 'utime' in stats:
+        parts.append(f'user {stats["utime"]:.3f}s')
+    if 'stime' in stats:
+        parts.append(f'sys {stats["stime"]:.3f}s')
+    return ', '.join(parts)
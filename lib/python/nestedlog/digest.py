@@ -0,0 +1,187 @@
+# Copyright 2021 Stephen Warren <swarren@wwwdotorg.org>
+# SPDX-License-Identifier: MIT
+
+import json
+import nestedlog.data as nld
+import re
+
+# Finds lines of interest (errors, warnings, tracebacks, ...) in the log's
+# output as it arrives, so that a failed run can be triaged without reading
+# the whole log. The output is scanned as the command wrote it, before any
+# filters, so lines that a filter removes from the log are still found.
+#
+# patterns is a list of (kind, regex); kind must be a valid Python
+# identifier. All patterns are combined into a single regex, which is run
+# over each chunk of output to find the lines that match any of them. Only
+# whole lines are matched; the incomplete last line of a chunk is held back
+# (up to max_line characters) until the rest of it arrives. Each line is
+# recorded at most once, as the kind of the first pattern in the list that
+# matches it, wherever in the line that pattern matches; the combined regex
+# only reports the leftmost match, so any earlier patterns are then checked
+# against the line separately.
+#
+# Each hit is a dict:
+#   kind: the pattern's kind.
+#   block_id: ID of the block containing the line.
+#   path: names of the blocks containing the line, outermost first.
+#   stream: "stdout" or "stderr".
+#   line_number: number of the line within the block's output on that
+#       stream, counting from 1.
+#   line: the line, without its line ending, truncated to max_text
+#       characters.
+#
+# At most max_hits hits are recorded; the rest are only counted, in dropped.
+
+default_patterns = [
+    ('error', r'(?i:\berror\b|\bfatal\b)|\bFAIL(?:ED|URE)?\b'),
+    ('traceback', r'^Traceback \(most recent call last\):'),
+    ('warning', r'(?i:\bwarning\b)'),
+]
+
+_stream_names = {
+    nld.STREAM_STDOUT: 'stdout',
+    nld.STREAM_STDERR: 'stderr',
+}
+
+# Parses a "kind=regex" command-line argument.
+def parse_pattern(arg):
+    kind, sep, regex = arg.partition('=')
+    if not sep or not kind.isidentifier():
+        raise Exception(f'Invalid digest pattern "{arg}"; expected kind=regex')
+    try:
+        re.compile(regex)
+    except re.error as e:
+        raise Exception(f'Invalid digest pattern "{arg}": {e}')
+    return (kind, regex)
+
+class Digest(object):
+    def __init__(self, patterns=None, max_hits=1000, max_line=4096, max_text=200):
+        if not patterns:
+            patterns = default_patterns
+        self.kinds = [kind for (kind, regex) in patterns]
+        self.pattern_regexes = [re.compile(regex, re.MULTILINE) for (kind, regex) in patterns]
+        self.group_index = {}
+        regexes = []
+        for i, (kind, regex) in enumerate(patterns):
+            group = f'p{i}'
+            self.group_index[group] = i
+            regexes.append(f'(?P<{group}>{regex})')
+        self.regex = re.compile('|'.join(regexes), re.MULTILINE)
+        self.max_hits = max_hits
+        self.max_line = max_line
+        self.max_text = max_text
+        self.hits = []
+        self.dropped = 0
+        self.blocks = []
+
+    def start_block(self, block_id, block_name):
+        self.blocks.append({
+            'id': block_id,
+            'name': block_name,
+            # Per stream: complete lines of output so far.
+            'lines': {stream: 0 for stream in _stream_names},
+            # Per stream: incomplete last line.
+            'pending': {},
+        })
+
+    def end_block(self):
+        self.flush()
+        self.blocks.pop()
+
+    # Matches any incomplete lines being held back, e.g. because the block is
+    # ending.
+    def flush(self):
+        block = self.blocks[-1]
+        for stream, text in block['pending'].items():
+            self._match(block, stream, text)
+        block['pending'] = {}
+
+    def feed(self, stream, data):
+        block = self.blocks[-1]
+        pending = block['pending'].pop(stream, None)
+        if pending:
+            data = pending + data
+        end = data.rfind('\n') + 1
+        if end < len(data) and len(data) - end <= self.max_line:
+            block['pending'][stream] = data[end:]
+            data = data[:end]
+        if data:
+            self._match(block, stream, data)
+
+    # text starts at the beginning of a line, unless the previous text was
+    # the start of a line longer than max_line.
+    def _match(self, block, stream, text):
+        line_number = block['lines'][stream] + 1
+        counted = 0
+        line_end = -1
+        for match in self.regex.finditer(text):
+            start = match.start()
+            if start < line_end:
+                continue
+            line_start = text.rfind('\n', 0, start) + 1
+            line_end = text.find('\n', start)
+            if line_end < 0:
+                line_end = len(text)
+            if len(self.hits) >= self.max_hits:
+                self.dropped += 1
+                continue
+            line_number += text.count('\n', counted, line_start)
+            counted = line_start
+            index = self.group_index[match.lastgroup]
+            for earlier in range(index):
+                if self.pattern_regexes[earlier].search(text, line_start, line_end):
+                    index = earlier
+                    break
+            self.hits.append({
+                'kind': self.kinds[index],
+                'block_id': block['id'],
+                'path': [b['name'] for b in self.blocks],
+                'stream': _stream_names[stream],
+                'line_number': line_number,
+                'line': text[line_start:line_end][:self.max_text],
+            })
+        block['lines'][stream] += text.count('\n')
+
+    def write(self, file_name):
+        with open(file_name, 'wt') as f:
+            json.dump({'hits': self.hits, 'dropped': self.dropped}, f, indent=4)
+            f.write('\n')
+
+# Formats a digest as text, in at most max_bytes bytes of UTF-8 if given.
+def format_text(hits, dropped, max_bytes=None):
+    counts = {}
+    for hit in hits:
+        counts[hit['kind']] = counts.get(hit['kind'], 0) + 1
+    summary = ', '.join(f'{count} {kind}' for (kind, count) in counts.items()) or 'nothing found'
+    if dropped:
+        summary += f', {dropped} more not recorded'
+    lines = [f'Digest: {summary}\n']
+    size = len(lines[0].encode('utf-8'))
+    for i, hit in enumerate(hits):
+        line = f'{hit["kind"]}: {" / ".join(hit["path"])} ({hit["stream"]} line {hit["line_number"]}): {hit["line"]}\n'
+        line_size = len(line.encode('utf-8'))
+        if max_bytes is not None:
+            # Always leave room to say that some hits were left out.
+            more = f'... {len(hits) - i} more\n'
+            if size + line_size + len(more) > max_bytes:
+                lines.append(more)
+                break
+        lines.append(line)
+        size += line_size
+    text = ''.join(lines)
+    if max_bytes is not None and len(text.encode('utf-8')) > max_bytes:
+        text = str(text.encode('utf-8')[:max_bytes], 'utf-8', 'ignore')
+    return text
+
+# Formats a digest using format_text(), then wrap(text), shortening the digest
+# until the result fits into max_bytes bytes of UTF-8. Used by emitters to fill
+# the space they reserved at the top of the log.
+def format_fitted(hits, dropped, max_bytes, wrap=lambda text: text):
+    budget = max_bytes
+    while budget > 0:
+        out = wrap(format_text(hits, dropped, budget))
+        excess = len(out.encode('utf-8')) - max_bytes
+        if excess <= 0:
+            return out
+        budget -= excess
+    return ''
@@ -1,19 +1,186 @@
 # Copyright 2021 Stephen Warren <swarren@wwwdotorg.org>
 # SPDX-License-Identifier: MIT
 
+import html
 import nestedlog.data as nld
 import os
+import time
+import zlib
+
+COMPRESSION_GZIP = 'gzip'
+COMPRESSION_ZSTD = 'zstd'
+
+compression_suffixes = {
+    COMPRESSION_GZIP: '.gz',
+    COMPRESSION_ZSTD: '.zst',
+}
+
+# Log files are compressed according to their file name suffix.
+def compression_type(file_name):
+    for compression, suffix in compression_suffixes.items():
+        if file_name.endswith(suffix):
+            return compression
+    return None
+
+def _zstd():
+    try:
+        import zstandard
+    except ImportError:
+        raise Exception('zstd compression requires the "zstandard" Python module')
+    return zstandard
+
+# Opens a (possibly compressed) log file for reading.
+def open_log(file_name):
+    compression = compression_type(file_name)
+    if compression == COMPRESSION_GZIP:
+        import gzip
+        return gzip.open(file_name, 'rb')
+    if compression == COMPRESSION_ZSTD:
+        return _zstd().ZstdDecompressor().stream_reader(open(file_name, 'rb'), closefd=True)
+    return open(file_name, 'rb')
+
+# A piece of stream data, as passed to emit_stream_data(). Forms of the data
+# that several emitters need are computed on first use, and then shared.
+# time is the time.time() at which the data arrived, or None if unknown.
+class Chunk(object):
+    __slots__ = ('text', 'time', '_html', '_lines')
+
+    def __init__(self, text, time=None):
+        self.text = text
+        self.time = time
+        self._html = None
+        self._lines = None
+
+    # The text, escaped for inclusion in HTML.
+    @property
+    def html(self):
+        if self._html is None:
+            self._html = html.escape(self.text)
+        return self._html
+
+    # The text, split into lines, each including its line ending.
+    @property
+    def lines(self):
+        if self._lines is None:
+            self._lines = self.text.splitlines(True)
+        return self._lines
+
+# Formats chunk arrival times for a per-line time gutter, e.g.
+# "12:34:56.789 ". Chunks of unknown time get a blank gutter.
+class TimeGutter(object):
+    width = 13
+
+    def __init__(self):
+        self.second = None
+        self.second_text = None
+
+    def format(self, timestamp):
+        if timestamp is None:
+            return ' ' * self.width
+        second = int(timestamp)
+        # Most chunks arrive within the same second as the previous one.
+        if second != self.second:
+            self.second = second
+            self.second_text = time.strftime('%H:%M:%S', time.localtime(second))
+        return f'{self.second_text}.{int((timestamp - second) * 1000):03} '
+
+# Data is collected into large chunks before being compressed, since the
+# compressors have a significant per-call cost, and emitters make many small
+# writes.
+class _CompressedFile(object):
+    def __init__(self, file_name, compression, buffer_size):
+        self.file = open(file_name, 'wb')
+        if compression == COMPRESSION_GZIP:
+            self.compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            self.flush_mode = zlib.Z_SYNC_FLUSH
+        else:
+            self.compressor = _zstd().ZstdCompressor().compressobj()
+            self.flush_mode = _zstd().COMPRESSOBJ_FLUSH_BLOCK
+        self.buffer_size = buffer_size
+        self.chunks = []
+        self.size = 0
+
+    def write(self, b):
+        self.chunks.append(b)
+        self.size += len(b)
+        if self.size >= self.buffer_size:
+            self._compress()
+
+    def _compress(self):
+        self.file.write(self.compressor.compress(b''.join(self.chunks)))
+        self.chunks = []
+        self.size = 0
+
+    # Makes everything written so far decompressible from the file.
+    def flush(self):
+        self._compress()
+        self.file.write(self.compressor.flush(self.flush_mode))
+        self.file.flush()
+
+    def close(self):
+        self._compress()
+        self.file.write(self.compressor.flush())
+        self.file.close()
+
+# A log file written through a large buffer. Patches to data that was
+# written earlier are queued, and applied in batches directly to the file,
+# so that the buffer doesn't need to be flushed for each patch.
+#
+# Compressed log files can't be patched; emitters must check patchable, and
+# record anything that isn't known until later (such as block status) after
+# the fact instead.
+class LogFile(object):
+    def __init__(self, log_file_name, buffer_size=1024 * 1024, max_patches=1024):
+        compression = compression_type(log_file_name)
+        if compression:
+            self.file = _CompressedFile(log_file_name, compression, buffer_size)
+        else:
+            self.file = open(log_file_name, 'wb', buffering=buffer_size)
+        self.patchable = compression is None
+        self.max_patches = max_patches
+        self.pos = 0
+        self.patches = []
+
+    def write(self, s):
+        b = s.encode('utf-8')
+        self.file.write(b)
+        self.pos += len(b)
+
+    def tell(self):
+        return self.pos
+
+    def patch(self, pos, s):
+        if not self.patchable:
+            raise Exception('Compressed log files cannot be patched')
+        self.patches.append((pos, s.encode('utf-8')))
+        if len(self.patches) >= self.max_patches:
+            self.apply_patches()
+
+    def apply_patches(self):
+        if not self.patches:
+            return
+        self.file.flush()
+        fd = self.file.fileno()
+        for pos, b in self.patches:
+            os.pwrite(fd, b, pos)
+        self.patches = []
+
+    def flush(self):
+        self.apply_patches()
+        self.file.flush()
+
+    def close(self):
+        self.apply_patches()
+        self.file.close()
 
 class Patcher(object):
-    def __init__(self, log_file, width):
+    def __init__(self, log_file, width, fill='?'):
         self.log_file = log_file
         self.width = width
 
         self.pos = self.log_file.tell()
-        self.log_file.write('?' * self.width)
+        self.log_file.write(fill * self.width)
 
+    # s must be no more than width bytes, once encoded as UTF-8.
     def patch(self, s):
-        self.log_file.seek(self.pos, os.SEEK_SET)
-        self.log_file.write(s)
-        self.log_file.write(' ' * (self.width - len(s)))
-        self.log_file.seek(0, os.SEEK_END)
+        self.log_file.patch(self.pos, s + ' ' * (self.width - len(s.encode('utf-8'))))
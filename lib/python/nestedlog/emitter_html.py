@@ -3,21 +3,50 @@
 
 import html
 import nestedlog.data as nld
+import nestedlog.digest as nldigest
 import nestedlog.emitter_base as nlebase
+import nestedlog.index as nlindex
 
 _stream_class = {
     nld.STREAM_STDERR: 'stderr',
     nld.STREAM_STDOUT: 'stdout',
 }
 
+# Must match the .block-status-* rules in the stylesheet below.
+_status_style = {
+    nld.STATUS_OK: 'color: #4f4; border-color: #333;',
+    nld.STATUS_WARNING: 'color: #ff0; border-color: #dd0;',
+    nld.STATUS_ERROR: 'color: #f00; border-color: #f00;',
+}
+
+def _digest_html(text):
+    return f'<div class="digest"><pre>{html.escape(text)}</pre></div>'
+
+# If time_gutter is set, each line of output is prefixed with the time it
+# arrived.
+#
+# If digest_size is set, that many bytes are reserved at the top of the log,
+# and the failure digest is patched into them at the end. If the log can't be
+# patched, the digest is written at the end of the log instead.
 class _EmitterHTML(object):
-    def __init__(self, log_file_name):
+    def __init__(self, log_file_name, index=False, time_gutter=False, digest_size=0):
         self.log_file_name = log_file_name
+        self.gen_index = index
+        self.time_gutter = time_gutter
+        self.wants_time = time_gutter
+        self.digest_size = digest_size
 
     def emit_start_log(self):
         self.first_block = True
         self.blocks = []
-        self.log_file = open(self.log_file_name, 'wt')
+        if self.time_gutter:
+            self.gutter = nlebase.TimeGutter()
+            self.last_nl = True
+        self.log_file = nlebase.LogFile(self.log_file_name)
+        if self.gen_index:
+            self.index = nlindex.Writer(self.log_file_name)
+        else:
+            self.index = None
         self.log_file.write('''\
 <html><head><style>
 body {
@@ -68,11 +97,31 @@ pre {
 .stream-stderr {
     color: #ff0;
 }
+.time-gutter {
+    color: #888;
+}
+.digest {
+    border-left: 0.5em solid #888;
+    padding-left: 0.5em;
+    margin-bottom: 1em;
+}
 </style></head><body class="base-colors"><div class="base-colors"><samp>''')
+        if self.digest_size and self.log_file.patchable:
+            self.digest_patcher = nlebase.Patcher(self.log_file, self.digest_size, ' ')
+        else:
+            self.digest_patcher = None
+
+    def emit_digest(self, hits, dropped):
+        if self.digest_patcher:
+            self.digest_patcher.patch(nldigest.format_fitted(hits, dropped, self.digest_size, _digest_html))
+        else:
+            self.log_file.write(_digest_html(nldigest.format_text(hits, dropped)))
 
     def emit_end_log(self):
         self.log_file.write('</samp></div></body></html>')
         self.log_file.close()
+        if self.index:
+            self.index.close()
 
     def _emit_pad(self):
         self.log_file.write('<div class="pad">&nbsp;</div>')
@@ -82,29 +131,55 @@ pre {
             self.first_block = False
         else:
             self._emit_pad()
+        if self.index:
+            self.index.start_block(block_id, block_name, self.log_file.tell())
         block_name_html = html.escape(block_name)
-        self.log_file.write('<div class="block block-status-')
-        patcher_class = nlebase.Patcher(self.log_file, nld.status_max_len)
-        self.log_file.write(f'"><div class="block-header">&nbsp;{block_name_html} (')
-        patcher_text = nlebase.Patcher(self.log_file, nld.status_max_len + 1)
+        if self.log_file.patchable:
+            self.log_file.write('<div class="block block-status-')
+            patcher_class = nlebase.Patcher(self.log_file, nld.status_max_len)
+            self.log_file.write(f'"><div class="block-header">&nbsp;{block_name_html} (')
+            patcher_text = nlebase.Patcher(self.log_file, nld.status_max_len + 1)
+        else:
+            # The status is applied by a stylesheet written at the end of the
+            # block instead; see _emit_status_style().
+            self.log_file.write(f'<div class="block" id="block-{block_id}"><div class="block-header">&nbsp;{block_name_html}')
+            patcher_class = None
+            patcher_text = None
         self.log_file.write('</div><div class="block-content">')
-        block_context = {'patcher_class': patcher_class, 'patcher_text': patcher_text}
+        block_context = {'id': block_id, 'patcher_class': patcher_class, 'patcher_text': patcher_text}
         self.blocks.append(block_context)
 
-    def emit_end_block(self, status):
+    def emit_end_block(self, status, stats):
         block_context = self.blocks.pop()
         status_class = nld.status_to_text[status]
         status_text = status_class.capitalize()
+        footer_text = status_text
+        stats_text = nld.format_block_stats(stats)
+        if stats_text:
+            footer_text += ', ' + stats_text
         self._emit_pad()
-        self.log_file.write(f'</div><div class="block-footer">&nbsp;({status_text})</div></div>')
-        block_context['patcher_class'].patch(status_class)
-        block_context['patcher_text'].patch(status_text + ')')
+        self.log_file.write(f'</div><div class="block-footer">&nbsp;({footer_text})</div></div>')
+        if block_context['patcher_class']:
+            block_context['patcher_class'].patch(status_class)
+            block_context['patcher_text'].patch(status_text + ')')
+        else:
+            self._emit_status_style(block_context['id'], status, status_text)
+        if self.index:
+            self.index.end_block(status, self.log_file.tell(), stats)
+
+    def _emit_status_style(self, block_id, status, status_text):
+        block = f'#block-{block_id}'
+        self.log_file.write(
+            f'<style>{block} {{ {_status_style[status]} }} ' +
+            f'{block} > .block-header::after {{ content: " ({status_text})"; }}</style>')
 
     def emit_start_stream(self, stream, switching):
         stream_class = _stream_class[stream]
         if not switching:
             self._emit_pad()
             self.log_file.write('<pre>')
+            if self.time_gutter:
+                self.last_nl = True
         self.log_file.write(f'<span class="stream-{stream_class}">')
 
     def emit_end_stream(self, switching):
@@ -112,7 +187,15 @@ pre {
         if not switching:
             self.log_file.write('</pre>')
 
-    def emit_stream_data(self, data):
-        self.log_file.write(html.escape(data))
+    def emit_stream_data(self, chunk):
+        if not self.time_gutter:
+            self.log_file.write(chunk.html)
+            return
+        stamp = f'<span class="time-gutter">{self.gutter.format(chunk.time)}</span>'
+        text = stamp.join(chunk.html.splitlines(True))
+        if self.last_nl:
+            text = stamp + text
+        self.log_file.write(text)
+        self.last_nl = chunk.text[-1] == '\n'
 
 Emitter = _EmitterHTML
@@ -0,0 +1,353 @@
+# Copyright 2021 Stephen Warren <swarren@wwwdotorg.org>
+# SPDX-License-Identifier: MIT
+
+import json
+import nestedlog.data as nld
+import nestedlog.digest as nldigest
+import os
+import re
+
+# Writes a log as a directory, for logs that are too large for a browser to
+# open as a single document:
+#
+#   index.html: The failure digest, if any, then the block tree, with each
+#       block's name, status, footer, parent ID, and child IDs, so the whole
+#       tree is known without loading any shards.
+#   shards/<id>-<part>.js: The content of each block; its output, and the
+#       position of its child blocks within that output. A block's content is
+#       split into parts of at most part_size characters.
+#
+# While the log is being written, index.html is rewritten whenever a
+# top-level block ends, and when a shard part fills up, so that a log in
+# progress can be viewed; blocks that haven't ended are shown as running, and
+# only their complete parts are loaded. To keep the cost linear, the index is
+# only rewritten for a filled part once at least as much output as the size of
+# the index has been written since it was last rewritten.
+#
+# Shards left in the directory by an earlier log are deleted when the log
+# starts. Shards are loaded by the browser as they are, so they can't be
+# compressed; nor is there a time gutter.
+# Blocks are collapsed by default, and their content is only loaded when they
+# are expanded; failed blocks are expanded automatically. Shards are loaded
+# using <script> elements rather than XMLHttpRequest, so that the log can be
+# viewed from a file:// URL without a web server. Each shard contains a call:
+#
+#   nlShard(block_id, part, [item, ...]);
+#
+# where each item is ["o", text] (stdout), ["e", text] (stderr), or
+# ["b", block_id] (a child block).
+
+_shard_file_name_re = re.compile(r'[0-9]+-[0-9]+\.js')
+
+_stream_item = {
+    nld.STREAM_STDOUT: 'o',
+    nld.STREAM_STDERR: 'e',
+}
+
+class _EmitterHTMLChunked(object):
+    def __init__(self, log_dir_name, part_size=1024 * 1024):
+        self.log_dir_name = log_dir_name
+        self.part_size = part_size
+        # Output is buffered and written as items of about this size.
+        self.item_size = part_size // 16
+
+    def emit_start_log(self):
+        self.shard_dir_name = os.path.join(self.log_dir_name, 'shards')
+        os.makedirs(self.shard_dir_name, exist_ok=True)
+        self.blocks = []
+        self.block_info = {}
+        self.root_ids = []
+        self.digest = None
+        self.index_size = 0
+        self.output_since_index = 0
+        # Replace any earlier index before deleting the shards it refers to.
+        self._write_index(_in_progress_html)
+        for file_name in os.listdir(self.shard_dir_name):
+            if _shard_file_name_re.fullmatch(file_name):
+                os.unlink(os.path.join(self.shard_dir_name, file_name))
+
+    def emit_digest(self, hits, dropped):
+        self.digest = nldigest.format_text(hits, dropped)
+
+    def emit_end_log(self):
+        self._write_tree_index()
+
+    def _write_tree_index(self):
+        blocks = dict(self.block_info)
+        for block_context in self.blocks:
+            parts = block_context['parts']
+            if block_context['shard_file'] is not None:
+                parts -= 1
+            blocks[block_context['id']] = {
+                'name': block_context['name'],
+                'status': 'running',
+                'footer': 'Running',
+                'parts': parts,
+                'parent': block_context['parent'],
+                'children': block_context['children'],
+            }
+        log = {'root': self.root_ids, 'blocks': blocks, 'digest': self.digest}
+        # Inline <script> content must not contain "</".
+        log_json = json.dumps(log, separators=(',', ':')).replace('</', '<\\/')
+        self._write_index(_index_html_head + log_json + _index_html_tail)
+        self.index_size = len(log_json)
+        self.output_since_index = 0
+
+    def _write_index(self, content):
+        # Write a complete new file, so that a browser never sees a partial
+        # index.
+        index_file_name = os.path.join(self.log_dir_name, 'index.html')
+        tmp_file_name = index_file_name + '.tmp'
+        with open(tmp_file_name, 'wt', encoding='utf-8') as f:
+            f.write(content)
+        os.rename(tmp_file_name, index_file_name)
+
+    def emit_start_block(self, block_id, block_name):
+        if self.blocks:
+            self._add_item(['b', block_id])
+            self.blocks[-1]['children'].append(block_id)
+            parent_id = self.blocks[-1]['id']
+        else:
+            self.root_ids.append(block_id)
+            parent_id = None
+        block_context = {
+            'id': block_id,
+            'name': block_name,
+            'parent': parent_id,
+            'children': [],
+            'shard_file': None,
+            'parts': 0,
+            'part_left': 0,
+            'stream': None,
+            'data': [],
+            'data_size': 0,
+        }
+        self.blocks.append(block_context)
+
+    def emit_end_block(self, status, stats):
+        block_context = self.blocks.pop()
+        self._close_shard(block_context)
+        footer_text = nld.status_to_text[status].capitalize()
+        stats_text = nld.format_block_stats(stats)
+        if stats_text:
+            footer_text += ', ' + stats_text
+        self.block_info[block_context['id']] = {
+            'name': block_context['name'],
+            'status': nld.status_to_text[status],
+            'footer': footer_text,
+            'parts': block_context['parts'],
+            'parent': block_context['parent'],
+            'children': block_context['children'],
+        }
+        if not self.blocks:
+            self._write_tree_index()
+
+    def emit_start_stream(self, stream, switching):
+        self.blocks[-1]['stream'] = _stream_item[stream]
+
+    def emit_end_stream(self, switching):
+        self._flush_data(self.blocks[-1])
+
+    def emit_stream_data(self, chunk):
+        block_context = self.blocks[-1]
+        block_context['data'].append(chunk.text)
+        block_context['data_size'] += len(chunk.text)
+        if block_context['data_size'] >= self.item_size:
+            self._flush_data(block_context)
+
+    def _flush_data(self, block_context):
+        if block_context['data']:
+            item = [block_context['stream'], ''.join(block_context['data'])]
+            block_context['data'] = []
+            block_context['data_size'] = 0
+            self._write_item(block_context, item)
+
+    def _add_item(self, item):
+        block_context = self.blocks[-1]
+        self._flush_data(block_context)
+        self._write_item(block_context, item)
+
+    def _write_item(self, block_context, item):
+        if block_context['shard_file'] is None or block_context['part_left'] <= 0:
+            part_filled = block_context['shard_file'] is not None
+            self._close_shard(block_context)
+            part = block_context['parts']
+            shard_file_name = os.path.join(self.shard_dir_name, f'{block_context["id"]}-{part}.js')
+            block_context['shard_file'] = open(shard_file_name, 'wt', encoding='utf-8', buffering=256 * 1024)
+            block_context['shard_file'].write(f'nlShard({block_context["id"]},{part},[\n')
+            block_context['parts'] += 1
+            block_context['part_left'] = self.part_size
+            if part_filled and self.output_since_index >= self.index_size:
+                self._write_tree_index()
+        block_context['shard_file'].write(json.dumps(item) + ',\n')
+        if item[0] != 'b':
+            block_context['part_left'] -= len(item[1])
+            self.output_since_index += len(item[1])
+
+    def _close_shard(self, block_context):
+        self._flush_data(block_context)
+        if block_context['shard_file'] is not None:
+            block_context['shard_file'].write(']);\n')
+            block_context['shard_file'].close()
+            block_context['shard_file'] = None
+
+_in_progress_html = '''\
+<html><head><meta charset="utf-8"></head><body>Log in progress...</body></html>
+'''
+
+_index_html_head = '''\
+<html><head><meta charset="utf-8"><style>
+body {
+    margin: 0;
+    border: 0;
+    padding: 1em;
+    background-color: black;
+    color: #fff;
+}
+pre {
+    margin: 0;
+    border: 0;
+}
+.block {
+    border-left: 0.5em solid #333;
+    margin: 1em 0;
+}
+.block-header {
+    background-color: #333;
+    cursor: pointer;
+}
+.block-content {
+    border-left: 0.5em solid #000;
+}
+.block-footer {
+    background-color: #333;
+}
+.block-status-ok {
+    color: #4f4;
+    border-color: #333;
+}
+.block-status-warning {
+    color: #ff0;
+    border-color: #dd0;
+}
+.block-status-error {
+    color: #f00;
+    border-color: #f00;
+}
+.block-status-running {
+    color: #88f;
+    border-color: #333;
+}
+.stream-o {
+    color: #fff;
+}
+.stream-e {
+    color: #ff0;
+}
+.more {
+    color: #88f;
+    cursor: pointer;
+}
+.digest {
+    border-left: 0.5em solid #888;
+    padding-left: 0.5em;
+    margin-bottom: 1em;
+}
+</style></head><body><samp id="log"></samp><script>
+var nlLog = '''
+
+_index_html_tail = ''';
+var nlPending = {};
+
+function nlLoadPart(id, part, content) {
+    nlPending[id + "-" + part] = content;
+    var script = document.createElement("script");
+    script.src = "shards/" + id + "-" + part + ".js";
+    document.body.appendChild(script);
+}
+
+function nlShard(id, part, items) {
+    var key = id + "-" + part;
+    var content = nlPending[key];
+    delete nlPending[key];
+    var pre = null;
+    for (var i = 0; i < items.length; i++) {
+        var item = items[i];
+        if (item[0] == "b") {
+            pre = null;
+            content.appendChild(nlBlock(item[1]));
+            continue;
+        }
+        if (pre == null) {
+            pre = document.createElement("pre");
+            content.appendChild(pre);
+        }
+        var span = document.createElement("span");
+        span.className = "stream-" + item[0];
+        span.textContent = item[1];
+        pre.appendChild(span);
+    }
+    if (part + 1 < nlLog.blocks[id].parts) {
+        var more = document.createElement("div");
+        more.className = "more";
+        more.textContent = "[Load more]";
+        more.onclick = function() {
+            content.removeChild(more);
+            nlLoadPart(id, part + 1, content);
+        };
+        content.appendChild(more);
+    }
+}
+
+function nlToggle(id, block) {
+    var content = block.children[1];
+    if (!content.loaded) {
+        content.loaded = true;
+        if (nlLog.blocks[id].parts) {
+            nlLoadPart(id, 0, content);
+        }
+    }
+    content.style.display = content.style.display == "none" ? "" : "none";
+}
+
+function nlBlock(id) {
+    var info = nlLog.blocks[id];
+    var block = document.createElement("div");
+    block.className = "block block-status-" + info.status;
+    var header = document.createElement("div");
+    header.className = "block-header";
+    header.textContent = "\\u00a0" + info.name + " (" + info.status.charAt(0).toUpperCase() + info.status.slice(1) + ")";
+    header.onclick = function() { nlToggle(id, block); };
+    var content = document.createElement("div");
+    content.className = "block-content";
+    content.style.display = "none";
+    var footer = document.createElement("div");
+    footer.className = "block-footer";
+    footer.textContent = "\\u00a0(" + info.footer + ")";
+    block.appendChild(header);
+    block.appendChild(content);
+    block.appendChild(footer);
+    if (info.status == "error") {
+        nlToggle(id, block);
+    }
+    return block;
+}
+
+var log = document.getElementById("log");
+if (nlLog.digest) {
+    var digest = document.createElement("pre");
+    digest.className = "digest";
+    digest.textContent = nlLog.digest;
+    log.appendChild(digest);
+}
+for (var i = 0; i < nlLog.root.length; i++) {
+    var block = nlBlock(nlLog.root[i]);
+    log.appendChild(block);
+    if (block.children[1].style.display == "none") {
+        nlToggle(nlLog.root[i], block);
+    }
+}
+</script></body></html>
+'''
+
+Emitter = _EmitterHTMLChunked
@@ -3,7 +3,9 @@
 
 import html
 import nestedlog.data as nld
+import nestedlog.digest as nldigest
 import nestedlog.emitter_base as nlebase
+import nestedlog.index as nlindex
 
 _status_to_color = {
     nld.STATUS_OK: '4f4',
@@ -17,23 +19,58 @@ _status_to_border_color = {
     nld.STATUS_ERROR: 'f00',
 }
 
+def _digest_html(text):
+    return (
+        '<div style="border-left:0.5em solid #888;padding-left:0.5em;margin-bottom:1em">' +
+        f'<pre style="margin:0;border:0">{html.escape(text)}</pre></div>'
+    )
+
+# If time_gutter is set, each line of output is prefixed with the time it
+# arrived.
+#
+# If digest_size is set, that many bytes are reserved at the top of the log,
+# and the failure digest is patched into them at the end. If the log can't be
+# patched, the digest is written at the end of the log instead.
 class _EmitterHTML(object):
-    def __init__(self, log_file_name):
+    def __init__(self, log_file_name, index=False, time_gutter=False, digest_size=0):
         self.log_file_name = log_file_name
+        self.gen_index = index
+        self.time_gutter = time_gutter
+        self.wants_time = time_gutter
+        self.digest_size = digest_size
 
     def emit_start_log(self):
         self.first_block = True
         self.blocks = []
-        self.log_file = open(self.log_file_name, 'wt')
+        if self.time_gutter:
+            self.gutter = nlebase.TimeGutter()
+            self.last_nl = True
+        self.log_file = nlebase.LogFile(self.log_file_name)
+        if self.gen_index:
+            self.index = nlindex.Writer(self.log_file_name)
+        else:
+            self.index = None
         self.log_file.write(
             '<html><head></head>' +
             '<body style="margin:0;border:0;padding:1em;background-color:black;color:#fff">' +
             '<div style="background-color:black;color:#fff"><samp>'
        )
+        if self.digest_size and self.log_file.patchable:
+            self.digest_patcher = nlebase.Patcher(self.log_file, self.digest_size, ' ')
+        else:
+            self.digest_patcher = None
+
+    def emit_digest(self, hits, dropped):
+        if self.digest_patcher:
+            self.digest_patcher.patch(nldigest.format_fitted(hits, dropped, self.digest_size, _digest_html))
+        else:
+            self.log_file.write(_digest_html(nldigest.format_text(hits, dropped)))
 
     def emit_end_log(self):
         self.log_file.write('</samp></div></body></html>')
         self.log_file.close()
+        if self.index:
+            self.index.close()
 
     def _emit_pad(self):
         self.log_file.write('<div>&nbsp;</div>\n')
@@ -43,14 +80,25 @@ class _EmitterHTML(object):
             self.first_block = False
         else:
             self._emit_pad()
+        if self.index:
+            self.index.start_block(block_id, block_name, self.log_file.tell())
         block_name_html = html.escape(block_name)
-        self.log_file.write('<div style="border-left:0.5em solid #')
-        patcher_lborder_color = nlebase.Patcher(self.log_file, 3)
-        self.log_file.write('">')
-        self.log_file.write('<div style="background-color:#333;color:#')
-        patcher_header_text_color = nlebase.Patcher(self.log_file, 3)
-        self.log_file.write(f'">&nbsp;{block_name_html} (')
-        patcher_header_text = nlebase.Patcher(self.log_file, nld.status_max_len + 1)
+        if self.log_file.patchable:
+            self.log_file.write('<div style="border-left:0.5em solid #')
+            patcher_lborder_color = nlebase.Patcher(self.log_file, 3)
+            self.log_file.write('">')
+            self.log_file.write('<div style="background-color:#333;color:#')
+            patcher_header_text_color = nlebase.Patcher(self.log_file, 3)
+            self.log_file.write(f'">&nbsp;{block_name_html} (')
+            patcher_header_text = nlebase.Patcher(self.log_file, nld.status_max_len + 1)
+        else:
+            # Inline styles can't be changed after the fact, so the status is
+            # only shown in the footer.
+            self.log_file.write('<div style="border-left:0.5em solid #333">')
+            self.log_file.write(f'<div style="background-color:#333;color:#fff">&nbsp;{block_name_html}')
+            patcher_lborder_color = None
+            patcher_header_text_color = None
+            patcher_header_text = None
         self.log_file.write('</div>')
         self.log_file.write('<div style="border-left:0.5em solid #000">\n')
         block_context = {
@@ -60,25 +108,34 @@ class _EmitterHTML(object):
         }
         self.blocks.append(block_context)
 
-    def emit_end_block(self, status):
+    def emit_end_block(self, status, stats):
         block_context = self.blocks.pop()
         header_text_color = _status_to_color[status]
         lborder_color = _status_to_border_color[status]
         if status == nld.STATUS_OK:
             lborder_color = '333'
         header_text = nld.status_to_text[status].capitalize()
+        footer_text = header_text
+        stats_text = nld.format_block_stats(stats)
+        if stats_text:
+            footer_text += ', ' + stats_text
         self._emit_pad()
         self.log_file.write('</div>')
-        self.log_file.write(f'<div style="background-color:#333;color:#{header_text_color}">&nbsp;({header_text})</div>')
+        self.log_file.write(f'<div style="background-color:#333;color:#{header_text_color}">&nbsp;({footer_text})</div>')
         self.log_file.write('</div>\n')
-        block_context['patcher_lborder_color'].patch(lborder_color)
-        block_context['patcher_header_text_color'].patch(header_text_color)
-        block_context['patcher_header_text'].patch(header_text + ')')
+        if block_context['patcher_lborder_color']:
+            block_context['patcher_lborder_color'].patch(lborder_color)
+            block_context['patcher_header_text_color'].patch(header_text_color)
+            block_context['patcher_header_text'].patch(header_text + ')')
+        if self.index:
+            self.index.end_block(status, self.log_file.tell(), stats)
 
     def emit_start_stream(self, stream, switching):
         if not switching:
             self._emit_pad()
             self.log_file.write('<pre style="margin:0;border:0">')
+            if self.time_gutter:
+                self.last_nl = True
         self.log_file.write('<span')
         if stream == nld.STREAM_STDERR:
             self.log_file.write(' style="color:#ff0"')
@@ -89,7 +146,15 @@ class _EmitterHTML(object):
         if not switching:
             self.log_file.write('</pre>')
 
-    def emit_stream_data(self, data):
-        self.log_file.write(html.escape(data))
+    def emit_stream_data(self, chunk):
+        if not self.time_gutter:
+            self.log_file.write(chunk.html)
+            return
+        stamp = f'<span style="color:#888">{self.gutter.format(chunk.time)}</span>'
+        text = stamp.join(chunk.html.splitlines(True))
+        if self.last_nl:
+            text = stamp + text
+        self.log_file.write(text)
+        self.last_nl = chunk.text[-1] == '\n'
 
 Emitter = _EmitterHTML
@@ -0,0 +1,163 @@
+# Copyright 2021 Stephen Warren <swarren@wwwdotorg.org>
+# SPDX-License-Identifier: MIT
+
+import json
+import nestedlog.data as nld
+import nestedlog.emitter_base as nlebase
+import nestedlog.index as nlindex
+import threading
+import time
+
+# Writes the log as JSON Lines, for consumption by other tools. The file is
+# only ever appended to, and each record is flushed to it within max_age
+# seconds, so it may be read (e.g. tailed) while it's being written. Each
+# line is an object with these keys:
+#
+#   type: "start_log", "end_log", "start_block", "end_block", "data", or
+#       "digest".
+#   time: time.time() when the event occurred; for data records, when the
+#       first of the data was received.
+#
+# Block and data records also contain:
+#
+#   block_id: ID of the block, or for data, the block containing the data.
+#   parent_id: ID of the enclosing block, or null.
+#   depth: nesting depth; top-level blocks have depth 0.
+#
+# and:
+#
+#   start_block: name: block name.
+#   end_block: status: block status text, plus the block's stats; see
+#       nestedlog.rusage.
+#   data: stream: "stdout" or "stderr", data: the text. Consecutive output on
+#       the same stream is combined into a single record of up to max_data
+#       characters, received over at most max_age seconds.
+#
+# The digest record, if any, is written just before end_log, and contains
+# hits and dropped; see nestedlog.digest.
+
+_stream_names = {
+    nld.STREAM_STDOUT: 'stdout',
+    nld.STREAM_STDERR: 'stderr',
+}
+
+class _EmitterJSONL(object):
+    wants_time = True
+
+    def __init__(self, log_file_name, index=False, max_data=64 * 1024, max_age=0.1):
+        self.log_file_name = log_file_name
+        self.gen_index = index
+        self.max_data = max_data
+        self.max_age = max_age
+
+    def _write(self, record):
+        self.log_file.write(json.dumps(record, separators=(',', ':')) + '\n')
+        self.unflushed = True
+
+    # Runs on a separate thread, so that records are written out even while
+    # the command is quiet.
+    def _flusher(self):
+        while not self.done.wait(self.max_age):
+            with self.lock:
+                if self.data and time.time() - self.data_time >= self.max_age:
+                    self._flush_data()
+                if self.unflushed:
+                    self.log_file.flush()
+                    self.unflushed = False
+
+    def _block_record(self, record_type, block_context):
+        return {
+            'type': record_type,
+            'time': time.time(),
+            'block_id': block_context['id'],
+            'parent_id': block_context['parent_id'],
+            'depth': len(self.blocks) - 1,
+        }
+
+    def emit_start_log(self):
+        self.blocks = []
+        self.stream = None
+        self.data = []
+        self.data_size = 0
+        self.data_time = None
+        self.log_file = nlebase.LogFile(self.log_file_name)
+        if self.gen_index:
+            self.index = nlindex.Writer(self.log_file_name)
+        else:
+            self.index = None
+        self._write({'type': 'start_log', 'time': time.time()})
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+        self.flusher = threading.Thread(target=self._flusher, name='nestedlog-jsonl', daemon=True)
+        self.flusher.start()
+
+    def emit_digest(self, hits, dropped):
+        with self.lock:
+            self._write({'type': 'digest', 'time': time.time(), 'hits': hits, 'dropped': dropped})
+
+    def emit_end_log(self):
+        self.done.set()
+        self.flusher.join()
+        self._write({'type': 'end_log', 'time': time.time()})
+        self.log_file.close()
+        if self.index:
+            self.index.close()
+
+    def emit_start_block(self, block_id, block_name):
+        with self.lock:
+            self._start_block(block_id, block_name)
+
+    def _start_block(self, block_id, block_name):
+        if self.blocks:
+            parent_id = self.blocks[-1]['id']
+        else:
+            parent_id = None
+        block_context = {'id': block_id, 'parent_id': parent_id}
+        self.blocks.append(block_context)
+        if self.index:
+            self.index.start_block(block_id, block_name, self.log_file.tell())
+        record = self._block_record('start_block', block_context)
+        record['name'] = block_name
+        self._write(record)
+
+    def emit_end_block(self, status, stats):
+        with self.lock:
+            self._end_block(status, stats)
+
+    def _end_block(self, status, stats):
+        record = self._block_record('end_block', self.blocks[-1])
+        record['status'] = nld.status_to_text[status]
+        record.update(stats)
+        self._write(record)
+        self.blocks.pop()
+        if self.index:
+            self.index.end_block(status, self.log_file.tell(), stats)
+
+    def emit_start_stream(self, stream, switching):
+        self.stream = _stream_names[stream]
+
+    def emit_end_stream(self, switching):
+        with self.lock:
+            self._flush_data()
+
+    def emit_stream_data(self, chunk):
+        with self.lock:
+            if not self.data:
+                self.data_time = chunk.time or time.time()
+            self.data.append(chunk.text)
+            self.data_size += len(chunk.text)
+            if self.data_size >= self.max_data:
+                self._flush_data()
+
+    def _flush_data(self):
+        if not self.data:
+            return
+        record = self._block_record('data', self.blocks[-1])
+        record['time'] = self.data_time
+        record['stream'] = self.stream
+        record['data'] = ''.join(self.data)
+        self._write(record)
+        self.data = []
+        self.data_size = 0
+
+Emitter = _EmitterJSONL
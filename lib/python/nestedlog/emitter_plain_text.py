@@ -2,41 +2,95 @@
 # SPDX-License-Identifier: MIT
 
 import nestedlog.data as nld
+import nestedlog.digest as nldigest
 import nestedlog.emitter_base as nlebase
+import nestedlog.index as nlindex
 
+# If time_gutter is set, each line of output is prefixed with the time it
+# arrived; other lines are indented to match.
+#
+# If digest_size is set, that many bytes are reserved at the top of the log,
+# and the failure digest is patched into them at the end. If the log can't be
+# patched, the digest is written at the end of the log instead.
 class _Emitter_Plain_Text(object):
-    def __init__(self, log_file_name):
+    def __init__(self, log_file_name, index=False, time_gutter=False, digest_size=0):
         self.log_file_name = log_file_name
+        self.gen_index = index
+        self.time_gutter = time_gutter
+        self.wants_time = time_gutter
+        self.digest_size = digest_size
 
     def emit_start_log(self):
         self.blocks = []
-        self.log_file = open(self.log_file_name, 'wt')
+        if self.time_gutter:
+            self.gutter = nlebase.TimeGutter()
+            self.gutter_pad = ' ' * nlebase.TimeGutter.width
+        else:
+            self.gutter_pad = ''
+        self.log_file = nlebase.LogFile(self.log_file_name)
+        if self.gen_index:
+            self.index = nlindex.Writer(self.log_file_name)
+        else:
+            self.index = None
+        if self.digest_size and self.log_file.patchable:
+            self.digest_patcher = nlebase.Patcher(self.log_file, self.digest_size, ' ')
+            self.log_file.write('\n')
+        else:
+            self.digest_patcher = None
+
+    def emit_digest(self, hits, dropped):
+        if self.digest_patcher:
+            self.digest_patcher.patch(nldigest.format_fitted(hits, dropped, self.digest_size))
+        else:
+            self.log_file.write('\n' + nldigest.format_text(hits, dropped))
 
     def emit_end_log(self):
         self.log_file.close()
+        if self.index:
+            self.index.close()
 
     def emit_start_block(self, block_id, block_name):
         if len(self.blocks):
+            self.log_file.write(self.gutter_pad)
             self.log_file.write('| ' * len(self.blocks))
             self.log_file.write('\n')
+        if self.index:
+            self.index.start_block(block_id, block_name, self.log_file.tell())
+        self.log_file.write(self.gutter_pad)
         self.log_file.write('| ' * len(self.blocks))
-        self.log_file.write(f'/-- {block_name} (')
-        patcher = nlebase.Patcher(self.log_file, nld.status_max_len + 1)
+        # When the status can't be patched in later, it's only shown in the
+        # footer.
+        if self.log_file.patchable:
+            self.log_file.write(f'/-- {block_name} (')
+            patcher = nlebase.Patcher(self.log_file, nld.status_max_len + 1)
+        else:
+            self.log_file.write(f'/-- {block_name}')
+            patcher = None
         self.log_file.write('\n')
-        block_context = {'last_nl': True, 'patcher': patcher}
+        block_context = {'last_nl': True, 'patcher': patcher, 'prefix': '| ' * (len(self.blocks) + 1)}
         self.blocks.append(block_context)
 
-    def emit_end_block(self, status):
+    def emit_end_block(self, status, stats):
         block_context = self.blocks.pop()
+        self.log_file.write(self.gutter_pad)
         self.log_file.write('| ' * (len(self.blocks) + 1))
         self.log_file.write('\n')
         status_text = nld.status_to_text[status].capitalize()
+        footer_text = status_text
+        stats_text = nld.format_block_stats(stats)
+        if stats_text:
+            footer_text += ', ' + stats_text
+        self.log_file.write(self.gutter_pad)
         self.log_file.write('| ' * len(self.blocks))
-        self.log_file.write(f'\\-- ({status_text})\n')
-        block_context['patcher'].patch(status_text + ')')
+        self.log_file.write(f'\\-- ({footer_text})\n')
+        if block_context['patcher']:
+            block_context['patcher'].patch(status_text + ')')
+        if self.index:
+            self.index.end_block(status, self.log_file.tell(), stats)
 
     def emit_start_stream(self, stream, switching):
         if not switching:
+            self.log_file.write(self.gutter_pad)
             self.log_file.write('| ' * len(self.blocks))
             self.log_file.write('\n')
 
@@ -44,14 +98,16 @@ class _Emitter_Plain_Text(object):
         if not switching and not self.blocks[-1]['last_nl']:
             self.log_file.write('\n')
 
-    def emit_stream_data(self, data):
-        last_nl = self.blocks[-1]['last_nl']
-        lines = data.splitlines(True)
-        for line in lines:
-            if last_nl:
-                self.log_file.write('| ' * len(self.blocks))
-            last_nl = True
-            self.log_file.write(line)
-        self.blocks[-1]['last_nl'] = data[-1] == '\n'
+    def emit_stream_data(self, chunk):
+        block_context = self.blocks[-1]
+        # Every line except the first starts a new line, so gets the prefix.
+        prefix = block_context['prefix']
+        if self.time_gutter:
+            prefix = self.gutter.format(chunk.time) + prefix
+        text = prefix.join(chunk.lines)
+        if block_context['last_nl']:
+            text = prefix + text
+        self.log_file.write(text)
+        block_context['last_nl'] = chunk.text[-1] == '\n'
 
 Emitter = _Emitter_Plain_Text
@@ -0,0 +1,430 @@
+# Copyright 2021 Stephen Warren <swarren@wwwdotorg.org>
+# SPDX-License-Identifier: MIT
+
+import collections
+import http.server
+import json
+import nestedlog.data as nld
+import nestedlog.digest as nldigest
+import os
+import queue
+import socketserver
+import stat
+import threading
+import time
+
+# Serves a live view of the log over HTTP while it is being generated. The
+# server listens on a Unix socket, or if address is a port number, on that
+# port on localhost:
+#
+#   /: A page that renders the block tree as it is generated.
+#   /events: The log's events, as a stream of server-sent events.
+#
+# Each event is a JSON array:
+#   ["reset"]: Sent at the start of each connection.
+#   ["start_block", block_id, block_name]
+#   ["end_block", status, footer_text]
+#   ["start_stream", "o" or "e", switching]
+#   ["end_stream", switching]
+#   ["data", text]
+#   ["omitted"]: Some earlier output is not included in the stream.
+#   ["digest", text]: The failure digest, shown at the top of the page.
+#   ["end_log"]
+#
+# Emitter methods never wait for viewers. Each viewer has a bounded queue of
+# events; a viewer that falls so far behind that its queue fills is
+# disconnected, and (being an EventSource) reconnects and starts over.
+#
+# A viewer that connects part way through the log is sent the block
+# structure so far, but only the most recent history_size characters of
+# output. The history is limited to about max_history_events events; beyond
+# that, the oldest completed blocks are left out of it. So that a block that
+# stays open can't grow the history without bound either, it holds at most a
+# quarter that many output events; older output is dropped, as when there's
+# more than history_size characters of it.
+
+_stream_item = {
+    nld.STREAM_STDOUT: 'o',
+    nld.STREAM_STDERR: 'e',
+}
+
+def _encode_event(event):
+    if event[0] == 'end_block':
+        status, stats = event[1:]
+        footer_text = nld.status_to_text[status].capitalize()
+        stats_text = nld.format_block_stats(stats)
+        if stats_text:
+            footer_text += ', ' + stats_text
+        event = ('end_block', nld.status_to_text[status], footer_text)
+    return b'data: ' + json.dumps(event).encode('utf-8') + b'\n\n'
+
+# Removes output that was dropped from history, along with any streams, or
+# spans of a stream between switches to the other stream, left empty as a
+# result; then, if more than max_events events remain, removes the
+# oldest completed blocks until no more than half that remain. Returns the new
+# history, and whether any blocks were removed.
+def _compact_history(history, max_events):
+    events = []
+    stream_start = None
+    stream_data = False
+    span_start = None
+    span_data = False
+    for event in history:
+        if event[0] == 'data':
+            if event[1] is None:
+                continue
+            stream_data = True
+            span_data = True
+        elif event[0] == 'start_stream':
+            span_start = len(events)
+            span_data = False
+            if not event[2]:
+                stream_start = len(events)
+                stream_data = False
+        elif event[0] == 'end_stream':
+            if not event[1]:
+                if not stream_data:
+                    del events[stream_start:]
+                    continue
+            elif not span_data and events[span_start][2]:
+                del events[span_start:]
+                continue
+        events.append(event)
+    if len(events) <= max_events:
+        return events, False
+
+    excess = len(events) - max_events // 2
+    removed = 0
+    out = []
+    block_starts = []
+    for event in events:
+        out.append(event)
+        if event[0] == 'start_block':
+            block_starts.append(len(out) - 1)
+        elif event[0] == 'end_block':
+            start = block_starts.pop()
+            if removed < excess:
+                removed += len(out) - start
+                del out[start:]
+    return out, removed > 0
+
+class _Client(object):
+    def __init__(self, queue_size):
+        self.queue = queue.Queue(queue_size)
+        self.dropped = False
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        emitter = self.server.emitter
+        if self.path == '/':
+            body = _page_html.encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        if self.path != '/events':
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        client, history = emitter._attach()
+        try:
+            self.wfile.write(b''.join(map(_encode_event, history)))
+            self.wfile.flush()
+            while True:
+                events = [client.queue.get()]
+                # Send everything that's queued up in one go.
+                while True:
+                    try:
+                        events.append(client.queue.get_nowait())
+                    except queue.Empty:
+                        break
+                if client.dropped:
+                    break
+                self.wfile.write(b''.join(map(_encode_event, events)))
+                self.wfile.flush()
+                if events[-1][0] == 'end_log':
+                    break
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            emitter._detach(client)
+
+class _TCPServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+class _EmitterSSE(object):
+    def __init__(self, address, queue_size=4096, history_size=256 * 1024, max_history_events=64 * 1024):
+        self.address = address
+        self.queue_size = queue_size
+        self.history_size = history_size
+        self.max_history_events = max_history_events
+        self.max_history_data = max_history_events // 4
+
+    def emit_start_log(self):
+        self.lock = threading.Lock()
+        self.clients = []
+        # The events sent to newly connected viewers. Output events are
+        # lists, so that their data can be set to None when it is dropped
+        # from the history; such events are removed from time to time, by
+        # _compact_history().
+        self.history = []
+        self.history_data = collections.deque()
+        self.history_data_size = 0
+        self.history_dropped = 0
+        self.history_omitted = False
+        # The history is compacted when it grows past this, which is at least
+        # double its size after the last compaction, so that compaction takes
+        # amortized constant time per event.
+        self.compact_at = self.max_history_events
+        if self.address.isdigit():
+            self.server = _TCPServer(('127.0.0.1', int(self.address)), _Handler)
+            self.socket_path = None
+        else:
+            try:
+                if stat.S_ISSOCK(os.stat(self.address).st_mode):
+                    os.unlink(self.address)
+            except FileNotFoundError:
+                pass
+            self.server = _UnixServer(self.address, _Handler)
+            self.socket_path = self.address
+        self.server.emitter = self
+        self.thread = threading.Thread(target=self.server.serve_forever, args=(0.1,), name='nestedlog-sse', daemon=True)
+        self.thread.start()
+
+    def emit_end_log(self):
+        self._event(('end_log',))
+        # Give viewers a moment to receive the end of the log.
+        deadline = time.monotonic() + 1
+        while self.clients and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.server.shutdown()
+        self.server.server_close()
+        if self.socket_path:
+            os.unlink(self.socket_path)
+
+    def _attach(self):
+        client = _Client(self.queue_size)
+        with self.lock:
+            history = [('reset',)]
+            if self.history_omitted:
+                history.append(('omitted',))
+            # Copy output events, since their data may be dropped as soon as
+            # the lock is released.
+            history.extend(tuple(event) for event in self.history if event[0] != 'data' or event[1] is not None)
+            self.clients.append(client)
+        return client, history
+
+    def _detach(self, client):
+        with self.lock:
+            if client in self.clients:
+                self.clients.remove(client)
+
+    def _event(self, event, history_event=None):
+        with self.lock:
+            self.history.append(history_event or event)
+            if len(self.history) > self.compact_at:
+                self._compact_history()
+            for client in self.clients:
+                try:
+                    client.queue.put_nowait(event)
+                except queue.Full:
+                    client.dropped = True
+            if self.clients and any(client.dropped for client in self.clients):
+                self.clients = [client for client in self.clients if not client.dropped]
+
+    def emit_digest(self, hits, dropped):
+        self._event(('digest', nldigest.format_text(hits, dropped)))
+
+    def emit_start_block(self, block_id, block_name):
+        self._event(('start_block', block_id, block_name))
+
+    def emit_end_block(self, status, stats):
+        self._event(('end_block', status, stats))
+
+    def emit_start_stream(self, stream, switching):
+        self._event(('start_stream', _stream_item[stream], switching))
+
+    def emit_end_stream(self, switching):
+        self._event(('end_stream', switching))
+
+    def emit_stream_data(self, chunk):
+        data = chunk.text
+        history_event = ['data', data]
+        self._event(('data', data), history_event)
+        self.history_data.append(history_event)
+        self.history_data_size += len(data)
+        while self.history_data_size > self.history_size or len(self.history_data) > self.max_history_data:
+            old_event = self.history_data.popleft()
+            self.history_data_size -= len(old_event[1])
+            with self.lock:
+                old_event[1] = None
+                self.history_omitted = True
+            self.history_dropped += 1
+        if self.history_dropped > 1024 and self.history_dropped > len(self.history) // 2:
+            with self.lock:
+                self._compact_history()
+
+    # Must be called with the lock held.
+    def _compact_history(self):
+        self.history, omitted = _compact_history(self.history, self.max_history_events)
+        if omitted:
+            self.history_omitted = True
+        self.history_dropped = 0
+        self.compact_at = max(self.max_history_events, 2 * len(self.history))
+
+_page_html = '''\
+<html><head><meta charset="utf-8"><title>nestedlog</title><style>
+body {
+    margin: 0;
+    border: 0;
+    padding: 1em;
+    background-color: black;
+    color: #fff;
+}
+pre {
+    margin: 0;
+    border: 0;
+}
+.block {
+    border-left: 0.5em solid #333;
+    margin: 1em 0;
+}
+.block-header {
+    background-color: #333;
+}
+.block-content {
+    border-left: 0.5em solid #000;
+}
+.block-footer {
+    background-color: #333;
+}
+.block-status-running {
+    color: #88f;
+    border-color: #88f;
+}
+.block-status-ok {
+    color: #4f4;
+    border-color: #333;
+}
+.block-status-warning {
+    color: #ff0;
+    border-color: #dd0;
+}
+.block-status-error {
+    color: #f00;
+    border-color: #f00;
+}
+.stream-o {
+    color: #fff;
+}
+.stream-e {
+    color: #ff0;
+}
+.note {
+    color: #888;
+}
+.digest {
+    border-left: 0.5em solid #888;
+    padding-left: 0.5em;
+    margin-bottom: 1em;
+}
+</style></head><body><samp id="log"></samp><script>
+var log = document.getElementById("log");
+var blocks;
+var pre;
+var span;
+
+function nlNote(text) {
+    var note = document.createElement("div");
+    note.className = "note";
+    note.textContent = text;
+    (blocks.length ? blocks[blocks.length - 1].content : log).appendChild(note);
+}
+
+var handlers = {
+    "reset": function(ev) {
+        log.textContent = "";
+        blocks = [];
+        pre = null;
+        span = null;
+    },
+    "omitted": function(ev) {
+        nlNote("[Earlier output omitted]");
+    },
+    "digest": function(ev) {
+        var digest = document.createElement("pre");
+        digest.className = "digest";
+        digest.textContent = ev[1];
+        log.insertBefore(digest, log.firstChild);
+    },
+    "start_block": function(ev) {
+        var block = document.createElement("div");
+        block.className = "block block-status-running";
+        var header = document.createElement("div");
+        header.className = "block-header";
+        header.textContent = "\\u00a0" + ev[2] + " (Running)";
+        var content = document.createElement("div");
+        content.className = "block-content";
+        block.appendChild(header);
+        block.appendChild(content);
+        (blocks.length ? blocks[blocks.length - 1].content : log).appendChild(block);
+        blocks.push({"name": ev[2], "block": block, "header": header, "content": content});
+    },
+    "end_block": function(ev) {
+        var b = blocks.pop();
+        var status = ev[1].charAt(0).toUpperCase() + ev[1].slice(1);
+        b.block.className = "block block-status-" + ev[1];
+        b.header.textContent = "\\u00a0" + b.name + " (" + status + ")";
+        var footer = document.createElement("div");
+        footer.className = "block-footer";
+        footer.textContent = "\\u00a0(" + ev[2] + ")";
+        b.block.appendChild(footer);
+    },
+    "start_stream": function(ev) {
+        if (!ev[2]) {
+            pre = document.createElement("pre");
+            blocks[blocks.length - 1].content.appendChild(pre);
+        }
+        span = document.createElement("span");
+        span.className = "stream-" + ev[1];
+        pre.appendChild(span);
+    },
+    "end_stream": function(ev) {
+        span = null;
+        if (!ev[1]) {
+            pre = null;
+        }
+    },
+    "data": function(ev) {
+        span.appendChild(document.createTextNode(ev[1]));
+    },
+    "end_log": function(ev) {
+        source.close();
+        nlNote("[Log complete]");
+    },
+};
+
+var source = new EventSource("events");
+source.onmessage = function(e) {
+    var atBottom = window.innerHeight + window.scrollY >= document.body.scrollHeight - 20;
+    var ev = JSON.parse(e.data);
+    handlers[ev[0]](ev);
+    if (atBottom) {
+        window.scrollTo(0, document.body.scrollHeight);
+    }
+};
+</script></body></html>
+'''
+
+Emitter = _EmitterSSE
@@ -0,0 +1,99 @@
+# Copyright 2021 Stephen Warren <swarren@wwwdotorg.org>
+# SPDX-License-Identifier: MIT
+
+import nestedlog.emitter_base as nlebase
+import queue
+import threading
+
+BACKPRESSURE_BLOCK = 'block'
+BACKPRESSURE_DROP = 'drop'
+backpressures = (BACKPRESSURE_BLOCK, BACKPRESSURE_DROP)
+
+# Wraps another emitter, and runs it on a worker thread fed by a bounded
+# queue, so that slow formatting or file I/O doesn't hold up the main loop
+# that drains the logged process's output.
+#
+# When the queue is full, structural events always wait for space. Stream
+# data either waits too (BACKPRESSURE_BLOCK) or is discarded
+# (BACKPRESSURE_DROP), in which case a marker recording how much was lost is
+# emitted once the queue has space again.
+class _EmitterThreaded(object):
+    def __init__(self, emitter, queue_size=1024, backpressure=BACKPRESSURE_BLOCK):
+        if backpressure not in backpressures:
+            raise Exception(f'Invalid backpressure policy {backpressure}')
+        self.emitter = emitter
+        # Chunks must be timed when they're received, not when they're
+        # emitted.
+        self.wants_time = getattr(emitter, 'wants_time', False)
+        self.queue = queue.Queue(queue_size)
+        self.backpressure = backpressure
+        self.dropped = 0
+        self.thread = None
+        self.error = None
+
+    def _run(self):
+        while True:
+            event = self.queue.get()
+            if event is None:
+                break
+            if self.error is not None:
+                continue
+            func, args = event
+            try:
+                func(*args)
+            except BaseException as e:
+                # Keep draining the queue so that the producer never blocks
+                # forever; the error is re-raised from emit_end_log().
+                self.error = e
+
+    def _put(self, func, *args):
+        if self.dropped:
+            marker = f'\n[nestedlog: {self.dropped} characters dropped]\n'
+            self.dropped = 0
+            self.queue.put((self.emitter.emit_stream_data, (nlebase.Chunk(marker),)))
+        self.queue.put((func, args))
+
+    def emit_start_log(self):
+        self.thread = threading.Thread(target=self._run, name='nestedlog-emitter', daemon=True)
+        self.thread.start()
+        self._put(self.emitter.emit_start_log)
+
+    def emit_end_log(self):
+        self._put(self.emitter.emit_end_log)
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def emit_digest(self, hits, dropped):
+        self._put(self.emitter.emit_digest, hits, dropped)
+
+    def emit_start_block(self, block_id, block_name):
+        self._put(self.emitter.emit_start_block, block_id, block_name)
+
+    def emit_end_block(self, status, stats):
+        self._put(self.emitter.emit_end_block, status, stats)
+
+    def emit_start_stream(self, stream, switching):
+        self._put(self.emitter.emit_start_stream, stream, switching)
+
+    def emit_end_stream(self, switching):
+        self._put(self.emitter.emit_end_stream, switching)
+
+    def emit_stream_data(self, chunk):
+        if self.backpressure == BACKPRESSURE_BLOCK:
+            self._put(self.emitter.emit_stream_data, chunk)
+            return
+        if self.dropped:
+            # Don't let the marker itself be dropped; just try again later.
+            if self.queue.full():
+                self.dropped += len(chunk.text)
+                return
+            self._put(self.emitter.emit_stream_data, chunk)
+            return
+        try:
+            self.queue.put_nowait((self.emitter.emit_stream_data, (chunk,)))
+        except queue.Full:
+            self.dropped += len(chunk.text)
+
+Emitter = _EmitterThreaded
@@ -0,0 +1,96 @@
+# Copyright 2021 Stephen Warren <swarren@wwwdotorg.org>
+# SPDX-License-Identifier: MIT
+
+import time
+
+# Progress indicators typically redraw the current line by writing "\r" and
+# then the new state. In a terminal, only the final state remains visible, but
+# a log would record every redraw. This filter applies the "\r" overwrites
+# the same way a terminal would, and only passes on the final state of each
+# line.
+#
+# An incomplete line is held back until it is completed, or until the next
+# block boundary. If snapshot_interval is set, the state of a line that is
+# being redrawn is also recorded (as a line of its own) at most once per
+# snapshot_interval seconds, so the log shows progress over time.
+class _FilterCrFold(object):
+    # Incomplete lines longer than this aren't held back, so that memory use
+    # stays bounded even if a command never writes a newline.
+    max_pending = 64 * 1024
+
+    def __init__(self, snapshot_interval=None):
+        self.snapshot_interval = snapshot_interval
+        # stream -> (line, col) of the incomplete line for that stream.
+        self.pending = {}
+        self.last_snapshot = {}
+
+    def filter_start_log(self):
+        pass
+
+    def filter_end_log(self):
+        pass
+
+    def filter_start_block(self):
+        pass
+
+    def filter_end_block(self):
+        pass
+
+    @staticmethod
+    def _overwrite(line, col, text):
+        for i, part in enumerate(text.split('\r')):
+            if i:
+                col = 0
+            if part:
+                line = line[:col] + part + line[col + len(part):]
+                col += len(part)
+        return line, col
+
+    def filter_stream_data(self, stream, data):
+        pending = self.pending.pop(stream, None)
+        if pending is None and '\r' not in data:
+            nl = data.rfind('\n')
+            if nl == len(data) - 1:
+                return ((stream, data),)
+            if nl >= 0:
+                self.pending[stream] = (data[nl + 1:], len(data) - nl - 1)
+                return ((stream, data[:nl + 1]),)
+            pending = ('', 0)
+        elif pending is None:
+            pending = ('', 0)
+
+        line, col = pending
+        pieces = data.split('\n')
+        out = []
+        for piece in pieces[:-1]:
+            if line or '\r' in piece:
+                line, col = self._overwrite(line, col, piece)
+                out.append(line)
+                line, col = '', 0
+            else:
+                out.append(piece)
+        if out:
+            out.append('')
+            out = [(stream, '\n'.join(out))]
+        last = pieces[-1]
+        if '\r' in last and self.snapshot_interval is not None:
+            now = time.monotonic()
+            last_snapshot = self.last_snapshot.get(stream)
+            if last_snapshot is None or now - last_snapshot >= self.snapshot_interval:
+                self.last_snapshot[stream] = now
+                snapshot = self._overwrite(line, col, last[:last.rindex('\r')])[0]
+                if snapshot:
+                    out.append((stream, snapshot + '\n'))
+        line, col = self._overwrite(line, col, last)
+        if len(line) > self.max_pending:
+            out.append((stream, line))
+        elif line:
+            self.pending[stream] = (line, col)
+        return out
+
+    def filter_flush(self):
+        out = [(stream, line) for (stream, (line, col)) in self.pending.items()]
+        self.pending = {}
+        return out
+
+Filter = _FilterCrFold
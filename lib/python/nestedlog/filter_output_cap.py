@@ -0,0 +1,171 @@
+# Copyright 2021 Stephen Warren <swarren@wwwdotorg.org>
+# SPDX-License-Identifier: MIT
+
+import collections
+
+def _size(data):
+    if data.isascii():
+        return len(data)
+    return len(data.encode('utf-8'))
+
+# Returns the longest prefix of data that's no more than size bytes.
+def _head(data, size):
+    if data.isascii():
+        return data[:size]
+    return str(data.encode('utf-8')[:size], 'utf-8', 'ignore')
+
+# Returns the longest suffix of data that's no more than size bytes.
+def _tail(data, size):
+    if data.isascii():
+        return data[len(data) - size:]
+    encoded = data.encode('utf-8')
+    return str(encoded[len(encoded) - size:], 'utf-8', 'ignore')
+
+# Limits the amount of output recorded in the log. Sizes are counted in bytes
+# of UTF-8; output is only ever cut between characters, so slightly less than
+# a limit may be kept.
+#
+# max_block limits the output written directly into each block; the first
+# (max_block - tail) bytes are passed through, and the last tail bytes are
+# held in a ring buffer until the block ends (or a child block starts).
+# Everything in between is replaced by a marker. max_log limits the output
+# of the entire log in the same way, and is a hard limit: the tails count
+# towards it too, and room for one tail is kept back from the heads. Once it
+# has been reached, each block's output is replaced by a marker alone.
+#
+# If full_output_file_name is given, all output is also written to that file,
+# unmodified, and markers give the position of the elided data within it.
+class _FilterOutputCap(object):
+    def __init__(self, max_block=None, max_log=None, tail=None, full_output_file_name=None):
+        if tail is None:
+            if max_block is not None:
+                tail = max_block // 2
+            else:
+                tail = 16 * 1024
+        if max_block is not None:
+            tail = min(tail, max_block)
+            self.head = max_block - tail
+        else:
+            self.head = None
+        self.tail = tail
+        self.log_remaining = max_log
+        self.full_output_file_name = full_output_file_name
+        self.full_output = None
+        self.blocks = []
+
+    def filter_start_log(self):
+        if self.full_output_file_name:
+            self.full_output = open(self.full_output_file_name, 'wb')
+
+    def filter_end_log(self):
+        if self.full_output:
+            self.full_output.close()
+            self.full_output = None
+
+    def filter_start_block(self):
+        self.blocks.append({
+            'head_remaining': self.head,
+            'tail': collections.deque(),
+            'tail_size': 0,
+            'elided': 0,
+            'elided_offset': None,
+            'elided_stream': None,
+        })
+
+    def filter_end_block(self):
+        self.blocks.pop()
+
+    def filter_stream_data(self, stream, data):
+        if self.full_output:
+            offset = self.full_output.tell()
+            self.full_output.write(data.encode('utf-8'))
+        else:
+            offset = None
+        block = self.blocks[-1]
+        head_remaining = block['head_remaining']
+        if self.log_remaining is None:
+            if head_remaining is None:
+                return ((stream, data),)
+            allowed = head_remaining
+        else:
+            allowed = max(self.log_remaining - self.tail, 0)
+            if head_remaining is not None:
+                allowed = min(allowed, head_remaining)
+        size = _size(data)
+        if size <= allowed:
+            self._count(block, size)
+            return ((stream, data),)
+        out = []
+        if allowed:
+            head = _head(data, allowed)
+            if head:
+                head_size = _size(head)
+                self._count(block, head_size)
+                out.append((stream, head))
+                if offset is not None:
+                    offset += head_size
+                data = data[len(head):]
+                size -= head_size
+        self._add_tail(block, stream, data, size, offset)
+        return out
+
+    def _count(self, block, size):
+        if block['head_remaining'] is not None:
+            block['head_remaining'] -= size
+        if self.log_remaining is not None:
+            self.log_remaining -= size
+
+    # The tail holds (stream, data, size) tuples. Only the innermost block
+    # ever holds a tail, so log_remaining can't change while it's held.
+    def _add_tail(self, block, stream, data, size, offset):
+        if not block['tail'] and not block['elided']:
+            block['elided_offset'] = offset
+        tail = block['tail']
+        tail.append((stream, data, size))
+        block['tail_size'] += size
+        excess = block['tail_size'] - self.tail
+        if self.log_remaining is not None:
+            excess = max(excess, block['tail_size'] - self.log_remaining)
+        while excess > 0:
+            stream, data, size = tail[0]
+            if size <= excess:
+                tail.popleft()
+                dropped = size
+            else:
+                data = _tail(data, size - excess)
+                kept = _size(data)
+                if kept:
+                    tail[0] = (stream, data, kept)
+                else:
+                    tail.popleft()
+                dropped = size - kept
+            block['tail_size'] -= dropped
+            block['elided'] += dropped
+            block['elided_stream'] = stream
+            excess -= dropped
+
+    def filter_flush(self):
+        if not self.blocks:
+            return ()
+        block = self.blocks[-1]
+        tail = block['tail']
+        if not tail and not block['elided']:
+            return ()
+        out = []
+        if block['elided']:
+            marker = f'\n[nestedlog: {block["elided"]} bytes elided'
+            if block['elided_offset'] is not None:
+                marker += (f'; full output in {self.full_output_file_name} from byte '
+                    f'{block["elided_offset"]}')
+            marker += ']\n'
+            out.append((block['elided_stream'], marker))
+        out.extend((stream, data) for (stream, data, size) in tail)
+        if self.log_remaining is not None:
+            self.log_remaining -= block['tail_size']
+        block['tail'] = collections.deque()
+        block['tail_size'] = 0
+        block['elided'] = 0
+        block['elided_offset'] = None
+        return out
+
+Filter = _FilterOutputCap
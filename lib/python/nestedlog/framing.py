@@ -0,0 +1,130 @@
+# Copyright 2021 Stephen Warren <swarren@wwwdotorg.org>
+# SPDX-License-Identifier: MIT
+
+import codecs
+import nestedlog.data as nld
+import struct
+
+# Set in nestedlog-helper's environment to request protocol version 2, and to
+# configure output coalescing in that version. A helper that doesn't
+# understand these ignores them, and uses version 1.
+HELPER_PROTOCOL_ENV_VAR = 'NESTED_LOG_HELPER_PROTOCOL'
+HELPER_COALESCE_BYTES_ENV_VAR = 'NESTED_LOG_HELPER_COALESCE_BYTES'
+HELPER_COALESCE_USEC_ENV_VAR = 'NESTED_LOG_HELPER_COALESCE_USEC'
+
+# Sent by a helper which accepted the request for version 2, before any
+# frames. In version 1, this would be a zero-length frame with the stderr bit
+# set, which a version 1 helper never sends.
+_V2_HELLO = b'\x00\x80'
+
+class StreamDecoder(object):
+    def __init__(self, sink, stream, errors='replace'):
+        self.sink = sink
+        self.stream = stream
+        self.decoder = codecs.getincrementaldecoder('utf-8')(errors)
+
+    def feed(self, data):
+        # A multi-byte character may be split across reads or frames; the
+        # incremental decoder holds onto the partial character until the
+        # rest of it arrives.
+        text = self.decoder.decode(data)
+        if text:
+            self.sink.stream_data(self.stream, text)
+
+    def flush(self):
+        text = self.decoder.decode(b'', True)
+        if text:
+            self.sink.stream_data(self.stream, text)
+
+# Parses the multiplexed stdout of nestedlog-helper.
+#
+# In version 1 of the protocol, each frame is a 2-byte little-endian header;
+# bits 0..14 contain the payload length, and bit 15 contains the stream (0:
+# stdout, 1: stderr). A zero-length frame is a drain request from the helper.
+#
+# Version 2 is the same, except that the header is 4 bytes, with bits 0..30
+# containing the payload length, and bit 31 the stream.
+#
+# If negotiate is set, version 2 was requested, and is used if the helper
+# starts with _V2_HELLO; otherwise, version 1 is used.
+#
+# on_data(stream, view) receives a memoryview of the payload, which is only
+# valid during the call. on_drain() is called for each drain request.
+class FrameParser(object):
+    def __init__(self, on_data, on_drain, negotiate=False):
+        self.on_data = on_data
+        self.on_drain = on_drain
+        self.buf = bytearray()
+        if negotiate:
+            self.version = None
+        else:
+            self.version = 1
+
+    def feed(self, data):
+        # Only copy data when a partial frame was left over from the previous
+        # read; otherwise parse the caller's buffer in place.
+        if self.buf:
+            self.buf += data
+            data = self.buf
+        view = memoryview(data)
+        try:
+            pos = self._parse(data, view)
+        finally:
+            view.release()
+        if data is self.buf:
+            del self.buf[:pos]
+        elif pos < len(data):
+            self.buf += data[pos:]
+
+    def _parse(self, data, view):
+        pos = 0
+        if self.version is None:
+            if len(data) < len(_V2_HELLO):
+                return pos
+            if data[:len(_V2_HELLO)] == _V2_HELLO:
+                self.version = 2
+                pos += len(_V2_HELLO)
+            else:
+                self.version = 1
+        if self.version == 2:
+            return self._parse_v2(data, view, pos)
+        end = len(data)
+        while end - pos >= 2:
+            hdr1 = data[pos + 1]
+            count = ((hdr1 & 0x7f) << 8) | data[pos]
+            # fsync implementation to flush data pipe
+            if count == 0:
+                pos += 2
+                self.on_drain()
+                continue
+            if end - pos < 2 + count:
+                break
+            if hdr1 & 0x80:
+                stream = nld.STREAM_STDERR
+            else:
+                stream = nld.STREAM_STDOUT
+            self.on_data(stream, view[pos + 2:pos + 2 + count])
+            pos += 2 + count
+        return pos
+
+    def _parse_v2(self, data, view, pos):
+        end = len(data)
+        while end - pos >= 4:
+            hdr, = struct.unpack_from('<I', data, pos)
+            count = hdr & 0x7fffffff
+            if count == 0:
+                pos += 4
+                self.on_drain()
+                continue
+            if end - pos < 4 + count:
+                break
+            if hdr & 0x80000000:
+                stream = nld.STREAM_STDERR
+            else:
+                stream = nld.STREAM_STDOUT
+            self.on_data(stream, view[pos + 4:pos + 4 + count])
+            pos += 4 + count
+        return pos
+
+    def backlog(self):
+        return len(self.buf)
@@ -1,20 +1,54 @@
 # Copyright 2021 Stephen Warren <swarren@wwwdotorg.org>
 # SPDX-License-Identifier: MIT
 
+import errno
 import os
 import select
 import socket
+import struct
 import subprocess
 import tempfile
+import termios
+import time
 import nestedlog.api as nlapi
 import nestedlog.data as nld
+import nestedlog.framing as nlframing
+import nestedlog.rusage as nlrusage
 import nestedlog.sink as nlsink
 
-def gen_log(emitters, cmd):
+def _read(fd, size=32768):
+    try:
+        return os.read(fd, size)
+    except BlockingIOError:
+        return b''
+    except OSError as e:
+        # A pty master reports EIO once the slave side is fully closed.
+        if e.errno == errno.EIO:
+            return b''
+        raise
+
+def _open_pty():
+    master_fd, slave_fd = os.openpty()
+    # Disable output post-processing so that e.g. "\n" isn't translated to
+    # "\r\n" on the way through.
+    attrs = termios.tcgetattr(slave_fd)
+    attrs[1] &= ~termios.OPOST
+    termios.tcsetattr(slave_fd, termios.TCSANOW, attrs)
+    return master_fd, slave_fd
+
+# Version 2 of the helper protocol allows larger frames, and coalesced output
+# can build up in the pipe, so read more at once.
+_HELPER_READ_SIZE = 256 * 1024
+
+def gen_log(emitters, cmd, capture=nld.CAPTURE_CUSE, decode_errors='replace', slowest_blocks=0, stats=None, filters=(), helper_protocol=1, helper_coalesce_bytes=64 * 1024, helper_coalesce_usec=0, watchdog=None, digest=None):
     def handle_control_listen_event(fd, event):
         if event & select.POLLIN:
             ctl_client_sock, addr = ctl_listen_sock.accept()
             ctl_client_fd = ctl_client_sock.fileno()
+            peercred = ctl_client_sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+            ctl_client_pids[ctl_client_fd] = struct.unpack('3i', peercred)[0]
+            if stats:
+                ctl_client_connect_times[ctl_client_fd] = time.perf_counter()
             os.set_blocking(ctl_client_fd, False)
             handlers[ctl_client_fd] = (handle_control_client_data, ctl_client_sock)
             poller.register(ctl_client_fd, select.POLLIN | select.POLLHUP)
@@ -22,46 +56,97 @@ def gen_log(emitters, cmd):
         if event:
             raise Exception(f'Unknown event(s) 0x{event:x} on fd {fd}')
 
+    def read_data(fd):
+        data = _read(fd, read_sizes.get(fd, 32768))
+        if stats and data and fd in capture_fds:
+            stats.reads += 1
+            stats.read_bytes += len(data)
+        return data
+
     def handle_data_event(fd, event):
+        handler, file_obj = handlers[fd]
         if event & select.POLLIN:
-            data = os.read(fd, 32768)
-            handler, file_obj = handlers[fd]
-            handler(fd, data)
+            data = read_data(fd)
+            if data:
+                handler(fd, data)
             event &= ~select.POLLIN
         if event & select.POLLHUP:
+            # Consume anything still buffered before the fd goes away.
+            while True:
+                data = read_data(fd)
+                if not data:
+                    break
+                handler(fd, data)
             poller.unregister(fd)
             del handlers[fd]
+            if fd in ctl_client_pids:
+                ctl_clients.client_exited(ctl_client_pids.pop(fd))
+            if fd in drain_fds:
+                drain_fds.remove(fd)
+                os.close(fd)
             event &= ~select.POLLHUP
         if event:
             raise Exception(f'Unknown event(s) 0x{event:x} on fd {fd}')
 
-    mbuf = b''
     def handle_multiplexed_data(fd, buf):
-        nonlocal mbuf
-        mbuf += buf
-        while True:
-            if len(mbuf) < 2:
-                return
-            count = ((mbuf[1] & 0x7f) << 8) | mbuf[0]
-            # fsync implementation to flush data pipe
-            if count == 0:
-                os.write(stdin_fd, b'\x00')
-            else:
-                if len(mbuf) < 2 + count:
-                    return
-                mfd = (mbuf[1] >> 7) + 1
-                data = mbuf[2:2+count].decode('utf-8')
-                if mfd == 1:
-                    sink.stream_data(nld.STREAM_STDOUT, data)
-                else:
-                    sink.stream_data(nld.STREAM_STDERR, data)
-            mbuf = mbuf[2+count:]
+        frame_parser.feed(buf)
+        if stats:
+            backlog = frame_parser.backlog()
+            if backlog > stats.frame_backlog_peak:
+                stats.frame_backlog_peak = backlog
+
+    def handle_frame(stream, data):
+        if stats and stats.helper_protocol is None:
+            stats.helper_protocol = frame_parser.version
+        if stats:
+            stats.stream_frame(stream, len(data))
+        decoders[stream].feed(data)
+
+    # fsync implementation to flush data pipe
+    def handle_drain():
+        os.write(stdin_fd, b'\x00')
+
+    def handle_stdout_pipe_data(fd, buf):
+        if stats:
+            stats.stream_frame(nld.STREAM_STDOUT, len(buf))
+        decoders[nld.STREAM_STDOUT].feed(buf)
 
     def handle_stderr_pipe_data(fd, buf):
-        sink.stream_data(nld.STREAM_STDERR, buf.decode('utf-8'))
+        if stats:
+            stats.stream_frame(nld.STREAM_STDERR, len(buf))
+        decoders[nld.STREAM_STDERR].feed(buf)
+
+    def handle_helper_stderr_data(fd, buf):
+        helper_stderr_decoder.feed(buf)
+
+    # Without nestedlog-helper, the logged process writes straight into
+    # pipes/ptys. A client has written all its data before it sends a
+    # control command, so reading everything that's currently buffered
+    # before acting on the command keeps block boundaries in order.
+    drain_fds = []
+    def drain_capture_fds():
+        for fd in drain_fds:
+            handler, file_obj = handlers[fd]
+            while True:
+                data = read_data(fd)
+                if not data:
+                    break
+                handler(fd, data)
+
+    # A multi-byte character can't span a block boundary; any partial
+    # character held by a decoder is flushed (as a replacement character,
+    # with the default decode_errors) into the block it was written in.
+    def flush_decoders():
+        for decoder in decoders.values():
+            decoder.flush()
 
     ctl_client_bufs = {}
+    ctl_client_pids = {}
+    ctl_clients = nlrusage.ControlClients()
+    ctl_client_connect_times = {}
     def handle_control_client_data(fd, buf):
+        if stats:
+            received = ctl_client_connect_times.pop(fd, None) or time.perf_counter()
         prev_buf = ctl_client_bufs.get(fd, b'')
         buf = prev_buf + buf
         while True:
@@ -77,10 +162,15 @@ def gen_log(emitters, cmd):
                 cmd, args = cmd_s.split(' ', 1)
                 if cmd == nlapi.CMD_START_BLOCK:
                     cmdfunc = sink.start_block
-                    cmdargs = [args]
+                    cmdargs = [args, ctl_clients.snapshot(ctl_client_pids[fd])]
                 elif cmd == nlapi.CMD_END_BLOCK:
                     cmdfunc = sink.end_block
-                    cmdargs = [nld.text_to_status[args]]
+                    args = args.split(' ')
+                    status = nld.text_to_status[args[0]]
+                    if len(args) > 1:
+                        cmdargs = [status, nlrusage.from_args(args[1:])]
+                    else:
+                        cmdargs = [status, ctl_clients.snapshot(ctl_client_pids[fd]), True]
                 else:
                     raise Exception(f'Unknown command "{cmd}"')
             except:
@@ -89,22 +179,36 @@ def gen_log(emitters, cmd):
                 sink.stream_data(nld.STREAM_STDERR, traceback.format_exc())
                 os.write(fd, b'1')
                 continue
+            drain_capture_fds()
+            flush_decoders()
             cmdfunc(*cmdargs)
             os.write(fd, b'0')
+            if stats:
+                stats.control_command(time.perf_counter() - received)
         ctl_client_bufs[fd] = buf
 
-    sink = nlsink.Sink(emitters)
+    sink = nlsink.Sink(emitters, slowest_blocks, filters, digest)
+    decoders = {
+        stream: nlframing.StreamDecoder(sink, stream, decode_errors)
+        for stream in (nld.STREAM_STDOUT, nld.STREAM_STDERR)
+    }
+    helper_stderr_decoder = nlframing.StreamDecoder(sink, nld.STREAM_STDERR, decode_errors)
+    frame_parser = nlframing.FrameParser(handle_frame, handle_drain, negotiate=True)
     sink.start_log()
     sink.start_block(' '.join(cmd))
 
     block_status = nld.STATUS_AUTO
+    block_rusage = None
     try:
         with tempfile.TemporaryDirectory() as ctl_dir:
             sock_path = os.path.join(ctl_dir, 'control')
             os.environ[nlapi.SOCK_ENV_VAR] = sock_path
+            os.environ[nlapi.CAPTURE_ENV_VAR] = capture
 
             poller = select.epoll()
             handlers = {}
+            capture_fds = set()
+            read_sizes = {}
 
             ctl_listen_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
             ctl_listen_fd = ctl_listen_sock.fileno()
@@ -113,21 +217,65 @@ def gen_log(emitters, cmd):
             ctl_listen_sock.bind(sock_path)
             ctl_listen_sock.listen(1)
 
-            sp = subprocess.Popen(['nestedlog-helper'] + cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            stdin_f = sp.stdin
-            stdin_fd = stdin_f.fileno()
-            stdout_f = sp.stdout
-            stdout_fd = stdout_f.fileno()
-            handlers[stdout_fd] = (handle_multiplexed_data, stdout_f)
-            poller.register(stdout_fd, select.POLLIN | select.POLLHUP)
-            stderr_f = sp.stderr
-            stderr_fd = stderr_f.fileno()
-            handlers[stderr_fd] = (handle_stderr_pipe_data, stderr_f)
-            poller.register(stderr_fd, select.POLLIN | select.POLLHUP)
-            # FIXME: Closer stdin/stdout/stderr sometime
+            if capture == nld.CAPTURE_CUSE:
+                helper_env = dict(os.environ)
+                # Version 2 is only requested when asked for, since it needs a
+                # nestedlog-helper built with support for it; the output is
+                # parsed correctly either way.
+                if helper_protocol >= 2:
+                    helper_env[nlframing.HELPER_PROTOCOL_ENV_VAR] = str(helper_protocol)
+                    helper_env[nlframing.HELPER_COALESCE_BYTES_ENV_VAR] = str(helper_coalesce_bytes)
+                    helper_env[nlframing.HELPER_COALESCE_USEC_ENV_VAR] = str(helper_coalesce_usec)
+                sp = subprocess.Popen(['nestedlog-helper'] + cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=helper_env)
+                stdin_f = sp.stdin
+                stdin_fd = stdin_f.fileno()
+                stdout_f = sp.stdout
+                stdout_fd = stdout_f.fileno()
+                handlers[stdout_fd] = (handle_multiplexed_data, stdout_f)
+                capture_fds.add(stdout_fd)
+                read_sizes[stdout_fd] = _HELPER_READ_SIZE
+                poller.register(stdout_fd, select.POLLIN | select.POLLHUP)
+                stderr_f = sp.stderr
+                stderr_fd = stderr_f.fileno()
+                handlers[stderr_fd] = (handle_helper_stderr_data, stderr_f)
+                poller.register(stderr_fd, select.POLLIN | select.POLLHUP)
+                # FIXME: Closer stdin/stdout/stderr sometime
+            elif capture in (nld.CAPTURE_PIPE, nld.CAPTURE_PTY):
+                if capture == nld.CAPTURE_PTY:
+                    stdout_fd, stdout_wfd = _open_pty()
+                    stderr_fd, stderr_wfd = _open_pty()
+                else:
+                    stdout_fd, stdout_wfd = os.pipe()
+                    stderr_fd, stderr_wfd = os.pipe()
+                try:
+                    sp = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=stdout_wfd, stderr=stderr_wfd)
+                finally:
+                    os.close(stdout_wfd)
+                    os.close(stderr_wfd)
+                for fd, handler in ((stdout_fd, handle_stdout_pipe_data), (stderr_fd, handle_stderr_pipe_data)):
+                    os.set_blocking(fd, False)
+                    handlers[fd] = (handler, None)
+                    drain_fds.append(fd)
+                    capture_fds.add(fd)
+                    poller.register(fd, select.POLLIN | select.POLLHUP)
+            else:
+                raise Exception(f'Unknown capture method "{capture}"')
 
+            if watchdog:
+                poll_timeout = watchdog.timeout
+            else:
+                poll_timeout = None
             while True:
-                events = poller.poll()
+                events = poller.poll(poll_timeout)
+                if not events:
+                    watchdog.stalled(sink, sp.pid)
+                    poll_timeout = watchdog.timeout
+                    continue
+                if watchdog and watchdog.stalled_for:
+                    watchdog.active()
+                    poll_timeout = watchdog.timeout
+                if stats:
+                    stats.wakeups += 1
                 for fd, event in events:
                     if fd == ctl_listen_fd:
                         handle_control_listen_event(fd, event)
@@ -135,8 +283,12 @@ def gen_log(emitters, cmd):
                         handle_data_event(fd, event)
                 if len(handlers) == 0:
                     break
-            
-            sp.wait()
+            flush_decoders()
+            helper_stderr_decoder.flush()
+
+            pid, wait_status, ru = os.wait4(sp.pid, 0)
+            sp.returncode = nlrusage.exit_code(wait_status)
+            block_rusage = nlrusage.from_struct_rusage(ru)
             if sp.returncode != 0:
                 sink.stream_data(nld.STREAM_STDERR, 'ERROR: Process exit code ' + str(sp.returncode))
                 block_status = nld.STATUS_ERROR
@@ -145,6 +297,6 @@ def gen_log(emitters, cmd):
         sink.stream_data(nld.STREAM_STDERR, traceback.format_exc())
         block_status = nld.STATUS_ERROR
 
-    status = sink.end_block(block_status)
+    status = sink.end_block(block_status, block_rusage)
     sink.end_log()
     return status
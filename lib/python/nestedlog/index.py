@@ -0,0 +1,72 @@
+# Copyright 2021 Stephen Warren <swarren@wwwdotorg.org>
+# SPDX-License-Identifier: MIT
+
+import json
+import nestedlog.data as nld
+
+# A block index is a sidecar file next to a log file or journal that records
+# where each block lives within it, so that tools can seek straight to a
+# block rather than scanning the whole log. It contains one JSON object per
+# line, written as each block ends:
+#
+#   id: block ID, as assigned by Sink.
+#   name: block name.
+#   depth: nesting depth; top-level blocks have depth 0.
+#   parent: ID of the enclosing block, or null.
+#   status: block status text.
+#   start, end: byte offsets of the block within the log file.
+#   duration: wall-clock time the block was open for, in seconds.
+#   utime, stime: resource usage of the block, if known; see
+#       nestedlog.rusage.
+
+def index_file_name(log_file_name):
+    return log_file_name + '.idx'
+
+class Writer(object):
+    def __init__(self, log_file_name):
+        self.index_file = open(index_file_name(log_file_name), 'wt')
+        self.blocks = []
+
+    def close(self):
+        self.index_file.close()
+
+    def start_block(self, block_id, block_name, offset):
+        self.blocks.append((block_id, block_name, offset))
+
+    def end_block(self, status, offset, stats):
+        block_id, block_name, start = self.blocks.pop()
+        if self.blocks:
+            parent = self.blocks[-1][0]
+        else:
+            parent = None
+        record = {
+            'id': block_id,
+            'name': block_name,
+            'depth': len(self.blocks),
+            'parent': parent,
+            'status': nld.status_to_text[status],
+            'start': start,
+            'end': offset,
+        }
+        record.update(stats)
+        self.index_file.write(json.dumps(record) + '\n')
+
+# Returns the index's block records, sorted by block ID (i.e. in the order in
+# which the blocks started).
+def read(log_file_name):
+    with open(index_file_name(log_file_name), 'rt') as f:
+        blocks = [json.loads(line) for line in f]
+    blocks.sort(key=lambda block: block['id'])
+    return blocks
+
+# Returns the innermost blocks that failed; i.e. those whose failure wasn't
+# merely inherited from a child block.
+def failed_blocks(blocks):
+    failed_text = nld.status_to_text[nld.STATUS_ERROR]
+    failed_parents = set(
+        block['parent'] for block in blocks if block['status'] == failed_text
+    )
+    return [
+        block for block in blocks
+        if block['status'] == failed_text and block['id'] not in failed_parents
+    ]
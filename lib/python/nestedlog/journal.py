@@ -0,0 +1,269 @@
+# Copyright 2021 Stephen Warren <swarren@wwwdotorg.org>
+# SPDX-License-Identifier: MIT
+
+import json
+import mmap
+import nestedlog.data as nld
+import nestedlog.emitter_base as nlebase
+import nestedlog.index as nlindex
+import os
+import struct
+import time
+
+# A journal is a compact binary record of every event a Sink sends to its
+# emitters. Capturing just the journal is very cheap, and the journal can be
+# rendered by the regular emitters later, possibly many times.
+#
+# File format:
+#   magic: b'NLJ\x01'
+#   records: type (u8), timestamp (f64, time.time()), payload length (varint),
+#            payload
+#
+# The end_block record's payload is the status (u8), optionally followed by
+# the block's duration (f64, seconds), optionally followed by its user and
+# system CPU time (f64, seconds).
+#
+# The digest record's payload is JSON: {"hits": [...], "dropped": n}; see
+# nestedlog.digest.
+#
+# Readers ignore any payload bytes they don't understand, so fields may be
+# appended to a record type's payload without breaking older readers.
+
+MAGIC = b'NLJ\x01'
+
+REC_START_LOG = 1
+REC_END_LOG = 2
+REC_START_BLOCK = 3
+REC_END_BLOCK = 4
+REC_START_STREAM = 5
+REC_END_STREAM = 6
+REC_STREAM_DATA = 7
+REC_DIGEST = 8
+
+_rec_header = struct.Struct('<Bd')
+_duration = struct.Struct('<d')
+_rusage = struct.Struct('<dd')
+
+def _varint(value):
+    out = bytearray()
+    while value >= 0x80:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+def _read_varint(buf, pos):
+    value = 0
+    shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        value |= (b & 0x7f) << shift
+        if not b & 0x80:
+            return value, pos
+        shift += 7
+
+class Writer(object):
+    wants_time = True
+
+    def __init__(self, journal_file_name, index=False):
+        self.journal_file_name = journal_file_name
+        self.gen_index = index
+
+    def _write(self, rec_type, payload=b'', timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        header = _rec_header.pack(rec_type, timestamp) + _varint(len(payload))
+        self.journal_file.write(header)
+        self.journal_file.write(payload)
+        self.pos += len(header) + len(payload)
+
+    def emit_start_log(self):
+        self.journal_file = open(self.journal_file_name, 'wb', buffering=1024 * 1024)
+        self.journal_file.write(MAGIC)
+        self.pos = len(MAGIC)
+        if self.gen_index:
+            self.index = nlindex.Writer(self.journal_file_name)
+        else:
+            self.index = None
+        self._write(REC_START_LOG)
+
+    def emit_end_log(self):
+        self._write(REC_END_LOG)
+        self.journal_file.close()
+        if self.index:
+            self.index.close()
+
+    def emit_start_block(self, block_id, block_name):
+        if self.index:
+            self.index.start_block(block_id, block_name, self.pos)
+        name = block_name.encode('utf-8')
+        self._write(REC_START_BLOCK, _varint(block_id) + _varint(len(name)) + name)
+
+    def emit_end_block(self, status, stats):
+        payload = bytes((status,))
+        if 'duration' in stats:
+            payload += _duration.pack(stats['duration'])
+            if 'utime' in stats:
+                payload += _rusage.pack(stats['utime'], stats['stime'])
+        self._write(REC_END_BLOCK, payload)
+        if self.index:
+            self.index.end_block(status, self.pos, stats)
+
+    def emit_start_stream(self, stream, switching):
+        self._write(REC_START_STREAM, bytes((stream, switching)))
+
+    def emit_end_stream(self, switching):
+        self._write(REC_END_STREAM, bytes((switching,)))
+
+    def emit_stream_data(self, chunk):
+        self._write(REC_STREAM_DATA, chunk.text.encode('utf-8'), chunk.time)
+
+    def emit_digest(self, hits, dropped):
+        payload = json.dumps({'hits': hits, 'dropped': dropped}, separators=(',', ':'))
+        self._write(REC_DIGEST, payload.encode('utf-8'))
+
+# Yields (offset, rec_type, timestamp, payload) for each record, where offset
+# is the byte offset of the record within the journal, and payload is a
+# memoryview into the mapped file.
+def records(buf, start=None, end=None):
+    if bytes(buf[:len(MAGIC)]) != MAGIC:
+        raise Exception('Not a nestedlog journal')
+    if start is None:
+        start = len(MAGIC)
+    if end is None:
+        end = len(buf)
+    view = memoryview(buf)
+    pos = start
+    while pos < end:
+        offset = pos
+        # Stop at a truncated record, e.g. from a run that was killed.
+        if pos + _rec_header.size >= end:
+            break
+        rec_type, timestamp = _rec_header.unpack_from(buf, pos)
+        pos += _rec_header.size
+        try:
+            length, pos = _read_varint(buf, pos)
+        except IndexError:
+            break
+        if pos + length > end:
+            break
+        payload = view[pos:pos + length]
+        pos += length
+        yield offset, rec_type, timestamp, payload
+
+def _dispatch(emitter, rec_type, timestamp, payload):
+    if rec_type == REC_START_BLOCK:
+        block_id, pos = _read_varint(payload, 0)
+        length, pos = _read_varint(payload, pos)
+        block_name = str(payload[pos:pos + length], 'utf-8')
+        emitter.emit_start_block(block_id, block_name)
+        return
+    if rec_type == REC_END_BLOCK:
+        stats = {}
+        if len(payload) >= 1 + _duration.size:
+            stats['duration'] = _duration.unpack_from(payload, 1)[0]
+        if len(payload) >= 1 + _duration.size + _rusage.size:
+            utime, stime = _rusage.unpack_from(payload, 1 + _duration.size)
+            stats['utime'] = utime
+            stats['stime'] = stime
+        emitter.emit_end_block(payload[0], stats)
+        return
+    if rec_type == REC_START_STREAM:
+        emitter.emit_start_stream(payload[0], bool(payload[1]))
+        return
+    if rec_type == REC_END_STREAM:
+        emitter.emit_end_stream(bool(payload[0]))
+        return
+    if rec_type == REC_STREAM_DATA:
+        emitter.emit_stream_data(nlebase.Chunk(str(payload, 'utf-8'), timestamp))
+        return
+    if rec_type == REC_DIGEST:
+        digest = json.loads(str(payload, 'utf-8'))
+        emitter.emit_digest(digest['hits'], digest['dropped'])
+        return
+    # Unknown record types are skipped, so that newer journals can still be
+    # rendered, albeit without the extra information.
+
+def open_journal(journal_file_name):
+    with open(journal_file_name, 'rb') as f:
+        # A run that crashed before its first write leaves an empty journal,
+        # which renders as an empty log. Empty files can't be mapped.
+        if os.fstat(f.fileno()).st_size == 0:
+            return MAGIC
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+def is_journal(file_name):
+    with open(file_name, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+# Replays a journal into a set of emitters. Returns the status of the last
+# top-level block, or None if the journal contains no complete blocks.
+#
+# ranges optionally limits the replay to a list of (start, end) byte offsets
+# within the journal, such as those recorded in a block index. Each range
+# should contain complete blocks, which are replayed as top-level blocks.
+def replay(journal_file_name, emitters, ranges=None):
+    buf = open_journal(journal_file_name)
+    if ranges is None:
+        ranges = [(None, None)]
+    status = None
+    for emitter in emitters:
+        emitter.emit_start_log()
+    for start, end in ranges:
+        status = _replay_range(buf, emitters, start, end)
+    for emitter in emitters:
+        emitter.emit_end_log()
+    return status
+
+def _replay_range(buf, emitters, start, end):
+    status = None
+    depth = 0
+    in_stream = False
+    for offset, rec_type, timestamp, payload in records(buf, start, end):
+        if rec_type in (REC_START_LOG, REC_END_LOG):
+            continue
+        if rec_type == REC_START_BLOCK:
+            depth += 1
+        elif rec_type == REC_END_BLOCK:
+            depth -= 1
+            if depth == 0:
+                status = payload[0]
+        elif rec_type == REC_START_STREAM:
+            in_stream = True
+        elif rec_type == REC_END_STREAM:
+            in_stream = False
+        for emitter in emitters:
+            _dispatch(emitter, rec_type, timestamp, payload)
+    # A journal from a run that was killed may be incomplete. Close anything
+    # that was left open so the rendered log is still well formed.
+    if depth:
+        status = nld.STATUS_ERROR
+        if in_stream:
+            for emitter in emitters:
+                emitter.emit_end_stream(False)
+        for i in range(depth):
+            for emitter in emitters:
+                emitter.emit_end_block(nld.STATUS_ERROR, {})
+    return status
+
+def _render_one(journal_file_name, emitter):
+    replay(journal_file_name, [emitter])
+
+# Renders a journal into a set of emitters, each in its own process.
+def render(journal_file_name, emitters):
+    import multiprocessing
+    if len(emitters) == 1:
+        replay(journal_file_name, emitters)
+        return
+    ctx = multiprocessing.get_context('fork')
+    procs = [
+        ctx.Process(target=_render_one, args=(journal_file_name, emitter))
+        for emitter in emitters
+    ]
+    for proc in procs:
+        proc.start()
+    for proc in procs:
+        proc.join()
+    if any(proc.exitcode != 0 for proc in procs):
+        raise Exception('Rendering journal failed')
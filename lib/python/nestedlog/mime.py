@@ -0,0 +1,180 @@
+# Copyright 2021 Stephen Warren <swarren@wwwdotorg.org>
+# SPDX-License-Identifier: MIT
+
+import base64
+import binascii
+import email.header
+import email.utils
+import html
+import nestedlog.data as nld
+import nestedlog.index as nlindex
+import os
+import secrets
+import zlib
+
+# Composes a MIME email containing a log, writing it straight to a binary
+# file object (e.g. sendmail's stdin) as it goes, rather than building the
+# message in memory or in temporary files.
+#
+# The log must have been written as both plain text and HTML with inline
+# styles, with block indices. If the logs together are no larger than
+# max_inline_bytes, they're the body of the email, as alternatives of each
+# other. Otherwise, the body is a summary (the failed blocks' output, and the
+# block tree), and the full logs are attached, compressed with gzip as the
+# email is composed, after the logged command has finished.
+#
+# The body is quoted-printable, so that it's 7-bit clean and has no overlong
+# lines however the logged command wrote its output.
+
+_read_size = 1024 * 1024
+# A multiple of 57 bytes, which base64 encodes into whole 76-character lines.
+_base64_chunk = 57 * 16 * 1024
+
+def _boundary():
+    # Neither quoted-printable nor base64 can produce "=_", so this can't
+    # appear in any part.
+    return '=_nestedlog_' + secrets.token_hex(16)
+
+def _header(name, value):
+    if not value.isascii():
+        value = email.header.Header(value, 'utf-8').encode()
+    return f'{name}: {value}\n'
+
+class _Composer(object):
+    def __init__(self, out):
+        self.out = out
+
+    def write(self, text):
+        self.out.write(text.encode('utf-8'))
+
+    def start_part(self, boundary, content_type, encoding, file_name=None):
+        self.write(f'\n--{boundary}\n')
+        self.write(f'Content-Type: {content_type}\n')
+        self.write(f'Content-Transfer-Encoding: {encoding}\n')
+        if file_name:
+            self.write(f'Content-Disposition: attachment; filename="{file_name}"\n')
+        self.write('\n')
+
+    def end_parts(self, boundary):
+        self.write(f'\n--{boundary}--\n')
+
+    def qp_file(self, file_name):
+        with open(file_name, 'rb') as f:
+            partial = b''
+            while True:
+                data = f.read(_read_size)
+                if not data:
+                    break
+                data = partial + data
+                # Whole lines, so that no line is split between encodings;
+                # any partial line is carried over to the next read. A line
+                # longer than a read is split anyway, and the pieces joined
+                # with a soft line break.
+                end = data.rfind(b'\n') + 1
+                if end:
+                    partial = data[end:]
+                    self.out.write(binascii.b2a_qp(data[:end]))
+                else:
+                    partial = b''
+                    self.out.write(binascii.b2a_qp(data) + b'=\n')
+            self.out.write(binascii.b2a_qp(partial))
+
+    def qp_text(self, text):
+        self.out.write(binascii.b2a_qp(text.encode('utf-8')))
+
+    def gzip_base64_file(self, file_name):
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        pending = bytearray()
+        with open(file_name, 'rb') as f:
+            while True:
+                data = f.read(_read_size)
+                if not data:
+                    break
+                pending += compressor.compress(data)
+                if len(pending) >= _base64_chunk:
+                    whole = len(pending) - len(pending) % 57
+                    self.out.write(base64.encodebytes(pending[:whole]))
+                    del pending[:whole]
+        pending += compressor.flush()
+        self.out.write(base64.encodebytes(pending))
+
+def _block_paths(blocks):
+    paths = {}
+    for block in blocks:
+        parent = block['parent']
+        if parent in paths:
+            paths[block['id']] = paths[parent] + ' / ' + block['name']
+        else:
+            paths[block['id']] = block['name']
+    return paths
+
+# Builds the summary that replaces logs too large to include: the end of each
+# failed block's output (at most max_block_bytes of it), then the block tree.
+def summary(text_file_name, max_block_bytes):
+    blocks = nlindex.read(text_file_name)
+    paths = _block_paths(blocks)
+    lines = ['The full logs are too large to include, so are attached.\n']
+    failed = nlindex.failed_blocks(blocks)
+    if failed:
+        lines.append('\nFailed blocks:\n')
+        with open(text_file_name, 'rb') as f:
+            for block in failed:
+                lines.append(f'\n{paths[block["id"]]}:\n')
+                start = block['start']
+                if block['end'] - start > max_block_bytes:
+                    start = block['end'] - max_block_bytes
+                    lines.append(f'[nestedlog: {start - block["start"]} bytes elided]\n')
+                f.seek(start)
+                lines.append(str(f.read(block['end'] - start), 'utf-8', 'replace'))
+    lines.append('\nBlocks:\n')
+    for block in blocks:
+        footer_text = block['status'].capitalize()
+        stats_text = nld.format_block_stats(block)
+        if stats_text:
+            footer_text += ', ' + stats_text
+        lines.append(f'{"  " * block["depth"]}{block["name"]} ({footer_text})\n')
+    return ''.join(lines)
+
+def _summary_html(text):
+    return (
+        '<html><head></head>' +
+        '<body style="margin:0;border:0;padding:1em;background-color:black;color:#fff">' +
+        f'<pre style="margin:0;border:0">{html.escape(text)}</pre></body></html>\n'
+    )
+
+def compose(out, from_addr, to_addrs, subject, text_file_name, html_file_name,
+        max_inline_bytes=1024 * 1024, max_block_bytes=64 * 1024):
+    composer = _Composer(out)
+    composer.write(_header('Date', email.utils.formatdate(localtime=True)))
+    composer.write(_header('Message-ID', email.utils.make_msgid('nestedlog')))
+    composer.write(_header('From', f'<{from_addr}>'))
+    composer.write(_header('To', ', '.join(f'<{to_addr}>' for to_addr in to_addrs)))
+    composer.write(_header('Subject', subject))
+    composer.write('MIME-Version: 1.0\n')
+
+    log_size = os.path.getsize(text_file_name) + os.path.getsize(html_file_name)
+    alternative = _boundary()
+    if log_size <= max_inline_bytes:
+        composer.write(f'Content-Type: multipart/alternative; boundary="{alternative}"\n')
+        composer.start_part(alternative, 'text/plain; charset=utf-8', 'quoted-printable')
+        composer.qp_file(text_file_name)
+        composer.start_part(alternative, 'text/html; charset=utf-8', 'quoted-printable')
+        composer.qp_file(html_file_name)
+        composer.end_parts(alternative)
+        return
+
+    summary_text = summary(text_file_name, max_block_bytes)
+    mixed = _boundary()
+    composer.write(f'Content-Type: multipart/mixed; boundary="{mixed}"\n')
+    composer.write(f'\n--{mixed}\n')
+    composer.write(f'Content-Type: multipart/alternative; boundary="{alternative}"\n')
+    composer.start_part(alternative, 'text/plain; charset=utf-8', 'quoted-printable')
+    composer.qp_text(summary_text)
+    composer.start_part(alternative, 'text/html; charset=utf-8', 'quoted-printable')
+    composer.qp_text(_summary_html(summary_text))
+    composer.end_parts(alternative)
+    composer.start_part(mixed, 'application/gzip', 'base64', 'log.txt.gz')
+    composer.gzip_base64_file(text_file_name)
+    composer.start_part(mixed, 'application/gzip', 'base64', 'log.html.gz')
+    composer.gzip_base64_file(html_file_name)
+    composer.end_parts(mixed)
@@ -0,0 +1,191 @@
+# Copyright 2021 Stephen Warren <swarren@wwwdotorg.org>
+# SPDX-License-Identifier: MIT
+
+import nestedlog.api as nlapi
+import nestedlog.data as nld
+import nestedlog.rusage as nlrusage
+import os
+import selectors
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+_record_header = struct.Struct('<BI')
+
+# A command's captured output; a list of (stream, data) records. The records
+# are held in memory until they exceed spill_threshold bytes, and are then
+# moved to a temporary file.
+class _Output(object):
+    def __init__(self, spill_threshold):
+        self.spill_threshold = spill_threshold
+        self.records = []
+        self.size = 0
+        self.spill_file = None
+
+    def append(self, stream, data):
+        self.size += len(data)
+        if self.spill_file is None:
+            self.records.append((stream, data))
+            if self.size > self.spill_threshold:
+                self.spill_file = tempfile.TemporaryFile()
+                for stream, data in self.records:
+                    self._spill(stream, data)
+                self.records = None
+        else:
+            self._spill(stream, data)
+
+    def _spill(self, stream, data):
+        self.spill_file.write(_record_header.pack(stream, len(data)))
+        self.spill_file.write(data)
+
+    def __iter__(self):
+        if self.spill_file is None:
+            yield from self.records
+            return
+        self.spill_file.seek(0)
+        while True:
+            header = self.spill_file.read(_record_header.size)
+            if not header:
+                break
+            stream, size = _record_header.unpack(header)
+            yield stream, self.spill_file.read(size)
+
+    def close(self):
+        if self.spill_file is not None:
+            self.spill_file.close()
+
+class _Job(object):
+    def __init__(self, block_name, cmd, spill_threshold):
+        self.block_name = block_name
+        self.cmd = cmd
+        self.output = _Output(spill_threshold)
+        self.sp = None
+        self.open_fds = 0
+        self.rusage = None
+        self.launch_error = None
+        self.finished = False
+
+    # Returns whether the command was started. If it couldn't be, the job is
+    # finished, and its block records why.
+    def start(self, selector):
+        self.start_time = time.monotonic()
+        try:
+            self.sp = subprocess.Popen(
+                self.cmd, shell=isinstance(self.cmd, str), stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        except (OSError, subprocess.SubprocessError, ValueError) as e:
+            self.launch_error = e
+            self.finished = True
+            return False
+        for f, stream in ((self.sp.stdout, nld.STREAM_STDOUT), (self.sp.stderr, nld.STREAM_STDERR)):
+            selector.register(f, selectors.EVENT_READ, (self, stream))
+            self.open_fds += 1
+        return True
+
+    # Stops a command that is still running, e.g. because another job's
+    # block couldn't be written to the log.
+    def kill(self):
+        self.sp.kill()
+        self.sp.wait()
+        self.sp.stdout.close()
+        self.sp.stderr.close()
+        self.output.close()
+
+    def try_reap(self):
+        pid, wait_status, ru = os.wait4(self.sp.pid, os.WNOHANG)
+        if pid == 0:
+            return False
+        self.sp.returncode = nlrusage.exit_code(wait_status)
+        self.rusage = nlrusage.from_struct_rusage(ru)
+        # The block is only open in the log while its output is spliced in,
+        # so report how long the command actually ran for.
+        self.rusage['duration'] = time.monotonic() - self.start_time
+        self.finished = True
+        return True
+
+    def splice(self):
+        # Replay the captured output into the log, inside its own block.
+        nlapi.start_block(self.block_name)
+        outputs = {nld.STREAM_STDOUT: sys.stdout.buffer, nld.STREAM_STDERR: sys.stderr.buffer}
+        for stream, data in self.output:
+            outputs[stream].write(data)
+            outputs[stream].flush()
+        self.output.close()
+        if self.launch_error is not None:
+            print(f'ERROR: Failed to run command: {self.launch_error}', file=sys.stderr)
+            status = nld.STATUS_ERROR
+        elif self.sp.returncode != 0:
+            print('ERROR: Process exit code ' + str(self.sp.returncode), file=sys.stderr)
+            status = nld.STATUS_ERROR
+        else:
+            status = nld.STATUS_AUTO
+        nlapi.end_block(status, self.rusage)
+        if status == nld.STATUS_AUTO:
+            return nld.STATUS_OK
+        return status
+
+# Runs several commands at once, each in its own block. Each command's output
+# is captured separately, and once each command has completed, its block is
+# written to the log in the order the commands were given, so the log
+# structure is the same as if the commands had been run one after another.
+#
+# blocks is a list of (block_name, cmd) tuples; cmd is either an argument
+# list, or a string that is run using the shell. At most jobs commands are run
+# at once; by default, one per CPU. Returns the worst status of all blocks.
+def run_parallel_blocks(blocks, jobs=None, spill_threshold=16 * 1024 * 1024):
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    pending = [_Job(block_name, cmd, spill_threshold) for (block_name, cmd) in blocks]
+    to_splice = list(pending)
+    running = []
+    exiting = []
+    worst_status = nld.STATUS_OK
+
+    try:
+        with selectors.DefaultSelector() as selector:
+            while to_splice:
+                while pending and len(running) < jobs:
+                    job = pending.pop(0)
+                    if job.start(selector):
+                        running.append(job)
+
+                while to_splice and to_splice[0].finished:
+                    status = to_splice.pop(0).splice()
+                    if status > worst_status:
+                        worst_status = status
+                if not running:
+                    continue
+
+                # A command that has closed its output but not exited yet
+                # needs to be polled for its exit.
+                if exiting:
+                    timeout = 0.01
+                else:
+                    timeout = None
+                events = selector.select(timeout)
+                for key, mask in events:
+                    job, stream = key.data
+                    data = os.read(key.fd, 65536)
+                    if data:
+                        job.output.append(stream, data)
+                        continue
+                    selector.unregister(key.fileobj)
+                    key.fileobj.close()
+                    job.open_fds -= 1
+                    if not job.open_fds:
+                        exiting.append(job)
+                for job in list(exiting):
+                    if job.try_reap():
+                        exiting.remove(job)
+                        running.remove(job)
+    finally:
+        # Jobs are only left over if an exception is propagating; don't leave
+        # their commands running, or their output behind.
+        for job in running:
+            job.kill()
+        for job in to_splice:
+            job.output.close()
+
+    return worst_status
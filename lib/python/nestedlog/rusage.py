@@ -0,0 +1,116 @@
+# Copyright 2021 Stephen Warren <swarren@wwwdotorg.org>
+# SPDX-License-Identifier: MIT
+
+import os
+import resource
+
+# Resource usage is represented as a dict containing some of:
+#   utime: user CPU time, in seconds.
+#   stime: system CPU time, in seconds.
+#   duration: wall-clock time, in seconds. This overrides the time for which
+#       the block was open in the log, e.g. for blocks that were run elsewhere
+#       and then added to the log all at once.
+
+_clk_tck = os.sysconf('SC_CLK_TCK')
+
+# Peak RSS isn't recorded. A child's ru_maxrss includes the time before it
+# exec'd the command, when it was a copy of the (Python) process that forked
+# it, so it's never less than that process's own RSS; and RUSAGE_CHILDREN's
+# is a maximum over the process's lifetime, so has no per-block delta.
+def from_struct_rusage(ru):
+    return {'utime': ru.ru_utime, 'stime': ru.ru_stime}
+
+# Converts a wait status from os.wait4() to a return code, as subprocess
+# reports it. os.waitstatus_to_exitcode() needs Python 3.9.
+def exit_code(wait_status):
+    if os.WIFSIGNALED(wait_status):
+        return -os.WTERMSIG(wait_status)
+    return os.WEXITSTATUS(wait_status)
+
+# CPU time consumed so far by this process and its reaped children.
+def self_and_children():
+    ru_self = resource.getrusage(resource.RUSAGE_SELF)
+    ru_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return {
+        'utime': ru_self.ru_utime + ru_children.ru_utime,
+        'stime': ru_self.ru_stime + ru_children.ru_stime,
+    }
+
+def _proc_stat(pid):
+    with open(f'/proc/{pid}/stat', 'rt') as f:
+        stat = f.read()
+    # The command name may contain spaces and parentheses, so skip past it.
+    # The remaining fields start at field 3 (state).
+    return stat[stat.rindex(')') + 2:].split()
+
+def _cpu(fields, first):
+    return {
+        'utime': int(fields[first]) / _clk_tck,
+        'stime': int(fields[first + 1]) / _clk_tck,
+    }
+
+# Measures the CPU time consumed by the reaped children of control clients'
+# parents, i.e. the RUSAGE_CHILDREN of e.g. the shell script that ran
+# "nestedlog start-block" and "nestedlog end-block", for blocks whose clients
+# don't report their own usage.
+#
+# The control clients are themselves children of that parent, so once each
+# has exited, its own CPU time is subtracted from later snapshots of its
+# parent's counters.
+class ControlClients(object):
+    def __init__(self):
+        # Per client PID: (parent PID, the client's CPU time).
+        self.clients = {}
+        # Per parent PID: total CPU time of its clients that have exited.
+        self.exited = {}
+
+    # Returns a snapshot of the counters of client pid's parent, or None if
+    # this can't be determined.
+    def snapshot(self, pid):
+        try:
+            fields = _proc_stat(pid)
+            ppid = int(fields[1])
+            parent_fields = _proc_stat(ppid)
+        except (OSError, ValueError, IndexError):
+            return None
+        self.clients[pid] = (ppid, _cpu(fields, 11))
+        rusage = _cpu(parent_fields, 13)
+        exited = self.exited.get(ppid)
+        if exited:
+            rusage = delta(rusage, exited)
+        return rusage
+
+    # Called when client pid closes its connection, which it does as it
+    # exits.
+    def client_exited(self, pid):
+        if pid not in self.clients:
+            return
+        ppid, cpu = self.clients.pop(pid)
+        # Until it's reaped, the client's final CPU time is still available.
+        try:
+            fields = _proc_stat(pid)
+            if int(fields[1]) == ppid:
+                cpu = _cpu(fields, 11)
+        except (OSError, ValueError, IndexError):
+            pass
+        exited = self.exited.setdefault(ppid, {'utime': 0.0, 'stime': 0.0})
+        for key in exited:
+            exited[key] += cpu[key]
+
+# Counters sampled in clock ticks may appear to go backwards slightly.
+def delta(end, start):
+    return {key: max(end[key] - start[key], 0.0) for key in ('utime', 'stime')}
+
+# Control protocol encoding, e.g. "utime=1.5 stime=0.25".
+def to_args(rusage):
+    return ' '.join(f'{key}={value}' for (key, value) in rusage.items())
+
+def from_args(args):
+    rusage = {}
+    for arg in args:
+        key, value = arg.split('=', 1)
+        if key in ('utime', 'stime', 'duration'):
+            rusage[key] = float(value)
+        else:
+            raise Exception(f'Unknown resource usage field "{key}"')
+    return rusage
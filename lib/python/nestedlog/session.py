@@ -0,0 +1,215 @@
+# Copyright 2021 Stephen Warren <swarren@wwwdotorg.org>
+# SPDX-License-Identifier: MIT
+
+import io
+import nestedlog.api as nlapi
+import nestedlog.data as nld
+import nestedlog.framing as nlframing
+import nestedlog.rusage as nlrusage
+import nestedlog.sink as nlsink
+import os
+import select
+import selectors
+import subprocess
+import sys
+import threading
+import traceback
+
+# Replaces sys.stdout/sys.stderr, and sends everything written to the Sink.
+class _StreamWriter(io.TextIOBase):
+    def __init__(self, session, stream):
+        self.session = session
+        self.stream = stream
+
+    @property
+    def encoding(self):
+        return 'utf-8'
+
+    def writable(self):
+        return True
+
+    def write(self, s):
+        if s:
+            with self.session.lock:
+                self.session.sink.stream_data(self.stream, s)
+        return len(s)
+
+# Generates a nested log from within the calling Python process, without
+# nestedlog-helper or the control socket. Output written to sys.stdout and
+# sys.stderr is captured. If capture_fds is set, file descriptors 1 and 2 are
+# redirected to pipes instead, so that output from child processes and
+# non-Python code is captured too.
+#
+# The Session provides the same block operations as nestedlog.api:
+#
+#     with nestedlog.Session(emitters) as session:
+#         with session.run_python_as_block('some block'):
+#             print('Text that will show up in the block')
+class Session(object):
+    def __init__(self, emitters, block_name=None, capture_fds=False, slowest_blocks=0, filters=()):
+        if block_name is None:
+            block_name = ' '.join(sys.argv)
+        self.emitters = emitters
+        self.block_name = block_name
+        self.capture_fds = capture_fds
+        self.slowest_blocks = slowest_blocks
+        self.filters = filters
+        self.lock = threading.RLock()
+        self.sink = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        status = nld.STATUS_AUTO
+        if exc_type is not None and not issubclass(exc_type, nlapi.BlockFailedException):
+            print('ERROR: Exception thrown:', file=sys.stderr)
+            traceback.print_exception(exc_type, exc_value, exc_tb, file=sys.stderr)
+            status = nld.STATUS_ERROR
+        self.close(status)
+        return False
+
+    def start(self):
+        self.sink = nlsink.Sink(self.emitters, self.slowest_blocks, self.filters)
+        self.sink.start_log()
+        self.sink.start_block(self.block_name, nlrusage.self_and_children())
+        self.saved_streams = (sys.stdout, sys.stderr)
+        if self.capture_fds:
+            self._start_fd_capture()
+        else:
+            sys.stdout = _StreamWriter(self, nld.STREAM_STDOUT)
+            sys.stderr = _StreamWriter(self, nld.STREAM_STDERR)
+
+    # Returns the status of the session's top-level block.
+    def close(self, status=nld.STATUS_AUTO):
+        self._sync()
+        if self.capture_fds:
+            self._stop_fd_capture()
+        else:
+            sys.stdout, sys.stderr = self.saved_streams
+        with self.lock:
+            status = self.sink.end_block(status, nlrusage.self_and_children(), True)
+            self.sink.end_log()
+        return status
+
+    def _start_fd_capture(self):
+        sys.stdout.flush()
+        sys.stderr.flush()
+        self.saved_fds = {}
+        self.capture_rfds = {}
+        self.decoders = {}
+        for fd, stream in ((1, nld.STREAM_STDOUT), (2, nld.STREAM_STDERR)):
+            self.saved_fds[fd] = os.dup(fd)
+            rfd, wfd = os.pipe()
+            os.dup2(wfd, fd)
+            os.close(wfd)
+            os.set_blocking(rfd, False)
+            self.capture_rfds[rfd] = stream
+            self.decoders[rfd] = nlframing.StreamDecoder(self.sink, stream)
+        self.wake_rfd, self.wake_wfd = os.pipe()
+        self.reader = threading.Thread(target=self._reader, name='nestedlog-session', daemon=True)
+        self.reader.start()
+
+    def _stop_fd_capture(self):
+        for fd, saved_fd in self.saved_fds.items():
+            os.dup2(saved_fd, fd)
+            os.close(saved_fd)
+        os.write(self.wake_wfd, b'\x00')
+        self.reader.join()
+        self._drain_fds()
+        for rfd, decoder in self.decoders.items():
+            decoder.flush()
+            os.close(rfd)
+        os.close(self.wake_rfd)
+        os.close(self.wake_wfd)
+
+    def _reader(self):
+        poller = select.poll()
+        for rfd in self.capture_rfds:
+            poller.register(rfd, select.POLLIN)
+        poller.register(self.wake_rfd, select.POLLIN)
+        while True:
+            events = poller.poll()
+            if any(fd == self.wake_rfd for (fd, event) in events):
+                return
+            for fd, event in events:
+                if event & select.POLLHUP and not event & select.POLLIN:
+                    poller.unregister(fd)
+            self._drain_fds()
+
+    # Reads everything that has been written to the captured fds so far.
+    def _drain_fds(self):
+        with self.lock:
+            for rfd, decoder in self.decoders.items():
+                while True:
+                    try:
+                        data = os.read(rfd, 65536)
+                    except BlockingIOError:
+                        break
+                    if not data:
+                        break
+                    decoder.feed(data)
+
+    # Ensures all output written so far is in the log, so that it's recorded
+    # in the correct block.
+    def _sync(self):
+        sys.stdout.flush()
+        sys.stderr.flush()
+        if self.capture_fds:
+            self._drain_fds()
+
+    def start_block(self, block_name):
+        self._sync()
+        with self.lock:
+            self.sink.start_block(block_name)
+
+    def end_block(self, status, rusage=None):
+        if status in nld.status_to_text:
+            pass
+        elif status in nld.text_to_status:
+            status = nld.text_to_status[status]
+        else:
+            raise Exception('Invalid status ' + str(status))
+        self._sync()
+        with self.lock:
+            self.sink.end_block(status, rusage)
+
+    def run_python_as_block(self, block_name):
+        return nlapi._python_block(self, block_name)
+
+    def run_as_block(self, block_name, cmd):
+        with self.run_python_as_block(block_name) as block:
+            if self.capture_fds:
+                # The command inherits the captured fds.
+                sp = subprocess.Popen(cmd)
+            else:
+                sp = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                self._pump(sp)
+            pid, wait_status, ru = os.wait4(sp.pid, 0)
+            sp.returncode = nlrusage.exit_code(wait_status)
+            block['rusage'] = nlrusage.from_struct_rusage(ru)
+            if sp.returncode != 0:
+                print('ERROR: Process exit code ' + str(sp.returncode), file=sys.stderr)
+                raise nlapi.MarkBlockAsFailedException()
+
+    # Copies a child process's output into the log until it closes its
+    # stdout and stderr.
+    def _pump(self, sp):
+        decoders = {
+            sp.stdout: nlframing.StreamDecoder(self.sink, nld.STREAM_STDOUT),
+            sp.stderr: nlframing.StreamDecoder(self.sink, nld.STREAM_STDERR),
+        }
+        with selectors.DefaultSelector() as selector:
+            for f in decoders:
+                selector.register(f, selectors.EVENT_READ)
+            while selector.get_map():
+                for key, mask in selector.select():
+                    data = os.read(key.fd, 65536)
+                    with self.lock:
+                        if data:
+                            decoders[key.fileobj].feed(data)
+                            continue
+                        decoders[key.fileobj].flush()
+                    selector.unregister(key.fileobj)
+                    key.fileobj.close()
@@ -1,18 +1,47 @@
 # Copyright 2021 Stephen Warren <swarren@wwwdotorg.org>
 # SPDX-License-Identifier: MIT
 
+import heapq
 import html
 import nestedlog.data as nld
+import nestedlog.emitter_base as nlebase
+import nestedlog.rusage as nlrusage
+import time
 
+# Filters transform stream data before it reaches the emitters, and may hold
+# data back, e.g. to decide later what to do with it. Each filter provides:
+#   filter_start_log(), filter_end_log()
+#   filter_start_block(), filter_end_block(): called after a block is opened,
+#       and after it is closed.
+#   filter_stream_data(stream, data): returns a list of (stream, data) to pass
+#       on to the next filter.
+#   filter_flush(): returns a list of (stream, data) holding everything that
+#       has been held back. Called before each block starts or ends, so that
+#       data stays within the block it was written in.
+#
+# digest optionally provides a nestedlog.digest.Digest, which is fed the
+# output as it arrives, before the filters. Its hits are passed to each emitter's
+# emit_digest() just before emit_end_log().
+#
+# Chunks of output are only given the time they were received if an emitter
+# sets wants_time, since time.time() is a significant part of the cost of
+# each chunk.
 class Sink(object):
-    def __init__(self, emitters):
+    def __init__(self, emitters, slowest_blocks=0, filters=(), digest=None):
         self.emitters = emitters
+        self.slowest_blocks = slowest_blocks
+        self.filters = filters
+        self.digest = digest
+        self.wants_time = any(getattr(emitter, 'wants_time', False) for emitter in emitters)
 
         self.blocks = []
         self.block_id = 0
         self.cur_stream = None
+        self.slowest = []
 
     def start_log(self):
+        for filter in self.filters:
+            filter.filter_start_log()
         for emitter in self.emitters:
             emitter.emit_start_log()
 
@@ -20,32 +49,105 @@ class Sink(object):
         while self.blocks:
             self.stream_data(nld.STREAM_STDERR, 'nestedlog: Unclosed block')
             self.end_block(nld.STATUS_ERROR)
+        # Don't let the digest record the slowest blocks summary.
+        digest = self.digest
+        self.digest = None
+        if self.slowest:
+            self._emit_slowest_blocks()
+        for filter in self.filters:
+            filter.filter_end_log()
+        if digest:
+            for emitter in self.emitters:
+                emitter.emit_digest(digest.hits, digest.dropped)
         for emitter in self.emitters:
             emitter.emit_end_log()
 
-    def start_block(self, block_name):
+    def _emit_slowest_blocks(self):
+        slowest = sorted(self.slowest, reverse=True)
+        # Don't let the summary block record itself.
+        self.slowest_blocks = 0
+        self.slowest = []
+        lines = [f'{"Duration":>12}  Block\n']
+        for duration, block_id, path in slowest:
+            lines.append(f'{nld.format_duration(duration):>12}  {path}\n')
+        self.start_block('nestedlog: Slowest blocks')
+        self._stream_data(nld.STREAM_STDOUT, ''.join(lines))
+        self.end_block(nld.STATUS_OK)
+
+    # rusage_base optionally provides a snapshot of cumulative resource usage
+    # counters at the start of the block. If end_block() is given a snapshot
+    # of the same counters, the block's usage is the difference.
+    def start_block(self, block_name, rusage_base=None):
+        if self.filters:
+            self._flush_filters()
         if self.cur_stream is not None:
             self.end_stream(False)
         self.block_id += 1
-        block_context = {'status': nld.STATUS_OK}
+        block_context = {
+            'id': self.block_id,
+            'name': block_name,
+            'status': nld.STATUS_OK,
+            'min_status': nld.STATUS_OK,
+            'start_time': time.monotonic(),
+            'rusage_base': rusage_base,
+        }
         self.blocks.append(block_context)
         for emitter in self.emitters:
             emitter.emit_start_block(self.block_id, block_name)
+        if self.digest:
+            self.digest.start_block(self.block_id, block_name)
+        for filter in self.filters:
+            filter.filter_start_block()
 
-    def end_block(self, status):
+    # rusage optionally reports the block's resource usage, or if
+    # rusage_is_snapshot, a snapshot of the counters passed to start_block().
+    def end_block(self, status, rusage=None, rusage_is_snapshot=False):
+        if self.filters:
+            self._flush_filters()
         if status == nld.STATUS_AUTO:
             status = self.blocks[-1]['status']
         if self.cur_stream is not None:
             self.end_stream(False)
         block_context = self.blocks.pop()
+        if self.digest:
+            self.digest.end_block()
+        if status < block_context['min_status']:
+            status = block_context['min_status']
+        stats = {'duration': time.monotonic() - block_context['start_time']}
+        if rusage_is_snapshot:
+            if rusage and block_context['rusage_base']:
+                stats.update(nlrusage.delta(rusage, block_context['rusage_base']))
+        elif rusage:
+            stats.update(rusage)
         for emitter in self.emitters:
-            emitter.emit_end_block(status)
+            emitter.emit_end_block(status, stats)
+        for filter in self.filters:
+            filter.filter_end_block()
+        if self.slowest_blocks:
+            self._record_slowest_block(block_context, stats['duration'])
         if self.blocks:
             cur_status = self.blocks[-1]['status']
             if status > cur_status:
                 self.blocks[-1]['status'] = status
         return status
 
+    def _record_slowest_block(self, block_context, duration):
+        path = ' / '.join([b['name'] for b in self.blocks] + [block_context['name']])
+        entry = (duration, block_context['id'], path)
+        if len(self.slowest) < self.slowest_blocks:
+            heapq.heappush(self.slowest, entry)
+        elif entry > self.slowest[0]:
+            heapq.heapreplace(self.slowest, entry)
+
+    # Ensures the current block's status is at least status, even if the block
+    # is ended with an explicit, lower, status.
+    def raise_status(self, status):
+        block_context = self.blocks[-1]
+        if status > block_context['status']:
+            block_context['status'] = status
+        if status > block_context['min_status']:
+            block_context['min_status'] = status
+
     def start_stream(self, stream, switching):
         block_context = self.blocks[-1]
         for emitter in self.emitters:
@@ -59,6 +161,37 @@ class Sink(object):
         self.cur_stream = None
 
     def stream_data(self, stream, data):
+        if self.digest:
+            self.digest.feed(stream, data)
+        if self.filters:
+            for stream, data in self._run_filters([(stream, data)], 0):
+                self._stream_data(stream, data)
+        else:
+            self._stream_data(stream, data)
+
+    # Emits text that nestedlog itself adds to the output, bypassing the
+    # filters. Anything the filters are holding back is emitted first.
+    def annotate(self, stream, text):
+        if self.filters:
+            self._flush_filters()
+        self._stream_data(stream, text)
+
+    # Passes data through the filters from index first onwards.
+    def _run_filters(self, items, first):
+        for filter in self.filters[first:]:
+            items = [
+                out_item
+                for (stream, data) in items
+                for out_item in filter.filter_stream_data(stream, data)
+            ]
+        return items
+
+    def _flush_filters(self):
+        for i, filter in enumerate(self.filters):
+            for stream, data in self._run_filters(filter.filter_flush(), i + 1):
+                self._stream_data(stream, data)
+
+    def _stream_data(self, stream, data):
         block_context = self.blocks[-1]
         if stream != self.cur_stream:
             if self.cur_stream is not None:
@@ -67,5 +200,6 @@ class Sink(object):
             else:
                 switching = False
             self.start_stream(stream, switching)
+        chunk = nlebase.Chunk(data, time.time() if self.wants_time else None)
         for emitter in self.emitters:
-            emitter.emit_stream_data(data)
+            emitter.emit_stream_data(chunk)
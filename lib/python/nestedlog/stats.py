@@ -0,0 +1,143 @@
+# Copyright 2021 Stephen Warren <swarren@wwwdotorg.org>
+# SPDX-License-Identifier: MIT
+
+import json
+import nestedlog.data as nld
+import resource
+import time
+
+_stream_names = {
+    nld.STREAM_STDOUT: 'stdout',
+    nld.STREAM_STDERR: 'stderr',
+}
+
+# Measures the time spent in each of an emitter's methods.
+class TimedEmitter(object):
+    def __init__(self, emitter):
+        self.emitter = emitter
+        self.wants_time = getattr(emitter, 'wants_time', False)
+        self.times = {}
+
+    def _timed(self, name, func, *args):
+        start = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            elapsed = time.perf_counter() - start
+            calls, seconds = self.times.get(name, (0, 0.0))
+            self.times[name] = (calls + 1, seconds + elapsed)
+
+    def emit_start_log(self):
+        self._timed('emit_start_log', self.emitter.emit_start_log)
+
+    def emit_end_log(self):
+        self._timed('emit_end_log', self.emitter.emit_end_log)
+
+    def emit_digest(self, hits, dropped):
+        self._timed('emit_digest', self.emitter.emit_digest, hits, dropped)
+
+    def emit_start_block(self, block_id, block_name):
+        self._timed('emit_start_block', self.emitter.emit_start_block, block_id, block_name)
+
+    def emit_end_block(self, status, stats):
+        self._timed('emit_end_block', self.emitter.emit_end_block, status, stats)
+
+    def emit_start_stream(self, stream, switching):
+        self._timed('emit_start_stream', self.emitter.emit_start_stream, stream, switching)
+
+    def emit_end_stream(self, switching):
+        self._timed('emit_end_stream', self.emitter.emit_end_stream, switching)
+
+    def emit_stream_data(self, chunk):
+        self._timed('emit_stream_data', self.emitter.emit_stream_data, chunk)
+
+    def to_dict(self):
+        emitter = self.emitter
+        file_name = (
+            getattr(emitter, 'log_file_name', None) or
+            getattr(emitter, 'log_dir_name', None) or
+            getattr(emitter, 'journal_file_name', None)
+        )
+        return {
+            'emitter': type(emitter).__module__,
+            'file': file_name,
+            'seconds': sum(seconds for (calls, seconds) in self.times.values()),
+            'methods': {
+                name: {'calls': calls, 'seconds': seconds}
+                for (name, (calls, seconds)) in sorted(self.times.items())
+            },
+        }
+
+# Counters describing nestedlog's own overhead while capturing a log. These
+# are updated directly by gen_log(), and are cheap enough to always enable.
+class Stats(object):
+    def __init__(self):
+        self.start_time = time.monotonic()
+        self.stream_bytes = {stream: 0 for stream in _stream_names}
+        self.stream_frames = {stream: 0 for stream in _stream_names}
+        self.control_commands = 0
+        self.control_latency_total = 0.0
+        self.control_latency_max = 0.0
+        self.wakeups = 0
+        self.reads = 0
+        self.read_bytes = 0
+        self.frame_backlog_peak = 0
+        # Version of the nestedlog-helper protocol in use, once known.
+        self.helper_protocol = None
+        self.timed_emitters = []
+
+    def wrap_emitter(self, emitter):
+        timed = TimedEmitter(emitter)
+        self.timed_emitters.append(timed)
+        return timed
+
+    def stream_frame(self, stream, count):
+        self.stream_bytes[stream] += count
+        self.stream_frames[stream] += 1
+
+    def control_command(self, latency):
+        self.control_commands += 1
+        self.control_latency_total += latency
+        if latency > self.control_latency_max:
+            self.control_latency_max = latency
+
+    def to_dict(self):
+        if self.control_commands:
+            latency_avg = self.control_latency_total / self.control_commands
+        else:
+            latency_avg = 0.0
+        if self.reads:
+            bytes_per_read = self.read_bytes / self.reads
+        else:
+            bytes_per_read = 0.0
+        return {
+            'elapsed': time.monotonic() - self.start_time,
+            'streams': {
+                name: {
+                    'bytes': self.stream_bytes[stream],
+                    'frames': self.stream_frames[stream],
+                }
+                for (stream, name) in _stream_names.items()
+            },
+            'control': {
+                'commands': self.control_commands,
+                'latency_avg': latency_avg,
+                'latency_max': self.control_latency_max,
+            },
+            'poll': {
+                'wakeups': self.wakeups,
+                'reads': self.reads,
+                'bytes': self.read_bytes,
+                'bytes_per_read': bytes_per_read,
+            },
+            'frame_backlog_peak': self.frame_backlog_peak,
+            'helper_protocol': self.helper_protocol,
+            # Peak RSS of nestedlog itself, in KiB.
+            'maxrss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            'emitters': [timed.to_dict() for timed in self.timed_emitters],
+        }
+
+    def write(self, file_name):
+        with open(file_name, 'wt') as f:
+            json.dump(self.to_dict(), f, indent=4)
+            f.write('\n')
@@ -0,0 +1,78 @@
+# Copyright 2021 Stephen Warren <swarren@wwwdotorg.org>
+# SPDX-License-Identifier: MIT
+
+import nestedlog.data as nld
+import os
+
+# Notices when the logged command has produced no output and sent no control
+# commands for a while, and records that in the current block, so that a hung
+# command shows where it hung.
+#
+# gen_log() passes timeout to poll(), and calls stalled() each time poll()
+# times out, or active() the first time it doesn't after a stall; while data
+# is flowing, the watchdog costs nothing. After the first marker, further
+# markers are recorded each time the stall's length doubles.
+#
+# process_tree additionally records the logged command's process tree with
+# each marker. status, if set, raises the status of each block that stalls.
+class Watchdog(object):
+    def __init__(self, interval, process_tree=False, status=None):
+        self.interval = interval
+        self.process_tree = process_tree
+        self.status = status
+        self.timeout = interval
+        self.stalled_for = 0.0
+
+    def stalled(self, sink, pid):
+        self.stalled_for += self.timeout
+        self.timeout = self.stalled_for
+        text = f'\n[nestedlog: no output or control commands for {nld.format_duration(self.stalled_for)}]\n'
+        if self.process_tree:
+            text += ''.join(process_tree(pid))
+        sink.annotate(nld.STREAM_STDERR, text)
+        if self.status is not None:
+            sink.raise_status(self.status)
+
+    def active(self):
+        self.stalled_for = 0.0
+        self.timeout = self.interval
+
+def _read_proc(pid, name):
+    with open(f'/proc/{pid}/{name}', 'rb') as f:
+        return f.read()
+
+# Yields a line for each process in the tree rooted at pid, indented by depth:
+# the PID, state, kernel function the process is waiting in, and command line.
+def process_tree(pid):
+    children = {}
+    procs = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            stat = str(_read_proc(entry, 'stat'), 'utf-8', 'replace')
+        except OSError:
+            continue
+        # The command name may contain spaces and parentheses, so skip past it.
+        comm = stat[stat.index('(') + 1:stat.rindex(')')]
+        fields = stat[stat.rindex(')') + 2:].split()
+        child_pid = int(entry)
+        procs[child_pid] = (comm, fields[0])
+        children.setdefault(int(fields[1]), []).append(child_pid)
+    stack = [(pid, 0)]
+    while stack:
+        pid, depth = stack.pop()
+        if pid not in procs:
+            continue
+        comm, state = procs[pid]
+        try:
+            cmdline = str(_read_proc(pid, 'cmdline'), 'utf-8', 'replace').rstrip('\0').replace('\0', ' ')
+            wchan = str(_read_proc(pid, 'wchan'), 'utf-8', 'replace')
+        except OSError:
+            cmdline = ''
+            wchan = ''
+        if wchan in ('', '0'):
+            wchan = '-'
+        yield f'{"  " * depth}{pid} {state} {wchan} {cmdline or "[" + comm + "]"}\n'
+        for child_pid in sorted(children.get(pid, ()), reverse=True):
+            stack.append((child_pid, depth + 1))
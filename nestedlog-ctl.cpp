@@ -0,0 +1,108 @@
+// Copyright 2021 Stephen Warren <swarren@wwwdotorg.org>
+// SPDX-License-Identifier: MIT
+
+// A minimal client for the nestedlog control socket. This implements the
+// same start-block and end-block commands as "nestedlog start-block" and
+// "nestedlog end-block", but without the cost of starting Python for each
+// command, which dominates scripts that create many blocks.
+
+#include <cerrno>
+#include <cstdio>
+#include <cstdlib>
+#include <cstring>
+#include <string>
+#include <sys/socket.h>
+#include <sys/un.h>
+#include <termios.h>
+#include <unistd.h>
+
+static const char *sock_env_var = "NESTED_LOG_CONTROL";
+static const char *capture_env_var = "NESTED_LOG_CAPTURE";
+
+static int usage(const char *argv0) {
+    fprintf(stderr,
+        "usage: %s start-block block_name\n"
+        "       %s end-block [status]\n",
+        argv0, argv0);
+    return 1;
+}
+
+static bool write_all(int fd, const char *buf, size_t size) {
+    while (size) {
+        ssize_t wrote = write(fd, buf, size);
+        if (wrote < 0) {
+            if (errno == EINTR)
+                continue;
+            return false;
+        }
+        buf += wrote;
+        size -= wrote;
+    }
+    return true;
+}
+
+int main(int argc, char **argv) {
+    std::string cmd;
+    if (argc == 3 && !strcmp(argv[1], "start-block")) {
+        cmd = std::string("start-block ") + argv[2] + "\n";
+    } else if ((argc == 2 || argc == 3) && !strcmp(argv[1], "end-block")) {
+        const char *status = (argc == 3) ? argv[2] : "auto";
+        cmd = std::string("end-block ") + status + "\n";
+    } else {
+        return usage(argv[0]);
+    }
+
+    const char *sock_path = getenv(sock_env_var);
+    if (!sock_path) {
+        fprintf(stderr, "ERROR: %s not set\n", sock_env_var);
+        return 1;
+    }
+    struct sockaddr_un addr{};
+    addr.sun_family = AF_UNIX;
+    if (strlen(sock_path) >= sizeof(addr.sun_path)) {
+        fprintf(stderr, "ERROR: %s too long\n", sock_env_var);
+        return 1;
+    }
+    strcpy(addr.sun_path, sock_path);
+
+    // Synchronously flush to nestedlog-helper CUSE server, which will
+    // synchronously flush to main nestedlog server. With the pipe and pty
+    // capture backends, the server drains the streams itself before acting
+    // on each command.
+    const char *capture = getenv(capture_env_var);
+    if (!capture || !strcmp(capture, "cuse")) {
+        if (tcdrain(1) < 0) {
+            perror("ERROR: tcdrain() failed");
+            return 1;
+        }
+    }
+
+    int sock = socket(AF_UNIX, SOCK_STREAM, 0);
+    if (sock < 0) {
+        perror("ERROR: socket() failed");
+        return 1;
+    }
+    if (connect(sock, (struct sockaddr *)&addr, sizeof(addr)) < 0) {
+        perror("ERROR: connect() failed");
+        return 1;
+    }
+    if (!write_all(sock, cmd.c_str(), cmd.size())) {
+        perror("ERROR: write() failed");
+        return 1;
+    }
+    char response;
+    ssize_t nread;
+    do {
+        nread = read(sock, &response, 1);
+    } while (nread < 0 && errno == EINTR);
+    if (nread < 0) {
+        perror("ERROR: read() failed");
+        return 1;
+    }
+    close(sock);
+    if (nread != 1 || response != '0') {
+        fputs("ERROR: nestedlog server command failed\n", stderr);
+        return 1;
+    }
+    return 0;
+}
@@ -4,8 +4,14 @@
 #define FUSE_USE_VERSION 29
 #define _FILE_OFFSET_BITS 64
 
+#include <algorithm>
 #include <cerrno>
+#include <chrono>
+#include <condition_variable>
 #include <cstdio>
+#include <cstdlib>
+#include <cstring>
+#include <fcntl.h>
 #include <fuse/cuse_lowlevel.h>
 #include <fuse/fuse.h>
 #include <fuse/fuse_lowlevel.h>
@@ -14,7 +20,10 @@
 #include <sys/stat.h>
 #include <sys/types.h>
 #include <sys/wait.h>
+#include <mutex>
 #include <string>
+#include <thread>
+#include <vector>
 #include <asm/termbits.h>
 #include <unistd.h>
 
@@ -22,6 +31,155 @@
 
 int fd_num = 0;
 
+// Protocol used to send data to nestedlog on stdout.
+//
+// Version 1: Each frame has a 2-byte little-endian header; bits 0..14
+// contain the payload length, and bit 15 contains the stream (0: stdout, 1:
+// stderr). A zero-length frame is a drain request, which nestedlog
+// acknowledges by writing a byte to stdin.
+//
+// Version 2: Used if nestedlog sets $NESTED_LOG_HELPER_PROTOCOL to 2. The
+// helper first sends the bytes 00 80, which a version 1 helper never sends.
+// After that, each frame has a 4-byte little-endian header; bits 0..30
+// contain the payload length, and bit 31 contains the stream. Output may be
+// coalesced, i.e. buffered for up to $NESTED_LOG_HELPER_COALESCE_BYTES bytes
+// or $NESTED_LOG_HELPER_COALESCE_USEC microseconds before being sent, with
+// consecutive writes to the same stream merged into a single frame.
+static const char *protocol_env_var = "NESTED_LOG_HELPER_PROTOCOL";
+static const char *coalesce_bytes_env_var = "NESTED_LOG_HELPER_COALESCE_BYTES";
+static const char *coalesce_usec_env_var = "NESTED_LOG_HELPER_COALESCE_USEC";
+static const char v2_hello[2] = {0, (char)0x80};
+// Larger frames would only delay nestedlog processing the data.
+static const size_t v2_max_frame = 1024 * 1024;
+
+static int protocol_version = 1;
+static size_t coalesce_bytes = 0;
+static unsigned long coalesce_usec = 0;
+
+// Frames waiting to be sent, shared with the flush thread.
+static std::mutex out_mutex;
+static std::condition_variable out_cv;
+static std::vector<char> out_buf;
+static std::chrono::steady_clock::time_point out_first_time;
+static size_t out_last_hdr = SIZE_MAX;
+static unsigned int out_last_stream;
+static bool out_error = false;
+static bool flush_thread_exit = false;
+
+static bool write_all(int fd, const char *buf, size_t size) {
+    while (size) {
+        ssize_t wrote = write(fd, buf, size);
+        if (wrote < 0) {
+            if (errno == EINTR)
+                continue;
+            return false;
+        }
+        buf += wrote;
+        size -= wrote;
+    }
+    return true;
+}
+
+// Must be called with out_mutex held.
+static bool flush_locked() {
+    if (out_buf.empty())
+        return !out_error;
+    if (!write_all(1, out_buf.data(), out_buf.size()))
+        out_error = true;
+    out_buf.clear();
+    out_last_hdr = SIZE_MAX;
+    return !out_error;
+}
+
+// The rest of the output path below is only used for version 2; version 1
+// output is written by nlhelper_write() and nlhelper_ioctl() directly.
+static const size_t v2_hdr_size = 4;
+
+static void put_hdr(size_t pos, size_t size, unsigned int stream) {
+    out_buf[pos] = size & 255;
+    out_buf[pos + 1] = (size >> 8) & 255;
+    out_buf[pos + 2] = (size >> 16) & 255;
+    out_buf[pos + 3] = ((size >> 24) & 127) | (stream << 7);
+}
+
+static size_t hdr_frame_size(size_t pos) {
+    const unsigned char *hdr = (const unsigned char *)&out_buf[pos];
+    return hdr[0] | (hdr[1] << 8) | (hdr[2] << 16) | ((hdr[3] & 127) << 24);
+}
+
+// Must be called with out_mutex held.
+static void append_locked(unsigned int stream, const char *buf, size_t size) {
+    if (out_buf.empty())
+        out_first_time = std::chrono::steady_clock::now();
+    while (size) {
+        size_t to_write;
+        if ((out_last_hdr != SIZE_MAX) && (out_last_stream == stream) &&
+                (hdr_frame_size(out_last_hdr) < v2_max_frame)) {
+            // Extend the previous frame.
+            size_t frame_size = hdr_frame_size(out_last_hdr);
+            to_write = std::min(size, v2_max_frame - frame_size);
+            put_hdr(out_last_hdr, frame_size + to_write, stream);
+        } else {
+            to_write = std::min(size, v2_max_frame);
+            out_last_hdr = out_buf.size();
+            out_last_stream = stream;
+            out_buf.resize(out_buf.size() + v2_hdr_size);
+            put_hdr(out_last_hdr, to_write, stream);
+        }
+        out_buf.insert(out_buf.end(), buf, buf + to_write);
+        buf += to_write;
+        size -= to_write;
+    }
+}
+
+static bool coalescing() {
+    return (protocol_version >= 2) && coalesce_bytes && coalesce_usec;
+}
+
+static bool write_v2(unsigned int stream, const char *buf, size_t size) {
+    std::lock_guard<std::mutex> lock(out_mutex);
+    bool was_empty = out_buf.empty();
+    append_locked(stream, buf, size);
+    if (!coalescing() || (out_buf.size() >= coalesce_bytes))
+        return flush_locked();
+    if (was_empty) {
+        // Start the flush thread's timer.
+        out_cv.notify_one();
+    }
+    return !out_error;
+}
+
+// Sends any coalesced output, then a drain request, and waits for nestedlog
+// to acknowledge it.
+static bool drain_v2() {
+    {
+        std::lock_guard<std::mutex> lock(out_mutex);
+        if (!flush_locked())
+            return false;
+        char hdr[v2_hdr_size] = {0};
+        if (!write_all(1, hdr, v2_hdr_size))
+            return false;
+    }
+    char ack;
+    return read(0, &ack, 1) == 1;
+}
+
+static void flush_thread_main() {
+    std::unique_lock<std::mutex> lock(out_mutex);
+    while (!flush_thread_exit) {
+        if (out_buf.empty()) {
+            out_cv.wait(lock);
+            continue;
+        }
+        auto deadline = out_first_time + std::chrono::microseconds(coalesce_usec);
+        if (std::chrono::steady_clock::now() >= deadline) {
+            flush_locked();
+            continue;
+        }
+        out_cv.wait_until(lock, deadline);
+    }
+}
+
 static void nlhelper_open(fuse_req_t req, struct fuse_file_info *fi) {
     // 2 fds; stdout, stderr
     if (fd_num >= 2) {
@@ -32,6 +190,18 @@ static void nlhelper_open(fuse_req_t req, struct fuse_file_info *fi) {
     fuse_reply_open(req, fi);
 }
 
+static void nlhelper_write_v2(fuse_req_t req, const char *buf, size_t size,
+    struct fuse_file_info *fi
+) {
+    if (!write_v2(fi->fh - 1, buf, size)) {
+        perror("nlhelper: write() failed");
+        fi->fh = 0;
+        fuse_reply_err(req, EBADFD);
+        return;
+    }
+    fuse_reply_write(req, size);
+}
+
 static void nlhelper_write(fuse_req_t req, const char *buf, size_t size,
     off_t off, struct fuse_file_info *fi
 ) {
@@ -40,6 +210,11 @@ static void nlhelper_write(fuse_req_t req, const char *buf, size_t size,
         return;
     }
 
+    if (protocol_version >= 2) {
+        nlhelper_write_v2(req, buf, size, fi);
+        return;
+    }
+
     size_t ofs = 0;
     size_t size_left = size;
     char obuf[2];
@@ -92,6 +267,12 @@ static void nlhelper_ioctl(fuse_req_t req, int cmd, void *arg,
 
     switch (cmd) {
         case TCSBRK: {
+            if (protocol_version >= 2) {
+                if (!drain_v2())
+                    goto err;
+                fuse_reply_ioctl(req, 0, NULL, 0);
+                break;
+            }
             char buf[2] = {0};
             size_t nwrote = write(1, buf, 2);
             if (nwrote != 2)
@@ -191,9 +372,36 @@ int cuse_main(std::string &dev_name) {
         }
     }
 
+    if (protocol_version >= 2) {
+        // Allow nestedlog to read more data at once. This may fail due to
+        // system limits, which is harmless.
+        fcntl(1, F_SETPIPE_SZ, (int)v2_max_frame);
+        if (!write_all(1, v2_hello, sizeof(v2_hello))) {
+            perror("ERROR: CUSE child: write() failed");
+            ret = 1;
+            goto teardown;
+        }
+    }
+
     // Handle CUSE protocol
     {
+        std::thread flush_thread;
+        if (coalescing())
+            flush_thread = std::thread(flush_thread_main);
         ret = fuse_session_loop(se);
+        if (flush_thread.joinable()) {
+            {
+                std::lock_guard<std::mutex> lock(out_mutex);
+                flush_thread_exit = true;
+            }
+            out_cv.notify_one();
+            flush_thread.join();
+        }
+        if (protocol_version >= 2) {
+            // Send any output still being coalesced.
+            std::lock_guard<std::mutex> lock(out_mutex);
+            flush_locked();
+        }
         if (ret) {
             fputs("ERROR: CUSE child: fuse_session_loop() failed", stderr);
             ret = 1;
@@ -217,6 +425,23 @@ int main(int argc, char** argv) {
     pid_t cuse_pid;
     pid_t logged_pid;
 
+    // Negotiate the protocol version. The logged child doesn't need these.
+    {
+        const char *protocol = getenv(protocol_env_var);
+        if (protocol && !strcmp(protocol, "2")) {
+            protocol_version = 2;
+            const char *bytes = getenv(coalesce_bytes_env_var);
+            if (bytes)
+                coalesce_bytes = strtoul(bytes, NULL, 10);
+            const char *usec = getenv(coalesce_usec_env_var);
+            if (usec)
+                coalesce_usec = strtoul(usec, NULL, 10);
+        }
+        unsetenv(protocol_env_var);
+        unsetenv(coalesce_bytes_env_var);
+        unsetenv(coalesce_usec_env_var);
+    }
+
     // Create FUSE helper child process
     cuse_pid = fork();
     if (cuse_pid < 0) {
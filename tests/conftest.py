@@ -0,0 +1,12 @@
+# Copyright 2021 Stephen Warren <swarren@wwwdotorg.org>
+# SPDX-License-Identifier: MIT
+
+import os
+import sys
+
+# Run the tests against the source tree rather than any installed copy. The
+# environment variable lets commands run by the tests (e.g. under gen_log())
+# import it too.
+lib_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'lib', 'python'))
+sys.path.insert(0, lib_dir)
+os.environ['PYTHONPATH'] = lib_dir + os.pathsep + os.environ.get('PYTHONPATH', '')
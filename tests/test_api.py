@@ -0,0 +1,51 @@
+# Copyright 2021 Stephen Warren <swarren@wwwdotorg.org>
+# SPDX-License-Identifier: MIT
+
+import json
+import nestedlog.data as nld
+import nestedlog.emitter_jsonl as emjsonl
+import nestedlog.impl as nlimpl
+import sys
+
+def _block_output(tmp_path, script):
+    log_file_name = str(tmp_path / 'log.jsonl')
+    nlimpl.gen_log([emjsonl.Emitter(log_file_name)], [sys.executable, '-c', script], nld.CAPTURE_PIPE)
+    names = {}
+    output = {}
+    with open(log_file_name) as f:
+        for record in map(json.loads, f):
+            if record['type'] == 'start_block':
+                names[record['block_id']] = record['name']
+            elif record['type'] == 'data':
+                name = names[record['block_id']]
+                output[name] = output.get(name, '') + record['data']
+    return output
+
+def test_batch_output_lands_in_open_block(tmp_path):
+    script = '''
+import nestedlog.api as nlapi
+import sys
+nlapi.start_block("first")
+print("in first")
+with nlapi.batch():
+    nlapi.end_block("ok")
+    nlapi.start_block("second")
+    print("in second")
+    nlapi.end_block("ok")
+    nlapi.start_block("third")
+    sys.stderr.buffer.write(b"in third\\n")
+    nlapi.end_block("ok")
+    with nlapi.run_python_as_block("fourth"):
+        print("in fourth")
+    nlapi.start_block("fifth")
+print("in fifth")
+nlapi.end_block("ok")
+'''
+    output = _block_output(tmp_path, script)
+    assert output == {
+        'first': 'in first\n',
+        'second': 'in second\n',
+        'third': 'in third\n',
+        'fourth': 'in fourth\n',
+        'fifth': 'in fifth\n',
+    }
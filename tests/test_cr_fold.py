@@ -0,0 +1,85 @@
+# Copyright 2021 Stephen Warren <swarren@wwwdotorg.org>
+# SPDX-License-Identifier: MIT
+
+import nestedlog.data as nld
+import nestedlog.filter_cr_fold as filtcr
+import random
+
+def _run(filter, items, flush=True):
+    out = []
+    for stream, data in items:
+        out.extend(filter.filter_stream_data(stream, data))
+    if flush:
+        out.extend(filter.filter_flush())
+    return out
+
+def _text(out, stream=nld.STREAM_STDOUT):
+    return ''.join(data for (s, data) in out if s == stream)
+
+# What a terminal would show for text.
+def _terminal(text):
+    lines = []
+    for raw_line in text.split('\n'):
+        line = ''
+        for part in raw_line.split('\r'):
+            line = part + line[len(part):]
+        lines.append(line)
+    return '\n'.join(lines)
+
+def test_plain_output_passes_through():
+    filter = filtcr.Filter()
+    items = [(nld.STREAM_STDOUT, 'line 1\n'), (nld.STREAM_STDOUT, 'line 2\nline 3\n')]
+    assert _run(filter, items) == items
+
+def test_progress_folded():
+    filter = filtcr.Filter()
+    out = _run(filter, [(nld.STREAM_STDOUT, 'start\nProgress 10%\rProgress 50%\rProgress 100%\ndone\n')])
+    assert _text(out) == 'start\nProgress 100%\ndone\n'
+
+def test_shorter_overwrite_keeps_rest_of_line():
+    filter = filtcr.Filter()
+    assert _text(_run(filter, [(nld.STREAM_STDOUT, 'abcdef\rXY\n')])) == 'XYcdef\n'
+
+def test_random_splits_match_terminal():
+    rng = random.Random(1)
+    for i in range(200):
+        text = ''.join(rng.choice('ab\r\n') for j in range(rng.randrange(1, 60)))
+        filter = filtcr.Filter()
+        items = []
+        pos = 0
+        while pos < len(text):
+            size = rng.randrange(1, 8)
+            items.append((nld.STREAM_STDOUT, text[pos:pos + size]))
+            pos += size
+        assert _text(_run(filter, items)) == _terminal(text), repr(text)
+
+def test_streams_folded_separately():
+    filter = filtcr.Filter()
+    out = _run(filter, [
+        (nld.STREAM_STDOUT, 'out 1'),
+        (nld.STREAM_STDERR, 'err 1'),
+        (nld.STREAM_STDOUT, '\rout 2\n'),
+        (nld.STREAM_STDERR, '\rerr 2\n'),
+    ])
+    assert _text(out, nld.STREAM_STDOUT) == 'out 2\n'
+    assert _text(out, nld.STREAM_STDERR) == 'err 2\n'
+
+def test_incomplete_line_flushed_at_block_boundary():
+    filter = filtcr.Filter()
+    assert _run(filter, [(nld.STREAM_STDOUT, 'done\n50%\r90%')], flush=False) == [(nld.STREAM_STDOUT, 'done\n')]
+    assert filter.filter_flush() == [(nld.STREAM_STDOUT, '90%')]
+    assert filter.filter_flush() == []
+
+def test_snapshots():
+    # A snapshot is the state of the line before its last redraw in a chunk.
+    items = [(nld.STREAM_STDOUT, '10%\r20%'), (nld.STREAM_STDOUT, '\r30%'), (nld.STREAM_STDOUT, '\r40%\n')]
+    filter = filtcr.Filter(snapshot_interval=0)
+    assert _text(_run(filter, items)) == '10%\n20%\n40%\n'
+    filter = filtcr.Filter(snapshot_interval=3600)
+    assert _text(_run(filter, items)) == '10%\n40%\n'
+
+def test_long_incomplete_line_not_held():
+    filter = filtcr.Filter()
+    filter.max_pending = 10
+    out = _run(filter, [(nld.STREAM_STDOUT, 'x' * 20)], flush=False)
+    assert _text(out) == 'x' * 20
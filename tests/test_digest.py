@@ -0,0 +1,82 @@
+# Copyright 2021 Stephen Warren <swarren@wwwdotorg.org>
+# SPDX-License-Identifier: MIT
+
+import nestedlog.data as nld
+import nestedlog.digest as nldigest
+import nestedlog.emitter_plain_text as emplain
+import nestedlog.filter_output_cap as filtcap
+import nestedlog.sink as nlsink
+import os
+import subprocess
+import sys
+
+nestedlog_script = os.path.join(os.path.dirname(__file__), '..', 'nestedlog')
+
+def _hits(hits):
+    return [(hit['kind'], hit['stream'], hit['line_number'], hit['line']) for hit in hits]
+
+def test_lines_split_between_chunks():
+    digest = nldigest.Digest()
+    digest.start_block(1, 'block')
+    digest.feed(nld.STREAM_STDOUT, 'one\ntwo\nthe err')
+    digest.feed(nld.STREAM_STDERR, 'a warning\n')
+    digest.feed(nld.STREAM_STDOUT, 'or was here\nfour\n')
+    digest.feed(nld.STREAM_STDERR, 'second\nFAILED')
+    digest.end_block()
+    assert _hits(digest.hits) == [
+        ('warning', 'stderr', 1, 'a warning'),
+        ('error', 'stdout', 3, 'the error was here'),
+        ('error', 'stderr', 3, 'FAILED'),
+    ]
+
+def test_line_recorded_as_first_matching_pattern():
+    digest = nldigest.Digest()
+    digest.start_block(1, 'block')
+    digest.feed(nld.STREAM_STDOUT, 'WARNING: test FAILED\nwarning: only a warning\n')
+    digest.feed(nld.STREAM_STDOUT, 'Traceback (most recent call last): warning\n')
+    digest.end_block()
+    assert _hits(digest.hits) == [
+        ('error', 'stdout', 1, 'WARNING: test FAILED'),
+        ('warning', 'stdout', 2, 'warning: only a warning'),
+        ('traceback', 'stdout', 3, 'Traceback (most recent call last): warning'),
+    ]
+
+def test_long_lines_keep_their_line_number():
+    digest = nldigest.Digest(max_line=10)
+    digest.start_block(1, 'block')
+    digest.feed(nld.STREAM_STDOUT, 'one\n' + 'x' * 20)
+    digest.feed(nld.STREAM_STDOUT, ' error\nthree error\n')
+    digest.end_block()
+    assert [hit['line_number'] for hit in digest.hits] == [2, 3]
+
+def test_output_removed_by_filters_is_scanned(tmp_path):
+    digest = nldigest.Digest()
+    sink = nlsink.Sink([], filters=(filtcap.Filter(max_block=100, tail=20),), digest=digest)
+    sink.start_log()
+    sink.start_block('capped')
+    sink.stream_data(nld.STREAM_STDOUT, 'fine\n' * 100)
+    sink.stream_data(nld.STREAM_STDOUT, 'fatal: elided\n')
+    sink.stream_data(nld.STREAM_STDOUT, 'fine\n' * 100)
+    sink.end_block(nld.STATUS_OK)
+    sink.end_log()
+    assert _hits(digest.hits) == [('error', 'stdout', 101, 'fatal: elided')]
+
+def _log(tmp_path, *args):
+    log_file_name = str(tmp_path / 'log.txt')
+    script = 'print("fine"); print("error: broken")'
+    subprocess.run([sys.executable, nestedlog_script, 'log', '--capture', 'pipe', '--emit-text', log_file_name,
+        *args, sys.executable, '-c', script], check=True)
+    with open(log_file_name, 'rb') as f:
+        return f.read()
+
+def test_no_space_reserved_without_digest(tmp_path):
+    log = _log(tmp_path)
+    assert log.startswith(b'/-- ')
+    assert len(log) < 1024
+
+def test_digest_patched_into_top_of_log(tmp_path):
+    log = _log(tmp_path, '--digest', str(tmp_path / 'digest.json'), '--digest-max-bytes', '1000')
+    top = log[:1000]
+    assert top.startswith(b'Digest: 1 error\n')
+    assert b'(stdout line 2): error: broken\n' in top
+    assert log[1000:].startswith(b'\n/-- ')
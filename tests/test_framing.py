@@ -0,0 +1,127 @@
+# Copyright 2021 Stephen Warren <swarren@wwwdotorg.org>
+# SPDX-License-Identifier: MIT
+
+import json
+import nestedlog.data as nld
+import nestedlog.emitter_jsonl as emjsonl
+import nestedlog.framing as nlframing
+import nestedlog.impl as nlimpl
+import random
+import struct
+import sys
+
+def _frames_v1(items):
+    out = b''
+    for stream, data in items:
+        hdr = len(data)
+        if stream == nld.STREAM_STDERR:
+            hdr |= 0x8000
+        out += struct.pack('<H', hdr) + data
+    return out
+
+def _frames_v2(items):
+    out = nlframing._V2_HELLO
+    for stream, data in items:
+        hdr = len(data)
+        if stream == nld.STREAM_STDERR:
+            hdr |= 0x80000000
+        out += struct.pack('<I', hdr) + data
+    return out
+
+def _random_items(rng, max_len):
+    items = []
+    for i in range(200):
+        if rng.random() < 0.05:
+            # Drain request.
+            items.append((nld.STREAM_STDOUT, b''))
+            continue
+        stream = rng.choice((nld.STREAM_STDOUT, nld.STREAM_STDERR))
+        items.append((stream, bytes(rng.randrange(256) for j in range(rng.randrange(1, max_len)))))
+    return items
+
+def _parse_split(data, rng, negotiate):
+    events = []
+    parser = nlframing.FrameParser(
+        lambda stream, view: events.append((stream, bytes(view))),
+        lambda: events.append((nld.STREAM_STDOUT, b'')),
+        negotiate)
+    pos = 0
+    while pos < len(data):
+        size = rng.randrange(1, 64)
+        parser.feed(data[pos:pos + size])
+        pos += size
+    assert parser.backlog() == 0
+    return parser, events
+
+def test_frame_parser_v1_random_splits():
+    rng = random.Random(1)
+    for i in range(20):
+        items = _random_items(rng, 300)
+        parser, events = _parse_split(_frames_v1(items), rng, False)
+        assert events == items
+        assert parser.version == 1
+
+def test_frame_parser_v2_random_splits():
+    rng = random.Random(2)
+    for i in range(20):
+        items = _random_items(rng, 300)
+        parser, events = _parse_split(_frames_v2(items), rng, True)
+        assert events == items
+        assert parser.version == 2
+
+def test_frame_parser_negotiates_v1():
+    # A helper that doesn't understand the request for version 2 just starts
+    # sending version 1 frames.
+    rng = random.Random(3)
+    items = [(nld.STREAM_STDOUT, b'a' * 5)] + _random_items(rng, 100)
+    parser, events = _parse_split(_frames_v1(items), rng, True)
+    assert events == items
+    assert parser.version == 1
+
+class _RecordingSink(object):
+    def __init__(self):
+        self.data = []
+
+    def stream_data(self, stream, text):
+        self.data.append((stream, text))
+
+def test_stream_decoder_split_characters():
+    sink = _RecordingSink()
+    decoder = nlframing.StreamDecoder(sink, nld.STREAM_STDOUT)
+    data = 'aé€\U0001f600z'.encode('utf-8')
+    for b in data:
+        decoder.feed(bytes((b,)))
+    decoder.flush()
+    assert ''.join(text for (stream, text) in sink.data) == 'aé€\U0001f600z'
+
+def test_stream_decoder_flush_replaces_partial_character():
+    sink = _RecordingSink()
+    decoder = nlframing.StreamDecoder(sink, nld.STREAM_STDOUT)
+    decoder.feed(b'x\xc3')
+    decoder.flush()
+    decoder.feed(b'\xa9')
+    decoder.flush()
+    assert sink.data == [(nld.STREAM_STDOUT, 'x'), (nld.STREAM_STDOUT, '�'), (nld.STREAM_STDOUT, '�')]
+
+def test_partial_character_stays_in_its_block(tmp_path):
+    # The first byte of a character is written, then a block is started, then
+    # the rest of the character is written. Neither half may end up in the
+    # other block.
+    script = '''
+import nestedlog.api as nlapi
+import os
+os.write(1, b"before\\xc3")
+nlapi.start_block("inner")
+os.write(1, b"\\xa9after")
+nlapi.end_block("ok")
+'''
+    log_file_name = str(tmp_path / 'log.jsonl')
+    nlimpl.gen_log([emjsonl.Emitter(log_file_name)], [sys.executable, '-c', script], nld.CAPTURE_PIPE)
+    with open(log_file_name) as f:
+        records = [json.loads(line) for line in f]
+    data = {}
+    for record in records:
+        if record['type'] == 'data':
+            data[record['block_id']] = data.get(record['block_id'], '') + record['data']
+    assert data[1] == 'before�'
+    assert data[2] == '�after'
@@ -0,0 +1,81 @@
+# Copyright 2021 Stephen Warren <swarren@wwwdotorg.org>
+# SPDX-License-Identifier: MIT
+
+import gzip
+import nestedlog.data as nld
+import nestedlog.emitter_base as nlebase
+import nestedlog.emitter_html as emhtml
+import nestedlog.emitter_html_inline as emhtmli
+import nestedlog.emitter_plain_text as emplain
+import os
+
+# The expected output in tests/data was written by the emitters as they
+# were before status patches were batched, and before chunks were shared
+# between emitters; the output must not have changed since, except that
+# the HTML stylesheet has since gained the time gutter and digest rules.
+data_dir = os.path.join(os.path.dirname(__file__), 'data')
+
+# A fixed sequence of emitter events, with enough blocks that the status
+# patches are applied in several batches.
+def _events():
+    yield ('start_block', 1, 'outer <&> ünïcode')
+    yield ('start_stream', nld.STREAM_STDOUT, False)
+    yield ('data', 'line 1\nline 2\n')
+    yield ('end_stream', True)
+    yield ('start_stream', nld.STREAM_STDERR, True)
+    yield ('data', 'error <b>&amp;</b> "quoted"\n\npartial')
+    yield ('end_stream', False)
+    block_id = 1
+    for i in range(1200):
+        block_id += 1
+        yield ('start_block', block_id, f'step {i}')
+        if i % 4:
+            yield ('start_stream', (nld.STREAM_STDOUT, nld.STREAM_STDERR)[i % 2], False)
+            yield ('data', f'output {i}\n')
+            if i % 7 == 0:
+                yield ('data', 'no newline')
+            yield ('end_stream', False)
+        if i % 100 == 0:
+            block_id += 1
+            yield ('start_block', block_id, 'child')
+            yield ('start_stream', nld.STREAM_STDOUT, False)
+            yield ('data', 'ünïcode <&>\n')
+            yield ('end_stream', False)
+            yield ('end_block', nld.STATUS_WARNING)
+        yield ('end_block', (nld.STATUS_OK, nld.STATUS_WARNING, nld.STATUS_ERROR)[i % 3])
+    yield ('end_block', nld.STATUS_ERROR)
+
+# Each chunk is shared by all the emitters, as Sink does.
+def _render(emitters):
+    for emitter in emitters:
+        emitter.emit_start_log()
+    for event in _events():
+        for emitter in emitters:
+            if event[0] == 'start_block':
+                emitter.emit_start_block(event[1], event[2])
+            elif event[0] == 'end_block':
+                emitter.emit_end_block(event[1], {})
+            elif event[0] == 'start_stream':
+                emitter.emit_start_stream(event[1], event[2])
+            elif event[0] == 'end_stream':
+                emitter.emit_end_stream(event[1])
+        if event[0] == 'data':
+            chunk = nlebase.Chunk(event[1])
+            for emitter in emitters:
+                emitter.emit_stream_data(chunk)
+    for emitter in emitters:
+        emitter.emit_end_log()
+
+def test_output_unchanged(tmp_path):
+    outputs = (
+        (emplain, 'golden.txt.gz'),
+        (emhtml, 'golden.html.gz'),
+        (emhtmli, 'golden-inline.html.gz'),
+    )
+    _render([module.Emitter(str(tmp_path / expected_name[:-3])) for (module, expected_name) in outputs])
+    for module, expected_name in outputs:
+        with open(tmp_path / expected_name[:-3], 'rb') as f:
+            log = f.read()
+        with gzip.open(os.path.join(data_dir, expected_name), 'rb') as f:
+            expected = f.read()
+        assert log == expected, expected_name
@@ -0,0 +1,97 @@
+# Copyright 2021 Stephen Warren <swarren@wwwdotorg.org>
+# SPDX-License-Identifier: MIT
+
+import json
+import nestedlog.data as nld
+import nestedlog.emitter_html_chunked as emhtmlc
+import nestedlog.sink as nlsink
+import os
+
+def _gen_log(log_dir_name, blocks):
+    sink = nlsink.Sink([emhtmlc.Emitter(log_dir_name, part_size=64)])
+    sink.start_log()
+    sink.start_block('top')
+    sink.stream_data(nld.STREAM_STDOUT, 'top output\n')
+    for i in range(blocks):
+        sink.start_block(f'child {i}')
+        sink.stream_data(nld.STREAM_STDERR, 'x' * 100)
+        sink.start_block('grandchild')
+        sink.end_block(nld.STATUS_OK)
+        sink.end_block(nld.STATUS_OK)
+    sink.end_block(nld.STATUS_AUTO)
+    sink.end_log()
+
+def _read_index(log_dir_name):
+    with open(os.path.join(log_dir_name, 'index.html'), encoding='utf-8') as f:
+        index = f.read()
+    start = index.index('var nlLog = ') + len('var nlLog = ')
+    end = index.index(';\nvar nlPending')
+    return json.loads(index[start:end])
+
+def _shard_items(log_dir_name, block_id, part):
+    with open(os.path.join(log_dir_name, 'shards', f'{block_id}-{part}.js'), encoding='utf-8') as f:
+        shard = f.read()
+    prefix = f'nlShard({block_id},{part},['
+    assert shard.startswith(prefix) and shard.endswith(',\n]);\n')
+    return json.loads('[' + shard[len(prefix):-len(',\n]);\n')] + ']')
+
+def test_index_contains_tree(tmp_path):
+    log_dir_name = str(tmp_path / 'log')
+    _gen_log(log_dir_name, 2)
+    log = _read_index(log_dir_name)
+    assert log['root'] == [1]
+    blocks = log['blocks']
+    assert blocks['1']['parent'] is None
+    assert blocks['1']['children'] == [2, 4]
+    assert blocks['2']['name'] == 'child 0'
+    assert blocks['2']['parent'] == 1
+    assert blocks['2']['children'] == [3]
+    assert blocks['3']['children'] == []
+    assert blocks['1']['status'] == 'ok'
+    # Output is split into parts, with each child block placed within it.
+    assert blocks['2']['parts'] == 2
+    items = _shard_items(log_dir_name, 2, 0) + _shard_items(log_dir_name, 2, 1)
+    assert items == [['e', 'x' * 100], ['b', 3]]
+    assert _shard_items(log_dir_name, 1, 0)[0] == ['o', 'top output\n']
+
+def test_stale_shards_removed(tmp_path):
+    log_dir_name = str(tmp_path / 'log')
+    _gen_log(log_dir_name, 10)
+    other_file_name = os.path.join(log_dir_name, 'shards', 'notes.txt')
+    open(other_file_name, 'w').close()
+    _gen_log(log_dir_name, 1)
+    log = _read_index(log_dir_name)
+    shard_ids = set(int(name.split('-')[0]) for name in os.listdir(os.path.join(log_dir_name, 'shards')) if name.endswith('.js'))
+    assert shard_ids <= set(int(block_id) for block_id in log['blocks'])
+    assert os.path.exists(other_file_name)
+
+def test_index_written_while_running(tmp_path):
+    log_dir_name = str(tmp_path / 'log')
+    sink = nlsink.Sink([emhtmlc.Emitter(log_dir_name, part_size=64)])
+    sink.start_log()
+    sink.start_block('first')
+    sink.end_block(nld.STATUS_OK)
+    # The index is rewritten when a top-level block ends.
+    log = _read_index(log_dir_name)
+    assert log['root'] == [1]
+    assert log['blocks']['1']['status'] == 'ok'
+    sink.start_block('second')
+    sink.start_block('running')
+    for i in range(100):
+        sink.stream_data(nld.STREAM_STDOUT, f'{i:09}\n' * 10)
+    # ... and when a part fills up, with the blocks that are still running.
+    log = _read_index(log_dir_name)
+    assert log['root'] == [1, 2]
+    assert log['blocks']['2']['status'] == 'running'
+    assert log['blocks']['2']['children'] == [3]
+    running = log['blocks']['3']
+    assert running['status'] == 'running'
+    assert running['parent'] == 2
+    # Only complete parts are listed.
+    assert running['parts'] > 1
+    for part in range(running['parts']):
+        assert _shard_items(log_dir_name, 3, part)
+    sink.end_block(nld.STATUS_OK)
+    sink.end_block(nld.STATUS_OK)
+    sink.end_log()
+    assert _read_index(log_dir_name)['blocks']['3']['status'] == 'ok'
@@ -0,0 +1,78 @@
+# Copyright 2021 Stephen Warren <swarren@wwwdotorg.org>
+# SPDX-License-Identifier: MIT
+
+import gzip
+import nestedlog.data as nld
+import nestedlog.emitter_plain_text as emplain
+import nestedlog.index as nlindex
+import nestedlog.journal as nljournal
+import nestedlog.sink as nlsink
+import os
+import subprocess
+import sys
+
+nestedlog_script = os.path.join(os.path.dirname(__file__), '..', 'nestedlog')
+
+def _gen_log(emitters):
+    sink = nlsink.Sink(emitters)
+    sink.start_log()
+    sink.start_block('top')
+    sink.stream_data(nld.STREAM_STDOUT, 'top output\n')
+    sink.start_block('passes')
+    sink.stream_data(nld.STREAM_STDOUT, 'fine\n')
+    sink.end_block(nld.STATUS_OK)
+    sink.start_block('fails')
+    sink.stream_data(nld.STREAM_STDERR, 'ünïcode failure\n' * 1000)
+    sink.end_block(nld.STATUS_ERROR)
+    sink.end_block(nld.STATUS_AUTO)
+    sink.end_log()
+
+def _extract(*args):
+    return subprocess.run([sys.executable, nestedlog_script, 'extract', *args], stdout=subprocess.PIPE, check=True).stdout
+
+def test_index_records_tree(tmp_path):
+    log_file_name = str(tmp_path / 'log.txt')
+    _gen_log([emplain.Emitter(log_file_name, index=True)])
+    blocks = nlindex.read(log_file_name)
+    assert [(b['id'], b['name'], b['depth'], b['parent'], b['status']) for b in blocks] == [
+        (1, 'top', 0, None, 'error'),
+        (2, 'passes', 1, 1, 'ok'),
+        (3, 'fails', 1, 1, 'error'),
+    ]
+    assert [b['id'] for b in nlindex.failed_blocks(blocks)] == [3]
+
+def test_index_offsets_plain_and_gzip(tmp_path):
+    plain_file_name = str(tmp_path / 'log.txt')
+    gz_file_name = str(tmp_path / 'log.txt.gz')
+    _gen_log([emplain.Emitter(plain_file_name, index=True), emplain.Emitter(gz_file_name, index=True)])
+    with open(plain_file_name, 'rb') as f:
+        plain = f.read()
+    with gzip.open(gz_file_name, 'rb') as f:
+        unzipped = f.read()
+    plain_blocks = nlindex.read(plain_file_name)
+    gz_blocks = nlindex.read(gz_file_name)
+    for plain_block, gz_block in zip(plain_blocks, gz_blocks):
+        # The compressed log has no patched-in statuses in its headers, so
+        # its offsets differ; but each block must start with its header and
+        # end with its footer in both.
+        for log, block in ((plain, plain_block), (unzipped, gz_block)):
+            content = log[block['start']:block['end']]
+            assert content.lstrip(b'| ').startswith(f'/-- {block["name"]}'.encode('utf-8'))
+            assert content.rstrip(b'\n').rsplit(b'\n', 1)[-1].lstrip(b'| ').startswith(f'\\-- ({block["status"].capitalize()}'.encode('utf-8'))
+
+def test_extract_failed_gzip(tmp_path):
+    gz_file_name = str(tmp_path / 'log.txt.gz')
+    _gen_log([emplain.Emitter(gz_file_name, index=True)])
+    out = _extract('--failed', gz_file_name)
+    assert out.startswith(b'| /-- fails\n')
+    assert out.count('ünïcode failure\n'.encode('utf-8')) == 1000
+    assert b'fine' not in out
+    assert out == _extract('--block', '3', gz_file_name)
+
+def test_extract_from_journal(tmp_path):
+    journal_file_name = str(tmp_path / 'log.nlj')
+    _gen_log([nljournal.Writer(journal_file_name, index=True)])
+    out = _extract('--block', '2', journal_file_name)
+    assert out.startswith(b'/-- passes (Ok)')
+    assert b'| fine\n' in out
+    assert b'failure' not in out
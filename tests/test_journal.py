@@ -0,0 +1,61 @@
+# Copyright 2021 Stephen Warren <swarren@wwwdotorg.org>
+# SPDX-License-Identifier: MIT
+
+import nestedlog.data as nld
+import nestedlog.emitter_html as emhtml
+import nestedlog.emitter_plain_text as emplain
+import nestedlog.journal as nljournal
+import nestedlog.sink as nlsink
+
+def _emitters(dir_path, prefix):
+    return [
+        emplain.Emitter(str(dir_path / f'{prefix}.txt'), time_gutter=True),
+        emhtml.Emitter(str(dir_path / f'{prefix}.html'), time_gutter=True),
+    ]
+
+def _read(file_name):
+    with open(file_name, 'rb') as f:
+        return f.read()
+
+def _gen_log(sink):
+    sink.start_log()
+    sink.start_block('outer')
+    sink.stream_data(nld.STREAM_STDOUT, 'line 1\nline ')
+    sink.stream_data(nld.STREAM_STDOUT, '2\n')
+    sink.stream_data(nld.STREAM_STDERR, 'ünïcode <&> error\n')
+    sink.start_block('inner')
+    sink.stream_data(nld.STREAM_STDOUT, 'no newline')
+    sink.end_block(nld.STATUS_WARNING, {'utime': 0.5, 'stime': 0.25})
+    sink.stream_data(nld.STREAM_STDOUT, 'after\n')
+    sink.end_block(nld.STATUS_AUTO)
+    sink.end_log()
+
+def test_replay_matches_direct_output(tmp_path):
+    journal_file_name = str(tmp_path / 'log.nlj')
+    _gen_log(nlsink.Sink(_emitters(tmp_path, 'direct') + [nljournal.Writer(journal_file_name)]))
+    status = nljournal.replay(journal_file_name, _emitters(tmp_path, 'replayed'))
+    assert status == nld.STATUS_WARNING
+    for suffix in ('txt', 'html'):
+        assert _read(tmp_path / f'replayed.{suffix}') == _read(tmp_path / f'direct.{suffix}')
+
+def test_replay_truncated_journal(tmp_path):
+    journal_file_name = str(tmp_path / 'log.nlj')
+    _gen_log(nlsink.Sink([nljournal.Writer(journal_file_name)]))
+    journal = _read(journal_file_name)
+    # Cut the journal off part way through the inner block's output.
+    truncated_file_name = str(tmp_path / 'truncated.nlj')
+    with open(truncated_file_name, 'wb') as f:
+        f.write(journal[:journal.index(b'no newline') + 3])
+    text_file_name = str(tmp_path / 'truncated.txt')
+    status = nljournal.replay(truncated_file_name, [emplain.Emitter(text_file_name)])
+    assert status == nld.STATUS_ERROR
+    text = _read(text_file_name).decode('utf-8')
+    assert '/-- inner (Error)' in text
+    assert text.endswith('\\-- (Error)\n')
+
+def test_replay_empty_journal(tmp_path):
+    journal_file_name = str(tmp_path / 'empty.nlj')
+    open(journal_file_name, 'wb').close()
+    text_file_name = str(tmp_path / 'empty.txt')
+    assert nljournal.replay(journal_file_name, [emplain.Emitter(text_file_name)]) is None
+    assert _read(text_file_name) == b''
@@ -0,0 +1,66 @@
+# Copyright 2021 Stephen Warren <swarren@wwwdotorg.org>
+# SPDX-License-Identifier: MIT
+
+import json
+import nestedlog.data as nld
+import nestedlog.emitter_jsonl as emjsonl
+import nestedlog.sink as nlsink
+import time
+import zlib
+
+def _records(data):
+    return [json.loads(line) for line in data.decode('utf-8').splitlines()]
+
+def _wait_for(read, count):
+    deadline = time.monotonic() + 5
+    while True:
+        records = _records(read())
+        if len(records) >= count or time.monotonic() > deadline:
+            return records
+        time.sleep(0.01)
+
+def _tail_while_running(tmp_path, file_name, read):
+    log_file_name = str(tmp_path / file_name)
+    sink = nlsink.Sink([emjsonl.Emitter(log_file_name)])
+    sink.start_log()
+    sink.start_block('quiet')
+    sink.start_stream(nld.STREAM_STDOUT, False)
+    sink.stream_data(nld.STREAM_STDOUT, 'partial ')
+    sink.stream_data(nld.STREAM_STDOUT, 'line')
+    # The command goes quiet, but the stream doesn't end.
+    records = _wait_for(lambda: read(log_file_name), 3)
+    sink.end_stream(False)
+    sink.end_block(nld.STATUS_OK)
+    sink.end_log()
+    assert [record['type'] for record in records] == ['start_log', 'start_block', 'data']
+    assert records[2]['data'] == 'partial line'
+    assert [record['type'] for record in _records(read(log_file_name))] == [
+        'start_log', 'start_block', 'data', 'end_block', 'end_log']
+
+def test_records_are_readable_while_running(tmp_path):
+    def read(file_name):
+        with open(file_name, 'rb') as f:
+            return f.read()
+    _tail_while_running(tmp_path, 'log.jsonl', read)
+
+def test_compressed_records_are_readable_while_running(tmp_path):
+    def read(file_name):
+        with open(file_name, 'rb') as f:
+            return zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(f.read())
+    _tail_while_running(tmp_path, 'log.jsonl.gz', read)
+
+def test_data_is_coalesced(tmp_path):
+    log_file_name = str(tmp_path / 'log.jsonl')
+    sink = nlsink.Sink([emjsonl.Emitter(log_file_name, max_data=100)])
+    sink.start_log()
+    sink.start_block('busy')
+    sink.start_stream(nld.STREAM_STDOUT, False)
+    for i in range(30):
+        sink.stream_data(nld.STREAM_STDOUT, f'{i:09}\n')
+    sink.end_stream(False)
+    sink.end_block(nld.STATUS_OK)
+    sink.end_log()
+    with open(log_file_name, 'rb') as f:
+        data = [record['data'] for record in _records(f.read()) if record['type'] == 'data']
+    assert ''.join(data) == ''.join(f'{i:09}\n' for i in range(30))
+    assert len(data) <= 4
@@ -0,0 +1,56 @@
+# Copyright 2021 Stephen Warren <swarren@wwwdotorg.org>
+# SPDX-License-Identifier: MIT
+
+import binascii
+import io
+import nestedlog.mime as nlmime
+
+# Records the most data returned by any one read.
+class _File(object):
+    def __init__(self, f):
+        self.f = f
+        self.max_read = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.f.close()
+
+    def _record(self, data):
+        self.max_read = max(self.max_read, len(data))
+        return data
+
+    def read(self, *args):
+        return self._record(self.f.read(*args))
+
+    def readlines(self, *args):
+        lines = self.f.readlines(*args)
+        self._record(b''.join(lines))
+        return lines
+
+def _qp_file(tmp_path, data):
+    file_name = tmp_path / 'log.txt'
+    file_name.write_bytes(data)
+    out = io.BytesIO()
+    nlmime._Composer(out).qp_file(str(file_name))
+    return out.getvalue()
+
+def test_qp_file_reads_bounded_blocks(tmp_path, monkeypatch):
+    monkeypatch.setattr(nlmime, '_read_size', 100)
+    files = []
+    def open_file(*args):
+        files.append(_File(open(*args)))
+        return files[-1]
+    monkeypatch.setattr(nlmime, 'open', open_file, raising=False)
+    long_line = ''.join(chr(0x20 + i % 95) for i in range(1000)) + ' é\t'
+    data = ('short\n' + long_line + '\n' + 'x' * 99 + '\n' + long_line).encode('utf-8')
+    encoded = _qp_file(tmp_path, data)
+    assert binascii.a2b_qp(encoded) == data
+    assert max(len(line) for line in encoded.split(b'\n')) <= 76
+    assert encoded.isascii()
+    assert files[0].max_read <= 100
+
+def test_qp_file_whole_lines(tmp_path):
+    data = b'line one\nline two\n'
+    assert _qp_file(tmp_path, data) == data
@@ -0,0 +1,95 @@
+# Copyright 2021 Stephen Warren <swarren@wwwdotorg.org>
+# SPDX-License-Identifier: MIT
+
+import nestedlog.data as nld
+import nestedlog.filter_output_cap as filtcap
+import re
+
+def _run(filter, items, flush=True):
+    out = []
+    for stream, data in items:
+        out.extend(filter.filter_stream_data(stream, data))
+    if flush:
+        out.extend(filter.filter_flush())
+    return out
+
+def _text(out):
+    return ''.join(data for (stream, data) in out)
+
+def _size(text):
+    return len(text.encode('utf-8'))
+
+def test_under_limit_passes_through():
+    filter = filtcap.Filter(max_block=100)
+    filter.filter_start_log()
+    filter.filter_start_block()
+    items = [(nld.STREAM_STDOUT, 'a' * 50), (nld.STREAM_STDERR, 'é' * 25)]
+    assert _run(filter, items) == items
+
+def test_block_limit_counts_bytes():
+    filter = filtcap.Filter(max_block=100, tail=40)
+    filter.filter_start_log()
+    filter.filter_start_block()
+    # 2-byte and 3-byte characters, written in odd-sized pieces.
+    text = ''.join('é€x'[i % 3] for i in range(1000))
+    items = [(nld.STREAM_STDOUT, text[i:i + 7]) for i in range(0, len(text), 7)]
+    out = _text(_run(filter, items))
+    head, marker, tail = re.match(r'(.*)\n(\[nestedlog: \d+ bytes elided\])\n(.*)', out, re.DOTALL).groups()
+    assert _size(head) <= 60 and _size(head) > 60 - 3
+    assert _size(tail) <= 40 and _size(tail) > 40 - 3
+    assert text.startswith(head)
+    assert text.endswith(tail)
+    elided = int(re.search(r'(\d+) bytes', marker).group(1))
+    assert _size(head) + elided + _size(tail) == _size(text)
+
+def test_log_limit_includes_tails():
+    filter = filtcap.Filter(max_log=10, tail=5)
+    filter.filter_start_log()
+    filter.filter_start_block()
+    assert _text(_run(filter, [(nld.STREAM_STDOUT, '0123456789abcdef')])) == '01234\n[nestedlog: 6 bytes elided]\nbcdef'
+    filter.filter_end_block()
+    filter.filter_start_block()
+    assert _text(_run(filter, [(nld.STREAM_STDOUT, 'ABCDEFGH')])) == '\n[nestedlog: 8 bytes elided]\n'
+
+def test_log_limit_with_many_small_blocks():
+    filter = filtcap.Filter(max_block=100, max_log=1000, tail=40)
+    filter.filter_start_log()
+    out = []
+    for i in range(1000):
+        filter.filter_start_block()
+        out.extend(_run(filter, [(nld.STREAM_STDOUT, f'{i:09}\n' * 3)]))
+        filter.filter_end_block()
+    text = _text(out)
+    kept = re.sub(r'\n\[nestedlog: \d+ bytes elided\]\n', '', text)
+    assert _size(kept) <= 1000 and _size(kept) > 1000 - 40
+    elided = sum(int(n) for n in re.findall(r'(\d+) bytes elided', text))
+    assert _size(kept) + elided == 30 * 1000
+
+def test_tail_held_until_child_block():
+    filter = filtcap.Filter(max_block=4, tail=2)
+    filter.filter_start_log()
+    filter.filter_start_block()
+    assert _run(filter, [(nld.STREAM_STDOUT, 'abcdef')], flush=False) == [(nld.STREAM_STDOUT, 'ab')]
+    assert _text(filter.filter_flush()) == '\n[nestedlog: 2 bytes elided]\nef'
+    # The parent's budget isn't reset by a child block.
+    filter.filter_start_block()
+    filter.filter_end_block()
+    assert _text(_run(filter, [(nld.STREAM_STDOUT, 'gh')])) == 'gh'
+    assert _text(_run(filter, [(nld.STREAM_STDOUT, 'ijk')])) == '\n[nestedlog: 1 bytes elided]\njk'
+
+def test_full_output_offset(tmp_path):
+    full_file_name = str(tmp_path / 'full.txt')
+    filter = filtcap.Filter(max_block=8, tail=4, full_output_file_name=full_file_name)
+    filter.filter_start_log()
+    filter.filter_start_block()
+    text = 'ü' * 3 + 'abcdefghijklmnop'
+    out = _text(_run(filter, [(nld.STREAM_STDOUT, text)]))
+    filter.filter_end_block()
+    filter.filter_end_log()
+    offset = int(re.search(r'from byte (\d+)', out).group(1))
+    with open(full_file_name, 'rb') as f:
+        full = f.read()
+    assert full == text.encode('utf-8')
+    head = out.split('\n')[0]
+    assert offset == _size(head)
+    assert full[offset:].decode('utf-8').startswith('üabc')
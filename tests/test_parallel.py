@@ -0,0 +1,112 @@
+# Copyright 2021 Stephen Warren <swarren@wwwdotorg.org>
+# SPDX-License-Identifier: MIT
+
+import json
+import nestedlog.data as nld
+import nestedlog.emitter_jsonl as emjsonl
+import nestedlog.impl as nlimpl
+import nestedlog.parallel as nlparallel
+import pytest
+import signal
+import sys
+
+def test_output_spills_to_file():
+    records = [(nld.STREAM_STDOUT, b'a' * 10), (nld.STREAM_STDERR, b'b' * 20), (nld.STREAM_STDOUT, b'c')]
+    output = nlparallel._Output(25)
+    for stream, data in records:
+        output.append(stream, data)
+    assert output.spill_file is not None
+    assert list(output) == records
+    output.close()
+
+def _run(tmp_path, script):
+    log_file_name = str(tmp_path / 'log.jsonl')
+    nlimpl.gen_log([emjsonl.Emitter(log_file_name)], [sys.executable, '-c', script], nld.CAPTURE_PIPE)
+    with open(log_file_name) as f:
+        return [json.loads(line) for line in f]
+
+def test_blocks_spliced_in_order(tmp_path):
+    # Later commands finish first, and the first fails, yet the log looks as
+    # if they had run one after another.
+    script = '''
+import nestedlog.api as nlapi
+import sys
+blocks = [
+    ("one", "sleep 0.6; echo one out; echo one err >&2; exit 3"),
+    ("two", "sleep 0.3; echo two out"),
+    ("three", [sys.executable, "-c", "print('three out'); print('x' * 100000, end='')"]),
+]
+status = nlapi.run_parallel_blocks(blocks, jobs=3, spill_threshold=1000)
+print("status", status)
+'''
+    records = _run(tmp_path, script)
+    names = {}
+    output = {}
+    order = []
+    statuses = {}
+    for record in records:
+        if record['type'] == 'start_block':
+            names[record['block_id']] = record['name']
+            order.append(record['name'])
+        elif record['type'] == 'end_block':
+            statuses[names[record['block_id']]] = (record['status'], record['duration'])
+        elif record['type'] == 'data':
+            key = (names[record['block_id']], record['stream'])
+            output[key] = output.get(key, '') + record['data']
+    assert order[1:] == ['one', 'two', 'three']
+    assert output[('one', 'stdout')] == 'one out\n'
+    assert output[('one', 'stderr')] == 'one err\nERROR: Process exit code 3\n'
+    assert output[('two', 'stdout')] == 'two out\n'
+    assert output[('three', 'stdout')] == 'three out\n' + 'x' * 100000
+    assert statuses['one'][0] == 'error'
+    assert statuses['two'][0] == 'ok'
+    assert statuses['three'][0] == 'ok'
+    # Each block reports how long its command ran for, not how long it took
+    # to splice it into the log.
+    assert statuses['one'][1] >= 0.6
+    assert statuses['two'][1] >= 0.3
+    assert statuses['three'][1] < 0.3
+    assert output[(order[0], 'stdout')].endswith(f'status {nld.STATUS_ERROR}\n')
+    # The commands ran at the same time.
+    assert statuses[order[0]][1] < 1.2
+
+def test_launch_failure_recorded_in_block(tmp_path):
+    script = '''
+import nestedlog.api as nlapi
+blocks = [
+    ("missing", ["/nonexistent/command"]),
+    ("fine", "echo fine"),
+]
+nlapi.run_parallel_blocks(blocks, jobs=2)
+'''
+    records = _run(tmp_path, script)
+    names = {}
+    output = {}
+    statuses = {}
+    for record in records:
+        if record['type'] == 'start_block':
+            names[record['block_id']] = record['name']
+        elif record['type'] == 'end_block':
+            statuses[names[record['block_id']]] = record['status']
+        elif record['type'] == 'data':
+            key = (names[record['block_id']], record['stream'])
+            output[key] = output.get(key, '') + record['data']
+    assert statuses['missing'] == 'error'
+    assert output[('missing', 'stderr')].startswith('ERROR: Failed to run command: [Errno 2] ')
+    assert statuses['fine'] == 'ok'
+    assert output[('fine', 'stdout')] == 'fine\n'
+
+def test_commands_killed_on_error(monkeypatch):
+    jobs = []
+    start = nlparallel._Job.start
+    def record_start(job, selector):
+        jobs.append(job)
+        return start(job, selector)
+    def fail_splice(job):
+        raise Exception('splice failed')
+    monkeypatch.setattr(nlparallel._Job, 'start', record_start)
+    monkeypatch.setattr(nlparallel._Job, 'splice', fail_splice)
+    with pytest.raises(Exception, match='splice failed'):
+        nlparallel.run_parallel_blocks([('fast', 'true'), ('slow', 'sleep 30')], jobs=2)
+    assert jobs[1].sp.returncode == -signal.SIGKILL
+    assert jobs[1].sp.stdout.closed
@@ -0,0 +1,59 @@
+# Copyright 2021 Stephen Warren <swarren@wwwdotorg.org>
+# SPDX-License-Identifier: MIT
+
+import json
+import nestedlog.data as nld
+import nestedlog.emitter_jsonl as emjsonl
+import nestedlog.impl as nlimpl
+import nestedlog.rusage as nlrusage
+import os
+import pytest
+
+repo_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+def _end_block_records(tmp_path, cmd):
+    log_file_name = str(tmp_path / 'log.jsonl')
+    nlimpl.gen_log([emjsonl.Emitter(log_file_name)], cmd, nld.CAPTURE_PIPE)
+    with open(log_file_name) as f:
+        records = [json.loads(line) for line in f]
+    return {
+        record['block_id']: record
+        for record in records if record['type'] == 'end_block'
+    }
+
+def _cpu(record):
+    return record['utime'] + record['stime']
+
+def test_no_peak_rss_from_wait4(tmp_path):
+    # A child's peak RSS from wait4() includes the copy of nestedlog it was
+    # forked from, so isn't reported.
+    records = _end_block_records(tmp_path, ['true'])
+    assert 'utime' in records[1]
+    assert 'maxrss' not in records[1]
+    assert 'RSS' not in nld.format_block_stats(records[1])
+
+def test_control_protocol_has_no_peak_rss():
+    assert nlrusage.from_args(['utime=1.5', 'stime=0.25']) == {'utime': 1.5, 'stime': 0.25}
+    with pytest.raises(Exception, match='maxrss'):
+        nlrusage.from_args(['maxrss=10240'])
+
+def test_shell_blocks_exclude_control_clients(tmp_path, monkeypatch):
+    monkeypatch.setenv('PATH', repo_dir + os.pathsep + os.environ['PATH'])
+    script = '''
+nestedlog start-block outer
+for i in 1 2 3 4 5; do
+    nestedlog start-block "inner $i"
+    echo x
+    nestedlog end-block ok
+done
+nestedlog end-block ok
+'''
+    records = _end_block_records(tmp_path, ['sh', '-c', script])
+    # Nearly all the CPU time of the whole script is spent running the 12
+    # control clients. None of that belongs to the blocks they start and end.
+    total = _cpu(records[1])
+    outer = _cpu(records[2])
+    inner = sum(_cpu(records[block_id]) for block_id in range(3, 8))
+    assert total > 0
+    assert outer < total / 2
+    assert inner < total / 4
@@ -0,0 +1,108 @@
+# Copyright 2021 Stephen Warren <swarren@wwwdotorg.org>
+# SPDX-License-Identifier: MIT
+
+import json
+import nestedlog
+import nestedlog.api as nlapi
+import nestedlog.data as nld
+import nestedlog.emitter_jsonl as emjsonl
+import os
+import pytest
+import subprocess
+import sys
+
+# A command that uses about 0.3s of user CPU time.
+_busy_cmd = [sys.executable, '-c', 'import time\nend = time.process_time() + 0.3\nwhile time.process_time() < end: pass\nprint("busy done")']
+
+def _read(log_file_name):
+    with open(log_file_name) as f:
+        records = [json.loads(line) for line in f]
+    blocks = {}
+    for record in records:
+        if record['type'] == 'start_block':
+            blocks[record['name']] = {'id': record['block_id'], 'parent_id': record['parent_id'], 'output': ''}
+    names = {block['id']: name for (name, block) in blocks.items()}
+    for record in records:
+        if record['type'] == 'end_block':
+            blocks[names[record['block_id']]]['end'] = record
+        elif record['type'] == 'data':
+            blocks[names[record['block_id']]]['output'] += record['data']
+    assert records[-1]['type'] == 'end_log'
+    return blocks
+
+# pytest replaces sys.stdout and sys.stderr with objects that don't write to
+# fds 1 and 2; put back ones that do, as in a real process.
+def _fd_streams(monkeypatch):
+    monkeypatch.setattr(sys, 'stdout', open(1, 'wt', closefd=False))
+    monkeypatch.setattr(sys, 'stderr', open(2, 'wt', closefd=False))
+
+@pytest.mark.parametrize('capture_fds', (False, True))
+def test_nested_blocks_and_status(tmp_path, monkeypatch, capture_fds):
+    if capture_fds:
+        _fd_streams(monkeypatch)
+    log_file_name = str(tmp_path / 'log.jsonl')
+    with nestedlog.Session([emjsonl.Emitter(log_file_name)], 'session', capture_fds=capture_fds) as session:
+        print('top output')
+        with session.run_python_as_block('outer'):
+            print('outer output')
+            with pytest.raises(nlapi.BlockFailedException):
+                with session.run_python_as_block('inner'):
+                    print('inner output', file=sys.stderr)
+                    raise ValueError('inner failed')
+            session.start_block('warned')
+            session.end_block('warning')
+        session.run_as_block('busy', _busy_cmd)
+        if capture_fds:
+            # Output written straight to the fds is captured too.
+            with session.run_python_as_block('direct'):
+                subprocess.run(['echo', 'from a child'])
+                os.write(2, b'from fd 2\n')
+    blocks = _read(log_file_name)
+    assert blocks['outer']['parent_id'] == blocks['session']['id']
+    assert blocks['inner']['parent_id'] == blocks['outer']['id']
+    assert blocks['session']['output'] == 'top output\n'
+    assert blocks['outer']['output'] == 'outer output\n'
+    assert blocks['inner']['output'].startswith('inner output\nERROR: Exception thrown:\nTraceback')
+    assert blocks['inner']['output'].endswith('ValueError: inner failed\n')
+    assert blocks['busy']['output'] == 'busy done\n'
+    # The inner block's error propagates to its ancestors.
+    assert blocks['inner']['end']['status'] == 'error'
+    assert blocks['warned']['end']['status'] == 'warning'
+    assert blocks['outer']['end']['status'] == 'error'
+    assert blocks['session']['end']['status'] == 'error'
+    assert blocks['busy']['end']['status'] == 'ok'
+    # The command's CPU time is reported in its block's footer.
+    assert blocks['busy']['end']['utime'] + blocks['busy']['end']['stime'] >= 0.25
+    assert 'user ' in nld.format_block_stats(blocks['busy']['end'])
+    if capture_fds:
+        assert blocks['direct']['output'] == 'from a child\nfrom fd 2\n'
+
+def test_failed_command_marks_block(tmp_path):
+    log_file_name = str(tmp_path / 'log.jsonl')
+    session = nestedlog.Session([emjsonl.Emitter(log_file_name)], 'session')
+    session.start()
+    with pytest.raises(nlapi.BlockFailedException):
+        session.run_as_block('fails', ['sh', '-c', 'echo failing >&2; exit 3'])
+    assert session.close() == nld.STATUS_ERROR
+    blocks = _read(log_file_name)
+    assert blocks['fails']['output'] == 'failing\nERROR: Process exit code 3\n'
+    assert blocks['fails']['end']['status'] == 'error'
+
+@pytest.mark.parametrize('capture_fds', (False, True))
+def test_cleanup_when_body_raises(tmp_path, monkeypatch, capture_fds):
+    if capture_fds:
+        _fd_streams(monkeypatch)
+    log_file_name = str(tmp_path / 'log.jsonl')
+    streams = (sys.stdout, sys.stderr)
+    fds = [os.fstat(fd).st_ino for fd in (1, 2)]
+    with pytest.raises(ValueError):
+        with nestedlog.Session([emjsonl.Emitter(log_file_name)], 'session', capture_fds=capture_fds) as session:
+            session.start_block('unclosed')
+            print('before')
+            raise ValueError('body failed')
+    assert (sys.stdout, sys.stderr) == streams
+    assert [os.fstat(fd).st_ino for fd in (1, 2)] == fds
+    blocks = _read(log_file_name)
+    assert blocks['unclosed']['output'].startswith('before\nERROR: Exception thrown:\nTraceback')
+    assert blocks['unclosed']['end']['status'] == 'error'
+    assert blocks['session']['end']['status'] == 'error'
@@ -0,0 +1,70 @@
+# Copyright 2021 Stephen Warren <swarren@wwwdotorg.org>
+# SPDX-License-Identifier: MIT
+
+import nestedlog.data as nld
+import nestedlog.emitter_threaded as nlthreaded
+import nestedlog.filter_output_cap as filtcap
+import nestedlog.sink as nlsink
+import nestedlog.stats as nlstats
+import nestedlog.watchdog as nlwatchdog
+
+class _Recorder(object):
+    def __init__(self, wants_time=False):
+        self.wants_time = wants_time
+        self.chunks = []
+
+    def emit_start_log(self):
+        pass
+
+    def emit_end_log(self):
+        pass
+
+    def emit_digest(self, hits, dropped):
+        pass
+
+    def emit_start_block(self, block_id, block_name):
+        pass
+
+    def emit_end_block(self, status, stats):
+        pass
+
+    def emit_start_stream(self, stream, switching):
+        pass
+
+    def emit_end_stream(self, switching):
+        pass
+
+    def emit_stream_data(self, chunk):
+        self.chunks.append(chunk)
+
+def _times(emitters, recorder):
+    sink = nlsink.Sink(emitters)
+    sink.start_log()
+    sink.start_block('block')
+    sink.stream_data(nld.STREAM_STDOUT, 'text\n')
+    sink.end_block(nld.STATUS_OK)
+    sink.end_log()
+    return [chunk.time for chunk in recorder.chunks]
+
+def test_chunks_are_only_timed_when_wanted():
+    recorder = _Recorder()
+    assert _times([recorder], recorder) == [None]
+    recorder = _Recorder(wants_time=True)
+    assert isinstance(_times([_Recorder(), recorder], recorder)[0], float)
+
+def test_wrappers_forward_wants_time():
+    recorder = _Recorder(wants_time=True)
+    times = _times([nlstats.TimedEmitter(nlthreaded.Emitter(recorder))], recorder)
+    assert isinstance(times[0], float)
+
+def test_watchdog_marker_bypasses_filters():
+    recorder = _Recorder()
+    sink = nlsink.Sink([recorder], filters=(filtcap.Filter(max_block=20, tail=10),))
+    sink.start_log()
+    sink.start_block('block')
+    sink.stream_data(nld.STREAM_STDOUT, 'x' * 100)
+    nlwatchdog.Watchdog(60).stalled(sink, 0)
+    sink.end_block(nld.STATUS_OK)
+    sink.end_log()
+    text = ''.join(chunk.text for chunk in recorder.chunks)
+    assert text.endswith('x' * 10 + '\n[nestedlog: no output or control commands for 1m00s]\n')
@@ -0,0 +1,89 @@
+# Copyright 2021 Stephen Warren <swarren@wwwdotorg.org>
+# SPDX-License-Identifier: MIT
+
+import nestedlog.data as nld
+import nestedlog.emitter_sse as emsse
+import nestedlog.sink as nlsink
+
+def _sink(tmp_path, **kwargs):
+    emitter = emsse.Emitter(str(tmp_path / 'sse.sock'), **kwargs)
+    sink = nlsink.Sink([emitter])
+    sink.start_log()
+    return emitter, sink
+
+def _block(sink, name, text):
+    sink.start_block(name)
+    sink.start_stream(nld.STREAM_STDOUT, False)
+    sink.stream_data(nld.STREAM_STDOUT, text)
+    sink.end_stream(False)
+    sink.end_block(nld.STATUS_OK)
+
+def _check_structure(history):
+    depth = 0
+    for event in history:
+        if event[0] == 'start_block':
+            depth += 1
+        elif event[0] == 'end_block':
+            depth -= 1
+            assert depth >= 0
+        elif event[0] == 'data':
+            assert isinstance(event[1], str)
+    return depth
+
+def test_attach_snapshots_history(tmp_path):
+    emitter, sink = _sink(tmp_path, history_size=100)
+    _block(sink, 'first', 'x' * 100)
+    client, history = emitter._attach()
+    # Pushes the first block's output out of the history.
+    _block(sink, 'second', 'y' * 100)
+    emitter._detach(client)
+    sink.end_log()
+    assert ('data', 'x' * 100) in history
+    assert all(emsse._encode_event(event) for event in history)
+
+def test_history_is_bounded(tmp_path):
+    emitter, sink = _sink(tmp_path, history_size=1000, max_history_events=200)
+    sink.start_block('outer')
+    for i in range(5000):
+        _block(sink, f'inner {i}', f'{i}\n')
+    client, history = emitter._attach()
+    emitter._detach(client)
+    sink.end_block(nld.STATUS_OK)
+    sink.end_log()
+    assert len(history) <= 200 + 2
+    assert history[1] == ('omitted',)
+    # The still-open outer block, and the most recent output, are kept.
+    assert _check_structure(history) == 1
+    assert history[2][0] == 'start_block' and history[2][2] == 'outer'
+    assert history[-3] == ('data', '4999\n')
+
+def test_dropped_output_streams_are_removed(tmp_path):
+    emitter, sink = _sink(tmp_path, history_size=10, max_history_events=1000)
+    for i in range(300):
+        _block(sink, f'block {i}', f'{i:09}\n')
+    client, history = emitter._attach()
+    emitter._detach(client)
+    sink.end_log()
+    _check_structure(history)
+    # Every block is kept, but not the streams whose output was dropped.
+    assert sum(1 for event in history if event[0] == 'start_block') == 300
+    assert sum(1 for event in history if event[0] == 'start_stream') < 150
+    assert history[-3] == ('data', '000000299\n')
+
+def test_open_block_history_is_bounded(tmp_path):
+    emitter, sink = _sink(tmp_path)
+    sink.start_block('open')
+    for i in range(70000):
+        sink.stream_data(nld.STREAM_STDOUT, 'x')
+    for i in range(30000):
+        sink.stream_data(nld.STREAM_STDOUT, 'o')
+        sink.stream_data(nld.STREAM_STDERR, 'e')
+    client, history = emitter._attach()
+    emitter._detach(client)
+    sink.end_block(nld.STATUS_OK)
+    sink.end_log()
+    assert _check_structure(history) == 1
+    assert history[1] == ('omitted',)
+    assert len(history) <= 2 * emitter.max_history_events
+    assert sum(1 for event in history if event[0] == 'data') <= emitter.max_history_events // 4
+    assert history[-2:] == [('start_stream', 'e', True), ('data', 'e')]
@@ -0,0 +1,103 @@
+# Copyright 2021 Stephen Warren <swarren@wwwdotorg.org>
+# SPDX-License-Identifier: MIT
+
+import nestedlog.data as nld
+import nestedlog.emitter_base as nlebase
+import nestedlog.emitter_threaded as nlthreaded
+import pytest
+import threading
+
+# Records events, and holds up emit_start_block() until released, so that
+# the wrapper's queue fills up.
+class _SlowEmitter(object):
+    def __init__(self):
+        self.events = []
+        self.entered = threading.Event()
+        self.release = threading.Event()
+
+    def emit_start_log(self):
+        self.events.append(('start_log',))
+
+    def emit_end_log(self):
+        self.events.append(('end_log',))
+
+    def emit_digest(self, hits, dropped):
+        self.events.append(('digest',))
+
+    def emit_start_block(self, block_id, block_name):
+        self.entered.set()
+        self.release.wait(5)
+        self.events.append(('start_block', block_id))
+
+    def emit_end_block(self, status, stats):
+        self.events.append(('end_block', status))
+
+    def emit_start_stream(self, stream, switching):
+        self.events.append(('start_stream', stream))
+
+    def emit_end_stream(self, switching):
+        self.events.append(('end_stream',))
+
+    def emit_stream_data(self, chunk):
+        self.events.append(('data', chunk.text))
+
+def _start(backpressure):
+    inner = _SlowEmitter()
+    emitter = nlthreaded.Emitter(inner, queue_size=4, backpressure=backpressure)
+    emitter.emit_start_log()
+    emitter.emit_start_block(1, 'slow')
+    # The worker is now stuck in emit_start_block(), with an empty queue.
+    assert inner.entered.wait(5)
+    return inner, emitter
+
+def _finish(inner, emitter):
+    emitter.emit_end_block(nld.STATUS_OK, {})
+    emitter.emit_end_log()
+    assert not emitter.thread.is_alive()
+    return inner.events
+
+def test_block_waits_and_keeps_everything():
+    inner, emitter = _start(nlthreaded.BACKPRESSURE_BLOCK)
+    producer = threading.Thread(target=lambda: [emitter.emit_stream_data(nlebase.Chunk(f'{i}\n')) for i in range(20)])
+    producer.start()
+    producer.join(0.2)
+    # The queue is full, so the producer waits for the worker.
+    assert producer.is_alive()
+    inner.release.set()
+    producer.join(5)
+    events = _finish(inner, emitter)
+    assert events == (
+        [('start_log',), ('start_block', 1)] +
+        [('data', f'{i}\n') for i in range(20)] +
+        [('end_block', nld.STATUS_OK), ('end_log',)]
+    )
+
+def test_drop_counts_and_marks_lost_data():
+    inner, emitter = _start(nlthreaded.BACKPRESSURE_DROP)
+    for i in range(20):
+        emitter.emit_stream_data(nlebase.Chunk(f'{i:09}\n'))
+    inner.release.set()
+    events = _finish(inner, emitter)
+    # The first 4 chunks fill the queue; the other 16 are dropped, and
+    # reported before the next event.
+    assert events == (
+        [('start_log',), ('start_block', 1)] +
+        [('data', f'{i:09}\n') for i in range(4)] +
+        [('data', '\n[nestedlog: 160 characters dropped]\n')] +
+        [('end_block', nld.STATUS_OK), ('end_log',)]
+    )
+
+def test_end_log_reports_errors():
+    class _Failing(_SlowEmitter):
+        def emit_end_block(self, status, stats):
+            raise Exception('emitter failed')
+    inner = _Failing()
+    inner.release.set()
+    emitter = nlthreaded.Emitter(inner)
+    emitter.emit_start_log()
+    emitter.emit_start_block(1, 'block')
+    emitter.emit_end_block(nld.STATUS_OK, {})
+    with pytest.raises(Exception, match='emitter failed'):
+        emitter.emit_end_log()
+    assert not emitter.thread.is_alive()
+    assert inner.events == [('start_log',), ('start_block', 1)]